@@ -2,6 +2,10 @@
 
 from __future__ import print_function
 import subprocess
+import ctypes
+import ctypes.util
+import select
+import io
 import os
 import shutil
 import stat
@@ -11,56 +15,292 @@ import re
 import logging 
 import pdb
 import uuid
+import struct
+import mmap
 import hashlib
+import json
+import errno
 import datetime
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
+import contextlib
+import collections
+import fcntl
 import time
+import threading
+try:
+    from shlex import quote as shellquote
+except ImportError:
+    from pipes import quote as shellquote
 from pdb import set_trace as strace
 
 # TODO: PEP8-ify this, I do a lot of things in a non-standard way apparently
 
 # TODO: would be better to have printed output & logging configured in the same place
-# TODO: if we need to capture the output of *one* chroot command, this doesn't work because of set -v
+# sh() keeps at most this many bytes of a command's output for its return value; past that only the end is kept
+sh_capture_limit = 16*1024*1024
+
+# When this is an open file, everything sh() prints is appended to it as well; see tee_build_log()
+build_log = None
+
+def decode_output(data):
+    """Turn what came out of a pipe into a str, on both Python 2 and 3"""
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+def emit(text, printoutput=True, stream=None):
+    """Print text, unless printoutput is False, and always write it to the build log"""
+    if printoutput:
+        stream = stream if stream else sys.stdout
+        stream.write(text)
+        stream.flush()
+    if build_log:
+        build_log.write(text)
+        build_log.flush()
+
+@contextlib.contextmanager
+def tee_build_log(path):
+    """Append everything sh() prints to path while in this context"""
+    global build_log
+    log = open(path, 'a')
+    # build_one() already points stdout at the log, and it shouldn't get everything twice
+    try:
+        out = os.fstat(sys.stdout.fileno())
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        out = None
+    logst = os.fstat(log.fileno())
+    if out and (out.st_dev, out.st_ino) == (logst.st_dev, logst.st_ino):
+        log.close()
+        yield
+        return
+    previous = build_log
+    build_log = log
+    try:
+        yield
+    finally:
+        build_log = previous
+        log.close()
+
+class OutputCapture(object):
+    """Collect the lines a command prints, keeping only the last limit bytes of them"""
+
+    def __init__(self, limit=None):
+        self.limit = limit if limit is not None else sh_capture_limit
+        self.lines = collections.deque()
+        self.size = 0
+        self.dropped = 0
+
+    def add(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.limit and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft())
+            self.dropped += 1
+
+    def text(self):
+        return ''.join(self.lines).strip('\r\n') # Trims newlines @ beginning/end only
+
+class ShellResult(str):
+    """
+    The output of a command run by sh()
+    It's a str, so callers that only want the output can use it as one, and it also has the command's
+    returncode, its wall and cpu time in seconds, and its peak RSS in KB.
+    cpu and maxrss are None for commands run in a chroot session, since those all share one shell
+    """
+
+    def __new__(cls, output, command=None, returncode=0, wall=0.0, cpu=None, maxrss=None):
+        self = str.__new__(cls, output)
+        self.command = command
+        self.returncode = returncode
+        self.wall = wall
+        self.cpu = cpu
+        self.maxrss = maxrss
+        return self
+
+    def summary(self):
+        parts = ["{:.1f}s".format(self.wall)]
+        if self.cpu is not None:
+            parts.append("cpu {:.1f}s".format(self.cpu))
+        if self.maxrss is not None:
+            parts.append("max rss {}MB".format(self.maxrss // 1024))
+        return ', '.join(parts)
+
+def wait_rusage(pid):
+    """Wait for pid to exit; return its exit code (negative for a signal) and its resource usage"""
+    while True:
+        try:
+            _, status, rusage = os.wait4(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status), rusage
+    return os.WEXITSTATUS(status), rusage
+
+def run_command(cli, env=None, cwd=None, printoutput=True):
+    """
+    Run one shell command, printing its output line by line as it comes, and return a ShellResult
+    Only stdout goes into the result, as with subprocess.check_output(); stderr is printed but not kept
+    """
+    start = time.time()
+    proc = subprocess.Popen(cli, shell=True, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def pump_stderr():
+        for line in iter(proc.stderr.readline, b''):
+            emit(decode_output(line), stream=sys.stderr)
+    errthread = threading.Thread(target=pump_stderr)
+    errthread.daemon = True
+    errthread.start()
+
+    capture = OutputCapture()
+    for line in iter(proc.stdout.readline, b''):
+        line = decode_output(line)
+        capture.add(line)
+        emit(line, printoutput)
+    errthread.join()
+    proc.stdout.close()
+    proc.stderr.close()
+
+    # Popen.wait() doesn't give us the rusage, so reap the process ourselves
+    returncode, rusage = wait_rusage(proc.pid)
+    proc.returncode = returncode
+    if capture.dropped:
+        logging.info("Kept only the last {} bytes of the output of '{}'".format(capture.size, cli))
+    return ShellResult(
+        capture.text(), command=cli, returncode=returncode, wall=time.time() - start,
+        cpu=rusage.ru_utime + rusage.ru_stime, maxrss=rusage.ru_maxrss)
+
+class Tracer(object):
+    """
+    Records nested timing spans for a build, and writes them out in the Chrome trace event format, which
+    chrome://tracing and https://ui.perfetto.dev can open. Spans from different threads go on separate tracks.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """
+        Time the code in this context as a span called name
+        Yields args, so the code being timed can add to what gets recorded about it
+        """
+        start = time.time()
+        try:
+            yield args
+        finally:
+            end = time.time()
+            event = {
+                'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': threading.current_thread().ident,
+                'ts': int(start*1000000), 'dur': int((end - start)*1000000), 'args': args}
+            with self.lock:
+                self.events.append(event)
+
+    def write(self, path):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+
+    def summary(self, count=10):
+        """Return a plain text table of the slowest stages and commands"""
+        lines = []
+        for category, title in (('build', 'Builds'), ('stage', 'Slowest stages'), ('sh', 'Slowest commands')):
+            events = sorted(
+                [e for e in self.events if e['cat'] == category], key=lambda e: e['dur'], reverse=True)[:count]
+            if not events:
+                continue
+            lines.append("{}:".format(title))
+            for event in events:
+                name = event['name'].replace('\n', '; ')
+                if len(name) > 100:
+                    name = name[:97] + '...'
+                lines.append("  {:>9.1f}s  {}".format(event['dur'] / 1000000.0, name))
+        return '\n'.join(lines)
+
+# The Tracer for the current build, or None when it isn't being traced; see tracing()
+tracer = None
+
+@contextlib.contextmanager
+def trace_span(name, category, **args):
+    """Record a span with the current tracer, if there is one; yields a dict to add args to either way"""
+    if tracer is None:
+        yield args
+        return
+    with tracer.span(name, category, **args) as spanargs:
+        yield spanargs
+
+@contextlib.contextmanager
+def tracing(path):
+    """
+    Trace everything in this context, then write the trace to path and a summary of it to path.txt
+    They get written even if the build fails, since slow failures need looking at too
+    If path is None, nothing is traced
+    """
+    global tracer
+    if not path:
+        yield None
+        return
+    tracer = Tracer()
+    try:
+        yield tracer
+    finally:
+        tracer.write(path)
+        summary = tracer.summary()
+        with open(path+'.txt', 'w') as f:
+            f.write(summary+'\n')
+        print(summary)
+        logging.info("Wrote build trace to '{}'".format(path))
+        tracer = None
+
 def sh(commandline, env=None, printoutput=True, chroot=None, chroot_disable_daemons=False, cwd=None):
+    """
+    Run a command, or a list of commands, and return the ShellResult of the last one
+    Output is printed as it comes, and also goes to the build log if there is one
+    Commands for a chroot are run in that chroot's ChrootSession, so they all share one resident shell
+    Raises subprocess.CalledProcessError if a command fails
+    """
     if type(commandline) is str:
         commandline = [commandline]
 
     if chroot:
-        if not (os.path.isdir(chroot)):
-            raise Exception("chroot dir '{}' does not exist".format(chroot))
-        logging.debug('chroot into {}'.format(chroot))
-        nowstamp = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-        cs_name = "chroot_{}.sh".format(nowstamp)
-        cs_path = "{}/root/{}".format(chroot, cs_name)
-        cs_prefix = [
-            '#!/bin/bash',
-            'set -e',         # fail immediately on error
-            ". /etc/profile", # otherwise we get complaints the $PATH isn't set
-            'set -v']         # write each line to output before executing it
-        cs_contents = cs_prefix + commandline
-        write_file(cs_contents, cs_path, append=False, mode=0o700)
-        outercmd = ["chroot {} /root/{}".format(chroot, cs_name)]
-    else:
-        outercmd = commandline
+        session = get_chroot_session(chroot)
+        if chroot_disable_daemons:
+            session.disable_daemons()
+        emit('\n'.join([
+                    "==== Running commands in chroot: {}".format(chroot),
+                    "     commands: {}".format(commandline),
+                    "     env:      {}".format(env)]) + '\n')
+        start = time.time()
+        with trace_span('\n'.join(commandline), 'sh', chroot=chroot):
+            exitcode, output = session.run(commandline, env=env, printoutput=printoutput)
+        result = ShellResult(output, command='\n'.join(commandline), returncode=exitcode, wall=time.time() - start)
+        emit("==== Finished in {}\n".format(result.summary()), printoutput)
+        return result
 
-    outputs = []
-    for cli in outercmd:
-        print('\n'.join([
+    result = ShellResult('')
+    for cli in commandline:
+        emit('\n'.join([
                     "==== Running command: {}".format(cli),
-                    "     chroot: {}".format(chroot),
                     "     cwd:    {}".format(cwd),
-                    "     env:    {}".format(env)]))
-
-        if chroot and chroot_disable_daemons:
-            disable_chroot_daemons()
-        pristine_output = subprocess.check_output(cli, shell=True, env=env, cwd=cwd)
-        if chroot and chroot_disable_daemons:
-            enable_chroot_daemons()
-
-        output = pristine_output.strip('\r\n') # Trims newlines @ beginning/end only
-        if printoutput and len(output) > 0:
-            print(output)
-            print("==== Finished")
-    return output
+                    "     env:    {}".format(env)]) + '\n')
+        with trace_span(cli, 'sh', cwd=cwd) as spanargs:
+            result = run_command(cli, env=env, cwd=cwd, printoutput=printoutput)
+            spanargs.update(returncode=result.returncode, cpu=result.cpu, maxrss=result.maxrss)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cli, output=result)
+        emit("==== Finished in {}\n".format(result.summary()), printoutput)
+    return result
 
 def write_file(contents, filename, append=True, mode=False, uniqueonly=False):
     if type(contents) is str:
@@ -121,129 +361,2180 @@ def disable_chroot_daemons(chroot):
     sh(
         'dpkg-divert --add --local --divert /usr/sbin/invoke-rc.d.chroot --rename /usr/sbin/invoke-rc.d', 
         env={ 'LANG':'C' }, chroot=chroot)
-    os.copy(chroot+'/bin/true', chroot+'/usr/sbin/invoke-rc.d')
+    shutil.copy(chroot+'/bin/true', chroot+'/usr/sbin/invoke-rc.d')
+
+class ChrootSession(object):
+    """
+    One resident bash process inside a chroot, which commands are piped to
+
+    Starting chroot + bash under qemu-user is slow, so instead of spawning one for every command, sh() sends
+    chroot commands to a session that stays up until the image is detached. Each call runs in its own subshell
+    with 'set -e', and its exit code comes back on a line with a marker that commands won't print themselves.
+    """
+
+    # The resident shell starts with this environment; /etc/profile in the chroot sets the rest
+    base_env = {
+        'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+        'HOME': '/root',
+        'LANG': 'C'}
+
+    def __init__(self, chroot):
+        self.chroot = chroot
+        self.proc = None
+        self.daemons_disabled = False
+        self.marker = '__raspseed_{}__'.format(uuid.uuid4().hex)
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        if self.running:
+            return
+        if not os.path.isdir(self.chroot):
+            raise Exception("chroot dir '{}' does not exist".format(self.chroot))
+        logging.debug("Starting chroot session in {}".format(self.chroot))
+        self.proc = subprocess.Popen(
+            ['chroot', self.chroot, '/bin/bash', '--noprofile', '--norc'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=self.base_env, universal_newlines=True)
+        # otherwise we get complaints the $PATH isn't set
+        self._send(['. /etc/profile </dev/null 2>&1'])
+        self._receive(printoutput=False)
+
+    def _send(self, lines):
+        """Send lines to the shell, followed by a command that prints the marker and their exit code"""
+        lines = lines + ['printf "%s %d\\n" {} $?'.format(self.marker)]
+        self.proc.stdin.write('\n'.join(lines) + '\n')
+        self.proc.stdin.flush()
+
+    def _receive(self, printoutput=True):
+        """Read output up to the marker line; return the exit code and the output"""
+        capture = OutputCapture()
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise Exception("chroot session in '{}' exited unexpectedly".format(self.chroot))
+            if self.marker in line:
+                # The marker is printed right after the command, so if the last line of output didn't end in a
+                # newline, it's on the same line
+                before, after = line.split(self.marker, 1)
+                if before:
+                    capture.add(before)
+                    emit(before+'\n', printoutput)
+                return int(after.split()[0]), capture.text()
+            capture.add(line)
+            emit(line, printoutput)
+
+    def run(self, commandline, env=None, printoutput=True, check=True):
+        """
+        Run a command, or a list of commands that stops at the first failure, in the session
+        Return a tuple of (exit code, output)
+        If check is True, raise subprocess.CalledProcessError when the exit code isn't zero
+        """
+        if type(commandline) is str:
+            commandline = [commandline]
+        exports = ['export {}={}'.format(k, shellquote(v)) for k, v in sorted((env or {}).items())]
+        with self.lock:
+            self.start()
+            self._send(['(', 'set -e'] + exports + commandline + [') </dev/null 2>&1'])
+            exitcode, output = self._receive(printoutput=printoutput)
+        if check and exitcode != 0:
+            raise subprocess.CalledProcessError(exitcode, '\n'.join(commandline), output=output)
+        return exitcode, output
+
+    def disable_daemons(self):
+        """Disable daemons in the chroot, once for the whole session"""
+        if not self.daemons_disabled:
+            disable_chroot_daemons(self.chroot)
+            self.daemons_disabled = True
+
+    def close(self):
+        """Re-enable daemons if this session disabled them, and stop the shell"""
+        if not self.running:
+            self.proc = None
+            return
+        if self.daemons_disabled:
+            # Through this session, since sh() would start a new one that nothing closes
+            enable_chroot_daemons(self.chroot, session=self)
+            self.daemons_disabled = False
+        logging.debug("Closing chroot session in {}".format(self.chroot))
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc = None
+
+chroot_sessions = {}
+
+def get_chroot_session(chroot):
+    """Return the session for a chroot directory, creating it if there isn't one yet"""
+    key = os.path.realpath(chroot)
+    if key not in chroot_sessions:
+        chroot_sessions[key] = ChrootSession(chroot)
+    return chroot_sessions[key]
+
+def close_chroot_session(chroot):
+    key = os.path.realpath(chroot)
+    session = chroot_sessions.get(key)
+    if session:
+        session.close()
+        del chroot_sessions[key]
+
+def enable_chroot_daemons(chroot, session=None):
+    """
+    Re-enable daemons to start in the chroot
+    Run this before finishing an image
+    If session is a ChrootSession, the command runs in it instead of through sh()
+    """
+    # In a pristine system, policy-rc.d doesn't exist; if it doesn't now, then daemons are already enabled
+    if not os.path.exists(chroot+'/usr/sbin/policy-rc.d'):
+        logging.debug("Daemons already enabled in chroot {}".format(chroot))
+        return
+    logging.debug("Enabling daemons in chroot {}".format(chroot))
+    os.remove(chroot+'/usr/sbin/policy-rc.d')
+    os.remove(chroot+'/usr/sbin/invoke-rc.d')
+    command = 'dpkg-divert --remove --rename /usr/sbin/invoke-rc.d'
+    if session:
+        session.run(command, env={ 'LANG':'C' })
+    else:
+        sh(command, env={ 'LANG':'C' }, chroot=chroot)
+
+def makedirs(path, mode=0o755, exist_ok=False):
+    """Replacement for os.makedirs() w/ the Py3 feature of exists_ok"""
+    if os.path.exists(path) and exist_ok:
+        return
+    os.makedirs(path, mode)
+
+# Flags for mount(2), from <sys/mount.h>
+MS_RDONLY  = 1
+MS_NOSUID  = 2
+MS_NODEV   = 4
+MS_NOEXEC  = 8
+MS_REMOUNT = 32
+MS_NOATIME = 1024
+MS_BIND    = 4096
+MS_REC     = 16384
+# Flags for umount2(2)
+MNT_DETACH = 2
+
+mount_option_flags = {
+    'ro':       MS_RDONLY,
+    'nosuid':   MS_NOSUID,
+    'nodev':    MS_NODEV,
+    'noexec':   MS_NOEXEC,
+    'remount':  MS_REMOUNT,
+    'noatime':  MS_NOATIME,
+    'bind':     MS_BIND,
+    'rbind':    MS_BIND | MS_REC}
+
+_libc = None
+def libc():
+    """Load the C library for the syscalls that Python doesn't wrap, like mount(2)"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+def _cstr(s):
+    """Convert a str to something ctypes will pass as a char*"""
+    if s is None or isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+def unescape_mountinfo(field):
+    """The kernel escapes space, tab, newline and backslash in mountinfo as octal, like '\\040'"""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+class MountTable(object):
+    """
+    The mount table for this process, parsed from /proc/self/mountinfo and indexed by mountpoint
+
+    The kernel marks mountinfo as readable with POLLPRI/POLLERR whenever a mount or unmount happens,
+    so the table is only re-read when something actually changed, and looking things up in a loop is cheap.
+    """
+    path = '/proc/self/mountinfo'
+
+    def __init__(self):
+        self.entries = []
+        self.bymountpoint = {}
+        self._stale = True
+        self._poller = None
+        self._pid = None
+
+    def _open_poller(self):
+        # A forked child can't share the parent's poll fd, because each change is only reported once per fd
+        self._pid = os.getpid()
+        self._stale = True
+        try:
+            self._pollfd = os.open(self.path, os.O_RDONLY)
+            self._poller = select.poll()
+            self._poller.register(self._pollfd, select.POLLPRI | select.POLLERR)
+        except (OSError, AttributeError):
+            self._poller = None
+            logging.debug("Cannot poll {}; the mount table will be re-read every time".format(self.path))
+
+    def changed(self):
+        """Whether the mount table has changed since it was last read"""
+        if self._pid != os.getpid():
+            self._open_poller()
+        if self._poller is None:
+            return True
+        # Each change is only reported by poll() once, so remember it until the next refresh
+        if self._poller.poll(0):
+            self._stale = True
+        return self._stale
+
+    def refresh(self, force=False):
+        """Re-read the mount table, unless it hasn't changed since the last time"""
+        if not force and not self.changed():
+            return
+        self._stale = False
+        entries = []
+        bymountpoint = {}
+        with open(self.path) as f:
+            for line in f:
+                # Looks like:
+                # 36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+                # There can be any number of optional fields before the '-' separator
+                fields = line.split()
+                sep = fields.index('-')
+                entry = {
+                    'mount_id':   int(fields[0]),
+                    'parent_id':  int(fields[1]),
+                    'devnum':     fields[2],
+                    'root':       unescape_mountinfo(fields[3]),
+                    'fs_file':    unescape_mountinfo(fields[4]),
+                    'fs_mntops':  fields[5],
+                    'fs_vfstype': fields[sep+1],
+                    'fs_spec':    unescape_mountinfo(fields[sep+2]),
+                    'fs_superops': fields[sep+3] if len(fields) > sep+3 else ''}
+                entries.append(entry)
+                bymountpoint.setdefault(entry['fs_file'], []).append(entry)
+        self.entries = entries
+        self.bymountpoint = bymountpoint
+
+    def find(self, mountpoint):
+        """Return the topmost entry mounted on mountpoint, or None"""
+        self.refresh()
+        stack = self.bymountpoint.get(os.path.realpath(mountpoint))
+        return stack[-1] if stack else None
+
+    def is_mounted(self, mountpoint):
+        return self.find(mountpoint) is not None
+
+    def beneath(self, mountpoint):
+        """
+        Return all entries mounted on or below mountpoint, in the order they should be unmounted
+        That's the reverse of the order they were mounted in, which puts submounts before their parents
+        """
+        self.refresh()
+        mountpoint = os.path.realpath(mountpoint)
+        prefix = mountpoint.rstrip('/') + '/'
+        found = [e for e in self.entries
+                 if e['fs_file'] == mountpoint or e['fs_file'].startswith(prefix)]
+        return list(reversed(found))
+
+mounttable = MountTable()
+
+def probe_fstypes():
+    """Filesystem types the kernel knows about that are backed by a device, in the kernel's order"""
+    with open('/proc/filesystems') as f:
+        return [line.split()[0] for line in f if not line.startswith('nodev')]
+
+def native_mount(device, mountpoint, fstype=None, fsoptions=None):
+    """
+    Call mount(2) directly
+    fsoptions is a comma separated string like /bin/mount's -o; anything that isn't a known flag is passed
+    to the filesystem. If fstype is None and this isn't a bind mount, try each type the kernel supports
+    """
+    flags = 0
+    data = []
+    for opt in (fsoptions.split(',') if fsoptions else []):
+        if opt in mount_option_flags:
+            flags |= mount_option_flags[opt]
+        elif opt:
+            data.append(opt)
+    data = ','.join(data) if data else None
+
+    if fstype or flags & (MS_BIND | MS_REMOUNT):
+        fstypes = [fstype]
+    else:
+        fstypes = probe_fstypes()
+
+    for candidate in fstypes:
+        result = libc().mount(
+            _cstr(device), _cstr(mountpoint), _cstr(candidate), ctypes.c_ulong(flags), _cstr(data))
+        if result == 0:
+            return
+        err = ctypes.get_errno()
+        # EINVAL/ENODEV just mean this wasn't the right filesystem type
+        if len(fstypes) > 1 and err in (errno.EINVAL, errno.ENODEV, errno.ENOTBLK):
+            continue
+        raise OSError(err, "Could not mount '{}' on '{}': {}".format(
+            device, mountpoint, os.strerror(err)))
+    raise Exception("Could not mount '{}' on '{}': tried filesystem types {}".format(
+        device, mountpoint, fstypes))
+
+def native_umount(mountpoint, flags=0):
+    """Call umount2(2) directly"""
+    if libc().umount2(_cstr(mountpoint), flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "Could not unmount '{}': {}".format(mountpoint, os.strerror(err)))
+
+def mount(device, mountpoint, fstype=None, fsoptions=None):
+    """
+    Mount a device on a mountpoint
+    Create the mountpoint if necessary
+    If something is already mounted there, do nothing
+    """
+    mountpoint = os.path.realpath(mountpoint)
+    makedirs(mountpoint, mode=0o755, exist_ok=True)
+
+    existing = mounttable.find(mountpoint)
+    if existing:
+        logging.info("Attempted to mount '{}' on '{}' but '{}' is already mounted there".format(
+            device, mountpoint, existing['fs_spec']))
+        return
+    logging.info("Mounting '{}' on '{}' (type: {}, options: {})".format(
+        device, mountpoint, fstype, fsoptions))
+    native_mount(device, mountpoint, fstype=fstype, fsoptions=fsoptions)
+
+def parse_mtab():
+    """
+    Return the current mounts as a list of dicts with fstab(5) style keys
+    Backed by the cached mountinfo table, so escaped spaces etc in mountpoints are handled
+    """
+    mounttable.refresh()
+    return list(mounttable.entries)
+
+def is_mounted(mountpoint):
+    return mounttable.is_mounted(mountpoint)
+
+def show_mountpoint_users(mountpoint):
+    print('The following process are still using your mountpoint:')
+    try:
+        print(sh('lsof | grep {}'.format(mountpoint)))
+    except Exception:
+        print('(could not run lsof)')
+
+def umount(mountpoint, lsof_on_failure=True):
+    """Unmount whatever is mounted on mountpoint, if anything"""
+    umount_all([mountpoint], lsof_on_failure=lsof_on_failure)
+
+def umount_all(mountpoints, lsof_on_failure=True):
+    """
+    Unmount everything mounted on or below any of mountpoints, in one batch
+    Mounts are unmounted in the reverse of the order they were mounted in, so submounts like
+    chroot/dev/pts go before chroot/dev, which goes before chroot
+    """
+    ids = set()
+    for mp in mountpoints:
+        ids.update(e['mount_id'] for e in mounttable.beneath(mp))
+    # mountinfo lists mounts in the order they were made
+    tounmount = [e for e in reversed(mounttable.entries) if e['mount_id'] in ids]
+    for entry in tounmount:
+        logging.info("Unmounting '{}'".format(entry['fs_file']))
+        try:
+            native_umount(entry['fs_file'])
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                # Already gone, e.g. because it was a child of something that was just unmounted
+                continue
+            if lsof_on_failure:
+                show_mountpoint_users(entry['fs_file'])
+            raise
+
+# Where host-wide locks live, like the one that serializes loop device allocation
+lock_dir = '/run/lock/raspseed' if os.path.isdir('/run/lock') else tempfile.gettempdir()+'/raspseed-locks'
+
+class FileLock(object):
+    """
+    An flock(2) lock on a file, usually used in a with statement
+    Many processes can hold a shared lock at once; an exclusive lock can only be held by one, and only while
+    nobody has a shared one. If blocking is False, entering the with block raises instead of waiting
+    """
+
+    def __init__(self, path, shared=False, blocking=True):
+        self.path = path
+        self.shared = shared
+        self.blocking = blocking
+        self.fd = None
+
+    def acquire(self, blocking=None):
+        """Take the lock; return False if blocking is False and somebody else has it"""
+        blocking = self.blocking if blocking is None else blocking
+        makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.fd, mode | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if not blocking:
+                os.close(self.fd)
+                self.fd = None
+                return False
+            logging.info("Waiting for lock '{}'".format(self.path))
+            fcntl.flock(self.fd, mode)
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise Exception("'{}' is locked by another process".format(self.path))
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def host_lock(name, shared=False):
+    """A lock for a resource that every raspseed process on the host shares"""
+    return FileLock('{}/{}.lock'.format(lock_dir, name), shared=shared)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+# ioctls and flags from <linux/loop.h>
+LOOP_SET_FD       = 0x4C00
+LOOP_CLR_FD       = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_GET_STATUS64 = 0x4C05
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_PARTSCAN  = 8
+# struct loop_info64
+loop_info64 = struct.Struct('=QQQQQIIII64s64s32sQQ')
+# ioctl and ops from <linux/blkpg.h>, for adding partitions the kernel didn't find itself
+BLKPG = 0x1269
+BLKPG_ADD_PARTITION = 1
+# struct blkpg_ioctl_arg, and the struct blkpg_partition it points to; struct doesn't add the trailing padding
+# that makes the latter 152 bytes, which is what the kernel copies, so it's spelled out
+blkpg_ioctl_arg = struct.Struct('@iiiP')
+blkpg_partition = struct.Struct('@qqi64s64s4x')
+
+class LoopDevices(object):
+    """
+    Loop devices for images, attached with the kernel's partition scanning so partitions show up as
+    e.g. /dev/loop0p1 without kpartx or device-mapper
+
+    Free devices come from the kernel's pool in /dev/loop-control, which hands out an unused device if there
+    is one and only creates a new one if there isn't. Devices this module attaches are recorded, with the pid
+    that attached them, in a file that every raspseed process on the host shares, so devices leaked by a
+    build that crashed can be found and detached later.
+    """
+
+    def __init__(self, sysfs='/sys/block'):
+        self.sysfs = sysfs
+
+    @property
+    def recordfile(self):
+        return '{}/loop-devices.json'.format(lock_dir)
+
+    def _sysfs_read(self, device, name):
+        try:
+            with open('{}/{}/loop/{}'.format(self.sysfs, os.path.basename(device), name)) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def backing_file(self, device):
+        """The file a loop device is attached to, or None if it isn't attached"""
+        backing = self._sysfs_read(device, 'backing_file')
+        # The kernel appends this if the file was deleted while attached
+        if backing and backing.endswith(' (deleted)'):
+            backing = backing[:-len(' (deleted)')]
+        return backing
+
+    def devices(self):
+        """Every attached loop device on the host, as a dict of device path to the file it's attached to"""
+        retval = {}
+        for name in sorted(os.listdir(self.sysfs)):
+            if re.match('^loop\d+$', name):
+                backing = self.backing_file(name)
+                if backing:
+                    retval['/dev/'+name] = backing
+        return retval
+
+    def attached(self, image):
+        """Loop devices the image is attached to"""
+        image = os.path.realpath(image)
+        retval = [dev for dev, backing in sorted(self.devices().items()) if backing == image]
+        for dev in retval:
+            logging.info("Found existing loopback device for image '{}' at '{}'".format(image, dev))
+        return retval
+
+    def partition(self, device, number):
+        return '{}p{}'.format(device, number)
+
+    def attach(self, image):
+        """Attach an image to a loop device with partition scanning, reusing one it's already attached to"""
+        # Another build could grab the same free device between finding it and attaching to it
+        with host_lock('loop'):
+            self.reap()
+            existing = self.attached(image)
+            if existing:
+                if len(existing) > 1:
+                    logging.warn("Multiple loop devices found for '{}': {}".format(image, existing))
+                self._partscan(existing[0])
+                self.add_partitions(existing[0])
+                return existing[0]
+            try:
+                device = self._attach(image)
+            except (IOError, OSError) as e:
+                # Like in a container without /dev/loop-control
+                logging.info("Cannot attach '{}' with ioctls ({}); using losetup".format(image, e))
+                device = sh('losetup --find --show --partscan "{}"'.format(image), printoutput=False).strip()
+            records = read_json(self.recordfile, default={})
+            records[device] = {'image': os.path.realpath(image), 'pid': os.getpid()}
+            write_json(records, self.recordfile)
+            logging.info("Connected image '{}' to new loopback device at '{}'".format(image, device))
+            self.add_partitions(device)
+            return device
+
+    def _attach(self, image):
+        ctl = os.open('/dev/loop-control', os.O_RDWR)
+        try:
+            while True:
+                device = '/dev/loop{}'.format(fcntl.ioctl(ctl, LOOP_CTL_GET_FREE))
+                fd = os.open(device, os.O_RDWR)
+                try:
+                    backing = os.open(image, os.O_RDWR)
+                    try:
+                        fcntl.ioctl(fd, LOOP_SET_FD, backing)
+                    except (IOError, OSError) as e:
+                        # Something that doesn't take our lock, like losetup, got there first
+                        if e.errno == errno.EBUSY:
+                            continue
+                        raise
+                    finally:
+                        os.close(backing)
+                    name = os.path.realpath(image).encode('utf-8')[:63]
+                    info = loop_info64.pack(0, 0, 0, 0, 0, 0, 0, 0, LO_FLAGS_PARTSCAN, name, b'', b'', 0, 0)
+                    try:
+                        fcntl.ioctl(fd, LOOP_SET_STATUS64, info)
+                    except (IOError, OSError):
+                        fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+                        raise
+                    return device
+                finally:
+                    os.close(fd)
+        finally:
+            os.close(ctl)
+
+    def _partscan(self, device):
+        """Turn on partition scanning for a device that was attached without it, like by older raspseed"""
+        if self._sysfs_read(device, 'partscan') != '0':
+            return
+        logging.info("Enabling partition scanning on '{}'".format(device))
+        fd = os.open(device, os.O_RDWR)
+        try:
+            info = list(loop_info64.unpack(fcntl.ioctl(fd, LOOP_GET_STATUS64, b'\0' * loop_info64.size)))
+            info[8] |= LO_FLAGS_PARTSCAN
+            fcntl.ioctl(fd, LOOP_SET_STATUS64, loop_info64.pack(*info))
+        finally:
+            os.close(fd)
+
+    def partitions(self, device):
+        """Partition numbers the kernel has for the device"""
+        name = os.path.basename(device)
+        found = [re.match('^{}p(\d+)$'.format(name), n) for n in os.listdir('{}/{}'.format(self.sysfs, name))]
+        return sorted(int(m.group(1)) for m in found if m)
+
+    def add_partitions(self, device):
+        """
+        Add the partitions in the device's partition table that the kernel's scan didn't, which is all of them
+        on kernels built without support for that type of partition table
+        """
+        existing = self.partitions(device)
+        missing = [(i+1, p) for i, p in enumerate(read_partition_table(device)) if i+1 not in existing]
+        if not missing:
+            return
+        logging.info("Adding partitions {} of '{}' to the kernel".format([n for n, _ in missing], device))
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            for number, part in missing:
+                data = ctypes.create_string_buffer(
+                    blkpg_partition.pack(part['start'], part['size'], number, b'', b''), blkpg_partition.size)
+                arg = blkpg_ioctl_arg.pack(BLKPG_ADD_PARTITION, 0, blkpg_partition.size, ctypes.addressof(data))
+                fcntl.ioctl(fd, BLKPG, arg)
+        finally:
+            os.close(fd)
+
+    def in_use(self, device):
+        """Whether the device or any of its partitions is mounted or held by something like device-mapper"""
+        name = os.path.basename(device)
+        if os.listdir('{}/{}/holders'.format(self.sysfs, name)):
+            return True
+        mounttable.refresh()
+        return any(re.match('^{}(p\d+)?$'.format(re.escape(device)), e['fs_spec']) for e in mounttable.entries)
+
+    def detach(self, device):
+        logging.info("Removing loopback device '{}'".format(device))
+        if os.listdir('{}/{}/holders'.format(self.sysfs, os.path.basename(device))):
+            logging.warn("'{}' is still held by device-mapper, probably from kpartx; remove its maps with "
+                         "'dmsetup remove' and it will be detached when they're gone".format(device))
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            # If something still has it open, the kernel detaches it once that's closed instead
+            fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENXIO:
+                raise
+        finally:
+            os.close(fd)
+        with host_lock('loop'):
+            records = read_json(self.recordfile, default={})
+            if records.pop(device, None):
+                write_json(records, self.recordfile)
+
+    def detach_image(self, image):
+        """Detach every loop device the image is attached to"""
+        for device in self.attached(image):
+            self.detach(device)
+
+    def reap(self):
+        """
+        Detach devices that raspseed attached from processes that are gone, unless something is still using them
+        Call with host_lock('loop') held
+        """
+        records = read_json(self.recordfile, default={})
+        attached = self.devices()
+        for device, record in list(records.items()):
+            if attached.get(device) != record['image']:
+                # Detached since, or reused for something else
+                del records[device]
+            elif not pid_alive(record['pid']) and not self.in_use(device):
+                logging.info("Detaching '{}' for '{}', leaked by process {}".format(
+                    device, record['image'], record['pid']))
+                fd = os.open(device, os.O_RDONLY)
+                try:
+                    fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+                finally:
+                    os.close(fd)
+                del records[device]
+        write_json(records, self.recordfile)
+
+loopdevices = LoopDevices()
+
+# Digests computed over finished images. sha1 is kept for anything that still
+# expects the old .sha1 file
+checksum_algorithms = ['sha256', 'sha512', 'blake2b', 'sha1']
+# Digests that also get a sidecar file next to the image, like raspseed.img.sha256
+checksum_sidecars = ['sha256', 'sha1']
+# Images are read this many bytes at a time, so memory use doesn't grow with image size
+checksum_chunksize = 4 * 1024 * 1024
+
+class MultiDigest(object):
+    """
+    Compute several hashlib digests over the same data in one pass
+    Algorithms that this Python's hashlib doesn't have (like blake2b before 3.6) are skipped
+    """
+    def __init__(self, algorithms=None):
+        self.hashers = {}
+        self.length = 0
+        for algo in (algorithms if algorithms else checksum_algorithms):
+            try:
+                self.hashers[algo] = hashlib.new(algo)
+            except ValueError:
+                logging.warning("Hash algorithm '{}' is not available, skipping it".format(algo))
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.length += len(data)
+
+    def hexdigests(self):
+        return dict((algo, hasher.hexdigest()) for algo, hasher in self.hashers.items())
+
+def log_progress(label, total, step=10):
+    """
+    Return a callback that takes a number of bytes processed so far and logs
+    a progress message every time another 'step' percent of 'total' is done
+    """
+    state = {'next': step}
+    def progress(done):
+        if not total:
+            return
+        percent = done * 100 // total
+        if percent >= state['next'] or done == total:
+            logging.info("{}: {}% ({}MB of {}MB)".format(
+                label, percent, done // 1024 // 1024, total // 1024 // 1024))
+            state['next'] = (percent // step + 1) * step
+    return progress
+
+def checksum_file(path, algorithms=None, chunksize=None, progress=None):
+    """
+    Calculate several digests of a file in a single pass
+    The file is read into one reused buffer, so memory use is bounded by chunksize no matter how big the file is
+    Returns a dict like {'sha256': 'abc123...', 'sha1': 'def456...'}
+    """
+    digest = MultiDigest(algorithms)
+    buf = bytearray(chunksize if chunksize else checksum_chunksize)
+    view = memoryview(buf)
+    with io.open(path, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            digest.update(view[:count])
+            if progress:
+                progress(digest.length)
+    return digest.hexdigests()
+
+def write_checksum_sidecars(path, digests, algorithms=None):
+    """
+    Write digests next to a file, in the format that sha256sum -c and friends understand
+    """
+    for algo in (algorithms if algorithms else checksum_sidecars):
+        if algo not in digests:
+            continue
+        write_file(
+            "{}  {}".format(digests[algo], os.path.basename(path)),
+            "{}.{}".format(path, algo), append=False)
+
+# Compressors for export_image(), as a command line that reads stdin and writes stdout, and a default level
+# -T0 uses a thread for every CPU
+export_formats = {
+    'zst': {'command': 'zstd -T0 -q -c -{level}', 'level': 19},
+    'xz': {'command': 'xz -T0 -c -{level}', 'level': 6}}
+
+def export_image(path, fmt='zst', level=None, algorithms=None, progress=None):
+    """
+    Compress an image to path.fmt in one pass, checksumming the image and the compressed file as it goes
+    Only the parts of the image with data in them are read; holes are fed to the compressor as zeroes from
+    memory. Writes checksum sidecars for the compressed file, and returns (compressed path, image digests,
+    compressed file digests)
+    """
+    if fmt not in export_formats:
+        raise Exception("Unknown export format '{}'; use one of {}".format(fmt, sorted(export_formats)))
+    outpath = '{}.{}'.format(path, fmt)
+    command = export_formats[fmt]['command'].format(
+        level=level if level is not None else export_formats[fmt]['level'])
+    size = os.path.getsize(path)
+    imagedigest = MultiDigest(algorithms)
+    outdigest = MultiDigest(algorithms)
+    zeroes = memoryview(bytearray(checksum_chunksize))
+    view = memoryview(bytearray(checksum_chunksize))
+
+    logging.info("Exporting '{}' to '{}' with '{}'".format(path, outpath, command))
+    start = time.time()
+    out = open(outpath+'.tmp', 'wb')
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # The compressed output is read on another thread, so neither end of the pipe can fill up and block
+    def drain():
+        for data in iter(lambda: proc.stdout.read(checksum_chunksize), b''):
+            outdigest.update(data)
+            out.write(data)
+    drainer = threading.Thread(target=drain)
+    drainer.daemon = True
+    drainer.start()
+
+    def feed(data):
+        imagedigest.update(data)
+        proc.stdin.write(data)
+        if progress:
+            progress(imagedigest.length)
+
+    try:
+        offset = 0
+        with io.open(path, 'rb', buffering=0) as f:
+            # The last range is a placeholder, to fill in any hole at the end of the image
+            for datastart, length in list(iter_data_ranges(path)) + [(size, 0)]:
+                while offset < datastart:
+                    count = min(checksum_chunksize, datastart - offset)
+                    feed(zeroes[:count])
+                    offset += count
+                f.seek(datastart)
+                end = datastart + length
+                while offset < end:
+                    count = f.readinto(view[:min(checksum_chunksize, end - offset)])
+                    if not count:
+                        break
+                    feed(view[:count])
+                    offset += count
+        proc.stdin.close()
+    finally:
+        returncode = proc.wait()
+        drainer.join()
+        out.close()
+    if returncode != 0:
+        os.remove(outpath+'.tmp')
+        raise Exception("'{}' failed with exit code {} exporting '{}'".format(command, returncode, path))
+    os.rename(outpath+'.tmp', outpath)
+
+    outdigests = outdigest.hexdigests()
+    write_checksum_sidecars(outpath, outdigests)
+    elapsed = time.time() - start
+    logging.info("Exported '{}' in {:.1f}s: {}MB to {}MB ({:.1f}MB/s)".format(
+        outpath, elapsed, size // 1024 // 1024, outdigest.length // 1024 // 1024,
+        size / 1024.0 / 1024 / max(elapsed, 0.001)))
+    return outpath, imagedigest.hexdigests(), outdigests
+
+# How create_image gets space for a new image:
+#   sparse:    set the file size only; blocks get allocated when something writes to them
+#   fallocate: reserve all the blocks up front, without writing to them
+#   zero:      write every byte from /dev/zero with dd (the old behavior)
+allocation_modes = ['sparse', 'fallocate', 'zero']
+
+def allocate_image(path, sizemb, mode='sparse'):
+    """Create a file of sizemb megabytes at path, using one of the allocation_modes"""
+    size = sizemb * 1024 * 1024
+    if mode == 'sparse':
+        with open(path, 'wb') as f:
+            f.truncate(size)
+    elif mode == 'fallocate':
+        if hasattr(os, 'posix_fallocate'):
+            with open(path, 'wb') as f:
+                os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            sh('fallocate --length {} "{}"'.format(size, path))
+    elif mode == 'zero':
+        sh('dd if=/dev/zero of="{}" bs=1M count="{}"'.format(path, sizemb))
+    else:
+        raise Exception("Unknown allocation mode '{}'; must be one of {}".format(mode, allocation_modes))
+    logging.info("Allocated image '{}' ({}): {}MB apparent size, {}MB on disk".format(
+        path, mode, sizemb, allocated_size(path) // 1024 // 1024))
+
+def allocated_size(path):
+    """The number of bytes a file actually takes up on disk, which is less than its size if it has holes"""
+    return os.stat(path).st_blocks * 512
+
+# Python 2's os module doesn't have these, but Linux has had them since 3.1
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
+
+def iter_data_ranges(path):
+    """
+    Yield (offset, length) tuples for the parts of a file that have data in them, skipping holes
+    Uses SEEK_DATA/SEEK_HOLE where the OS and filesystem support it; otherwise the whole file is one range
+    """
+    size = os.path.getsize(path)
+    if SEEK_DATA is None:
+        if size:
+            yield (0, size)
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Nothing but hole from here to the end of the file
+                    break
+                if e.errno == errno.EINVAL:
+                    # The filesystem doesn't support SEEK_DATA
+                    yield (offset, size - offset)
+                    break
+                raise
+            end = os.lseek(fd, start, SEEK_HOLE)
+            yield (start, end - start)
+            offset = end
+    finally:
+        os.close(fd)
+
+def is_zeroes(data):
+    return data.count(b'\0') == len(data)
+
+def sparse_copy(src, dst, chunksize=None):
+    """
+    Copy a file without filling in its holes
+    Only the ranges of src that have data are read, and chunks of those that are all zeroes are skipped too,
+    so they stay holes in dst
+    """
+    size = os.path.getsize(src)
+    with io.open(dst, 'wb') as fout:
+        fout.truncate(size)
+    sparse_copy_into(src, dst, 0, chunksize)
+    shutil.copymode(src, dst)
+    logging.info("Copied '{}' to '{}': {}MB apparent size, {}MB on disk".format(
+        src, dst, size // 1024 // 1024, allocated_size(dst) // 1024 // 1024))
+
+def sparse_copy_into(src, dst, offset, chunksize=None):
+    """Write src into the existing file dst, starting at offset, without writing src's holes or zeroes"""
+    chunksize = chunksize if chunksize else checksum_chunksize
+    with io.open(src, 'rb') as fin, io.open(dst, 'r+b') as fout:
+        for start, length in iter_data_ranges(src):
+            fin.seek(start)
+            while length > 0:
+                data = fin.read(min(chunksize, length))
+                if not data:
+                    break
+                if not is_zeroes(data):
+                    fout.seek(offset + start)
+                    fout.write(data)
+                start += len(data)
+                length -= len(data)
+
+# SD cards write in erase blocks, so partitions that start partway through one make every write to them slower
+# 4MB covers most cards; some want more
+erase_block_size = 4*1024*1024
+# The size of the FAT boot partition, in MB
+boot_partition_size = 64
+sector_size = 512
+
+# MBR partition type IDs
+mbr_types = {'fat16': 0x0e, 'fat32': 0x0c, 'linux': 0x83}
+
+# How the filesystems are made; see mkfs_options()
+# default is whatever mkfs does on its own, which is tuned for hard disks. The sdcard profiles line ext4's
+# allocation up with the card's erase blocks, initialize the inode tables and journal while building instead of
+# in the background on the Pi's first boot, use fewer inodes (each one is a write to the card), and make the FAT
+# filesystem with clusters that are a whole number of the card's pages. sdcard-writeback also journals only
+# metadata, which writes less, but files written just before a power cut can end up with old data in them
+filesystem_profiles = {
+    'default': {
+        'stripe': False, 'lazy_init': True, 'inode_ratio': None, 'journal': None,
+        'fat_bits': None, 'fat_cluster': None},
+    'sdcard': {
+        'stripe': True, 'lazy_init': False, 'inode_ratio': 32768, 'journal': 'ordered',
+        'fat_bits': 16, 'fat_cluster': 4096},
+    'sdcard-writeback': {
+        'stripe': True, 'lazy_init': False, 'inode_ratio': 32768, 'journal': 'writeback',
+        'fat_bits': 16, 'fat_cluster': 4096}}
+filesystem_profile = 'sdcard'
+# ext4 block size, which stride and stripe width are counted in
+ext4_block_size = 4096
+
+def boot_partition_type(profile):
+    """The MBR type for the boot partition that one of filesystem_profiles makes"""
+    return mbr_types['fat16'] if filesystem_profiles[profile]['fat_bits'] == 16 else mbr_types['fat32']
+
+def mkfs_options(profile, eraseblock=None, extended=None):
+    """
+    Return the options for mkfs.ext4, tune2fs -o (or None), and mkfs.vfat, as strings, for one of
+    filesystem_profiles. extended is a list of more -E options for mkfs.ext4, like offset=
+    """
+    settings = filesystem_profiles[profile]
+    eraseblock = eraseblock if eraseblock else erase_block_size
+    extended = list(extended) if extended else []
+    ext4 = ['-b {}'.format(ext4_block_size)] if settings['stripe'] else []
+    if settings['stripe']:
+        # Each erase block is a RAID chunk, as far as ext4 is concerned, so it keeps big writes inside them
+        blocks = max(eraseblock // ext4_block_size, 1)
+        extended += ['stride={}'.format(blocks), 'stripe_width={}'.format(blocks)]
+    if not settings['lazy_init']:
+        extended += ['lazy_itable_init=0', 'lazy_journal_init=0']
+    if extended:
+        ext4.append('-E {}'.format(','.join(extended)))
+    if settings['inode_ratio']:
+        ext4.append('-i {}'.format(settings['inode_ratio']))
+    tune = None
+    if settings['journal'] == 'none':
+        ext4.append('-O ^has_journal')
+    elif settings['journal']:
+        tune = 'journal_data_{}'.format(settings['journal'])
+    vfat = []
+    if settings['fat_bits']:
+        vfat.append('-F {}'.format(settings['fat_bits']))
+    if settings['fat_cluster']:
+        vfat.append('-s {}'.format(settings['fat_cluster'] // sector_size))
+    return ' '.join(ext4), tune, ' '.join(vfat)
+
+def partition_layout(disksize, eraseblock=None, bootsize=None, boottype=None):
+    """
+    Work out where the boot and root partitions go on a disk of disksize bytes
+    Both start on an erase block boundary, and the root partition takes up the rest of the disk, down to the
+    last whole erase block. Returns a list of dicts with the start and size in bytes, type, and bootable flag
+    boottype is the boot partition's MBR type, FAT32 by default; see boot_partition_type()
+    """
+    eraseblock = eraseblock if eraseblock else erase_block_size
+    bootsize = (bootsize if bootsize else boot_partition_size) * 1024 * 1024
+    if eraseblock % sector_size:
+        raise Exception("Erase block size {} is not a multiple of the sector size".format(eraseblock))
+    def align(offset):
+        return (offset + eraseblock - 1) // eraseblock * eraseblock
+    bootstart = eraseblock
+    rootstart = align(bootstart + bootsize)
+    rootsize = (disksize // eraseblock * eraseblock) - rootstart
+    if rootsize <= 0:
+        raise Exception("A {} byte disk is too small for a {} byte boot partition".format(disksize, bootsize))
+    return [
+        {'start': bootstart, 'size': rootstart - bootstart, 'type': boottype if boottype else mbr_types['fat32'],
+         'bootable': True},
+        {'start': rootstart, 'size': rootsize, 'type': mbr_types['linux'], 'bootable': False}]
+
+def write_mbr(path, partitions, diskid=None):
+    """
+    Write an MBR partition table for partitions (a list like partition_layout() returns) to the start of path
+    diskid is the disk signature; if it's None, an existing signature is kept, or a random one made up
+    The CHS fields are filled with the "use LBA" value, which is all anything since the 90s reads
+    """
+    if len(partitions) > 4:
+        raise Exception("An MBR has room for 4 partitions, not {}".format(len(partitions)))
+    if diskid is None:
+        # Keep the disk's signature if it already has one, since things like PARTUUID= depend on it
+        with io.open(path, 'rb') as f:
+            f.seek(440)
+            diskid = struct.unpack('<I', f.read(4).ljust(4, b'\0'))[0]
+        diskid = diskid if diskid else uuid.uuid4().int & 0xffffffff
+    entries = b''
+    for p in partitions:
+        if p['start'] % sector_size or p['size'] % sector_size:
+            raise Exception("Partition {} is not made of whole sectors".format(p))
+        entries += struct.pack(
+            '<B3sB3sII', 0x80 if p['bootable'] else 0, b'\xfe\xff\xff', p['type'], b'\xfe\xff\xff',
+            p['start'] // sector_size, p['size'] // sector_size)
+    entries += b'\0' * 16 * (4 - len(partitions))
+    with io.open(path, 'r+b') as f:
+        f.seek(440)
+        f.write(struct.pack('<IH', diskid, 0) + entries + b'\x55\xaa')
+
+def read_partition_table(path):
+    """Read the MBR of a disk image, and return its partitions like partition_layout() does"""
+    with io.open(path, 'rb') as f:
+        mbr = f.read(512)
+    if len(mbr) < 512 or mbr[510:512] != b'\x55\xaa':
+        raise Exception("'{}' does not have an MBR partition table".format(path))
+    partitions = []
+    for i in range(4):
+        status, _, ptype, _, lba, sectors = struct.unpack('<B3sB3sII', mbr[446+16*i:446+16*(i+1)])
+        if ptype == 0:
+            continue
+        partitions.append({
+            'start': lba * sector_size, 'size': sectors * sector_size, 'type': ptype, 'bootable': status == 0x80})
+    return partitions
+
+def partition_extents(path):
+    """Return a list of (start, size) in bytes for each partition of a disk image"""
+    return [(p['start'], p['size']) for p in read_partition_table(path)]
+
+# How long to wait for partition device nodes to show up after attaching an image, in seconds
+device_timeout = 30
+
+def is_block_device(path):
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+def wait_for_devices(paths, timeout=None, interval=0.01, maxinterval=0.5):
+    """
+    Wait until every path in paths exists as a block device, and return as soon as they all do
+    losetup returns before udev has created the device nodes, so they may not be there yet
+    Polls with exponential backoff, starting at interval seconds and sleeping no longer than maxinterval
+    Raises an exception if the devices still aren't there after timeout seconds
+    """
+    timeout = device_timeout if timeout is None else timeout
+    start = time.time()
+    missing = list(paths)
+    while True:
+        missing = [p for p in missing if not is_block_device(p)]
+        elapsed = time.time() - start
+        if not missing:
+            logging.debug("Devices {} ready after {:.3f}s".format(paths, elapsed))
+            return
+        if elapsed >= timeout:
+            raise Exception("Timed out after {}s waiting for devices {}".format(timeout, missing))
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * 2, maxinterval)
+
+# ioctls from <linux/fs.h>
+FICLONE  = 0x40049409
+FIFREEZE = 0xC0045877
+FITHAW   = 0xC0045878
+FITRIM   = 0xC0185879
+
+def reflink(src, dst):
+    """
+    Make dst a copy-on-write clone of src, which takes no time and no space until one of them changes
+    Raises IOError/OSError if the filesystem can't do that (it needs to be something like btrfs or xfs)
+    """
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+    shutil.copymode(src, dst)
+
+def clone_file(src, dst, allow_copy=True):
+    """
+    Reflink src to dst, or fall back to sparse_copy() if the filesystem can't reflink and allow_copy is True
+    Returns True if dst is a reflink
+    """
+    try:
+        reflink(src, dst)
+        return True
+    except (IOError, OSError) as e:
+        if os.path.exists(dst):
+            os.remove(dst)
+        if not allow_copy:
+            raise
+        logging.debug("Could not reflink '{}' to '{}' ({}); copying it instead".format(src, dst, e))
+        sparse_copy(src, dst)
+        return False
+
+def copy_file_range(fdin, fdout, count):
+    """copy_file_range(2), which copies data between files inside the kernel; returns how many bytes it copied"""
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(fdin, fdout, count)
+    func = libc().copy_file_range
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    copied = func(fdin, None, fdout, None, count, 0)
+    if copied < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return copied
+
+def copy_data(src, dst):
+    """
+    Copy the contents of src to dst as cheaply as the filesystems allow: a reflink, then copy_file_range(2),
+    then plain reads and writes. Returns which one it used
+    """
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                return 'reflink'
+            except (IOError, OSError):
+                pass
+            size = os.fstat(fin.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    count = copy_file_range(fin.fileno(), fout.fileno(), size - copied)
+                    if count == 0:
+                        break
+                    copied += count
+            # Old kernels can't do it between filesystems, and old libcs don't have it at all
+            except (OSError, AttributeError):
+                pass
+            if copied == size:
+                return 'copy_file_range'
+            fin.seek(0)
+            fout.seek(0)
+            fout.truncate()
+            shutil.copyfileobj(fin, fout, 1024*1024)
+            return 'copy'
+
+def copy_metadata(src, dst, st):
+    """Give dst the owner, mode, extended attributes and times of src, whose lstat() is st"""
+    islink = stat.S_ISLNK(st.st_mode)
+    try:
+        os.lchown(dst, st.st_uid, st.st_gid)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            raise
+    # Python 2 can't get at xattrs
+    if hasattr(os, 'listxattr'):
+        try:
+            for name in os.listxattr(src, follow_symlinks=False):
+                os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM):
+                raise
+    if not islink:
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+def resolve_in_root(root, rel, follow=True):
+    """
+    Return the host path for rel inside root, resolving symlinks on the way the way a chroot into root would:
+    absolute links are relative to root, and nothing can lead out of it. The last part of rel is only
+    followed if follow is True. Links in the image, like /var/run -> /run, would otherwise point at the host
+    """
+    parts = [p for p in rel.split('/') if p not in ('', '.')]
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        path = os.path.join(root, *(resolved + [part]))
+        if os.path.islink(path) and (parts or follow):
+            links += 1
+            if links > 40:
+                raise Exception("Too many levels of symbolic links resolving '{}' in '{}'".format(rel, root))
+            linkto = os.readlink(path)
+            if linkto.startswith('/'):
+                resolved = []
+            parts = [p for p in linkto.split('/') if p not in ('', '.')] + parts
+            continue
+        resolved.append(part)
+    return os.path.join(root, *resolved) if resolved else root
+
+def sync_tree(src, dst, manifest=None, jobs=4):
+    """
+    Merge the tree at src into dst, which may already exist, and return a dict of statistics
+    Files are copied by a pool of jobs threads with copy_data(), keeping owners, modes, xattrs and symlinks.
+    manifest is a JSON file that remembers the size, mtime and sha256 of every file copied. A file that's
+    unchanged since the last sync, and that's still the same in dst, is skipped; so is one that was only
+    touched, once its hash shows that. Nothing in dst is deleted, and directories that dst already has keep
+    their owners and modes, since dst is usually a root filesystem. Paths in dst are resolved like a chroot
+    into it would, with resolve_in_root(), so symlinks in dst never lead out of it.
+    """
+    def mtime_ms(st):
+        return int(st.st_mtime * 1000)
+
+    previous = read_json(manifest, {}) if manifest else {}
+    current = {}
+    files = []
+    newdirs = []
+    stats = {'copied': 0, 'bytes': 0, 'skipped': 0, 'links': 0, 'methods': {}}
+
+    for dirpath, dirnames, filenames in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        for name in sorted(dirnames + filenames):
+            rel = os.path.normpath(os.path.join(reldir, name))
+            st = os.lstat(os.path.join(src, rel))
+            if stat.S_ISDIR(st.st_mode):
+                target = resolve_in_root(dst, rel)
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    raise Exception("'{}' is a directory in '{}', but not in '{}'".format(rel, src, dst))
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                    newdirs.append((rel, target, st))
+                continue
+            target = resolve_in_root(dst, rel, follow=False)
+            if stat.S_ISLNK(st.st_mode):
+                linkto = os.readlink(os.path.join(src, rel))
+                if not (os.path.islink(target) and os.readlink(target) == linkto):
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(linkto, target)
+                    copy_metadata(os.path.join(src, rel), target, st)
+                    stats['links'] += 1
+            elif stat.S_ISREG(st.st_mode):
+                files.append((rel, target, st))
+
+    def sync_file(item):
+        rel, target, st = item
+        source = os.path.join(src, rel)
+        entry = previous.get(rel)
+        try:
+            dstst = os.lstat(target)
+        except OSError:
+            dstst = None
+        # dst still has what the last sync put there
+        intact = (entry and dstst and stat.S_ISREG(dstst.st_mode) and
+                  dstst.st_size == entry['size'] and mtime_ms(dstst) == entry['mtime'])
+        if intact and st.st_size == entry['size'] and mtime_ms(st) == entry['mtime']:
+            return rel, entry, None
+        digest = checksum_file(source, ['sha256'])['sha256']
+        record = {'size': st.st_size, 'mtime': mtime_ms(st), 'sha256': digest}
+        if intact and digest == entry['sha256']:
+            # Only touched; bring the times up to date so next time it's skipped without hashing
+            copy_metadata(source, target, st)
+            return rel, record, None
+        tmp = os.path.join(os.path.dirname(target), '.{}.raspseed-tmp'.format(os.path.basename(target)))
+        method = copy_data(source, tmp)
+        copy_metadata(source, tmp, st)
+        os.rename(tmp, target)
+        return rel, record, method
+
+    pool = ThreadPool(jobs)
+    try:
+        for rel, record, method in pool.imap_unordered(sync_file, files):
+            current[rel] = record
+            if method:
+                stats['copied'] += 1
+                stats['bytes'] += record['size']
+                stats['methods'][method] = stats['methods'].get(method, 0) + 1
+            else:
+                stats['skipped'] += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    # Last, so that copying files into them doesn't change their times, and restrictive modes don't get in the way
+    for rel, target, st in reversed(newdirs):
+        copy_metadata(os.path.join(src, rel), target, st)
+
+    if manifest:
+        makedirs(os.path.dirname(manifest), exist_ok=True)
+        write_json(current, manifest)
+    return stats
+
+# fallocate(2) flags
+FALLOC_FL_KEEP_SIZE  = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+def fitrim(mountpoint):
+    """Discard all the free space of the filesystem mounted at mountpoint; returns how many bytes it discarded"""
+    fd = os.open(mountpoint, os.O_RDONLY)
+    try:
+        # struct fstrim_range: start, length, and the smallest extent worth discarding
+        result = fcntl.ioctl(fd, FITRIM, struct.pack('=QQQ', 0, 0xffffffffffffffff, 0))
+    finally:
+        os.close(fd)
+    return struct.unpack('=QQQ', result)[1]
+
+def zero_free_space(mountpoint, chunksize=None):
+    """
+    Fill the free space of the filesystem at mountpoint with zeroes, for filesystems that can't discard it
+    Writes a file of zeroes until the filesystem is full, then deletes it. Returns how many bytes it wrote
+    """
+    chunk = b'\0' * (chunksize if chunksize else checksum_chunksize)
+    path = os.path.join(mountpoint, '.raspseed-zero')
+    written = 0
+    try:
+        with open(path, 'wb') as f:
+            try:
+                while True:
+                    f.write(chunk)
+                    written += len(chunk)
+            except IOError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+    # Python 3 raises ENOSPC again when the file is closed, since closing flushes the buffer
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOSPC:
+            raise
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return written
+
+def punch_hole(fd, offset, length):
+    """Deallocate a range of a file, leaving a hole that reads as zeroes"""
+    func = getattr(libc(), 'fallocate64', None) or libc().fallocate
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if func(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "Punching a hole: {}".format(os.strerror(err)))
+
+def punch_zeroes(path, blocksize=64*1024):
+    """
+    Turn every block of a file that's all zeroes into a hole; returns how many bytes that freed
+    That includes filesystem metadata that has to stay zeroes, like inode tables, not just free space, so
+    anything that copies the file elsewhere has to write the holes it needs; see used_ranges()
+    """
+    before = allocated_size(path)
+    with io.open(path, 'r+b', buffering=0) as f:
+        for offset, length in list(iter_data_ranges(path)):
+            end = offset + length
+            # Only whole blocks can be punched
+            offset = (offset + blocksize - 1) // blocksize * blocksize
+            while offset + blocksize <= end:
+                f.seek(offset)
+                data = f.read(blocksize)
+                if len(data) == blocksize and is_zeroes(data):
+                    punch_hole(f.fileno(), offset, blocksize)
+                offset += blocksize
+    return before - allocated_size(path)
+
+@contextlib.contextmanager
+def frozen_filesystems(mountpoints):
+    """
+    Freeze the filesystems mounted at mountpoints for the duration of the with block, so that what's on disk
+    is consistent. Filesystems that can't be frozen (like vfat) are synced instead
+    """
+    fds = []
+    try:
+        for mp in mountpoints:
+            if not is_mounted(mp):
+                continue
+            fd = os.open(mp, os.O_RDONLY)
+            try:
+                fcntl.ioctl(fd, FIFREEZE, 0)
+                fds.append(fd)
+            except (IOError, OSError):
+                os.close(fd)
+                libc().sync()
+        yield
+    finally:
+        for fd in reversed(fds):
+            fcntl.ioctl(fd, FITHAW, 0)
+            os.close(fd)
+
+# Can't be a member property of RaspSeedImage because it's used in some global functions
+depsdir = os.getcwd()+'/dependencies'
+
+def evict_lru(directory, lastused, maxbytes, suffix='', keep=()):
+    """
+    Delete the least recently used files in directory until the ones left add up to no more than maxbytes
+    lastused maps file names to timestamps; files that aren't in it count as last used at their mtime
+    Only files whose names end in suffix are considered, and files named in keep are never deleted.
+    Returns the names of the deleted files
+    """
+    files = []
+    total = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.endswith(suffix) or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        files.append((lastused.get(name, st.st_mtime), name, st.st_size))
+        total += st.st_size
+    evicted = []
+    for used, name, size in sorted(files):
+        if total <= maxbytes:
+            break
+        if name in keep:
+            continue
+        os.remove(os.path.join(directory, name))
+        total -= size
+        evicted.append(name)
+    if evicted:
+        logging.info("Evicted {} least recently used files from '{}'".format(len(evicted), directory))
+    return evicted
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def inputs_hash(inputs):
+    """A hash of a JSON-able description of what went into something"""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def tree_hash(path):
+    """A hash of everything under path: names, modes, symlink targets, and file contents"""
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            full = os.path.join(dirpath, name)
+            st = os.lstat(full)
+            if stat.S_ISLNK(st.st_mode):
+                content = os.readlink(full)
+            elif stat.S_ISREG(st.st_mode):
+                content = checksum_file(full, ['sha256'])['sha256']
+            else:
+                content = ''
+            entry = '{}\0{:o}\0{}\n'.format(os.path.relpath(full, path), st.st_mode, content)
+            digest.update(entry.encode('utf-8'))
+    return digest.hexdigest()
+
+def write_json(data, path):
+    """Write JSON atomically, so a crash halfway through doesn't leave a corrupt file behind"""
+    with open(path+'.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(path+'.tmp', path)
+
+# Host-side apt cache shared by all image builds; see PackageCache
+package_cache_dir = depsdir+'/apt-cache'
+package_cache_maxsize = 4096 # MB
+
+def which(program):
+    """Return the full path to program if it's on $PATH, or None; Python 2 doesn't have shutil.which()"""
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(d, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+# Built kernels, shared by every image that uses the same source, config and toolchain; see KernelCache
+kernel_cache_dir = depsdir+'/kernel-cache'
+# ccache's own cache, used for kernel builds that miss the KernelCache
+ccache_dir = depsdir+'/ccache'
+
+class KernelCache(object):
+    """
+    Built kernels, stored under a hash of the kernel source archive, the defconfig, and the cross compiler
+    version. Each entry has the zImage, the device tree blob, and a tarball of the installed modules, which is
+    everything an image needs from a kernel build; installing one takes seconds instead of a full build.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path else kernel_cache_dir
+        self.statspath = self.path+'/stats.json'
+        self.hashespath = self.path+'/hashes.json'
+
+    def __str__(self):
+        return "KernelCache({})".format(self.path)
+
+    def file_hash(self, path):
+        """
+        The sha256 of a file, remembered by path, size and mtime so a big source archive is only read once
+        """
+        st = os.stat(path)
+        memokey = '{}:{}:{}'.format(os.path.abspath(path), st.st_size, st.st_mtime)
+        hashes = read_json(self.hashespath, {})
+        if memokey not in hashes:
+            hashes[memokey] = checksum_file(path, ['sha256'])['sha256']
+            makedirs(self.path, exist_ok=True)
+            write_json(hashes, self.hashespath)
+        return hashes[memokey]
+
+    def key(self, archive, config, toolchain):
+        keydata = json.dumps([self.file_hash(archive), self.file_hash(config), toolchain])
+        return hashlib.sha256(keydata.encode('utf-8')).hexdigest()
+
+    def entry(self, key):
+        return '{}/{}'.format(self.path, key)
+
+    def lookup(self, key, count=True):
+        """
+        Return the directory for key if the cache has a complete entry for it, or None
+        Counts hits and misses, unless count is False, for looking up again what a build already looked up
+        """
+        entry = self.entry(key)
+        hit = os.path.exists(entry+'/complete')
+        if not count:
+            return entry if hit else None
+        stats = read_json(self.statspath, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+        makedirs(self.path, exist_ok=True)
+        write_json(stats, self.statspath)
+        logging.info("Kernel cache {} for {}; {} hits, {} misses in total".format(
+            'hit' if hit else 'miss', key[:16], stats['hits'], stats['misses']))
+        return entry if hit else None
+
+    def store(self, key, zImage, dtb, kdir, makeenv):
+        """Copy a finished build into the cache, and return its directory"""
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        makedirs(entry+'/modules', exist_ok=True)
+        shutil.copyfile(zImage, entry+'/zImage')
+        shutil.copyfile(dtb, entry+'/'+os.path.basename(dtb))
+        sh('. /etc/profile; make modules_install INSTALL_MOD_PATH="{}"'.format(entry+'/modules'),
+           env=makeenv, cwd=kdir)
+        sh('tar --numeric-owner -cpf "{0}/modules.tar" -C "{0}/modules" .'.format(entry))
+        shutil.rmtree(entry+'/modules')
+        # Written last, so a build that dies halfway through storing doesn't leave an entry that looks usable
+        write_file(key, entry+'/complete', append=False)
+        return entry
+
+    def install(self, entry, mountpoint, dtbname):
+        shutil.copyfile(entry+'/zImage', mountpoint+'/boot/firmware/kernel7.img')
+        shutil.copyfile(entry+'/'+dtbname, mountpoint+'/boot/firmware/'+dtbname)
+        sh('tar --numeric-owner -xpf "{}/modules.tar" -C "{}"'.format(entry, mountpoint))
+
+def toolchain_version(cross_compile):
+    """The first line of the cross compiler's --version, which is part of what a built kernel depends on"""
+    try:
+        return sh('{}gcc --version'.format(cross_compile), printoutput=False).split('\n')[0]
+    except Exception:
+        return 'unknown'
+
+def run_parallel(tasks, jobs=4):
+    """Call each of a list of functions that take no arguments, jobs at a time, and return their results in order"""
+    if not tasks:
+        return []
+    pool = ThreadPool(min(jobs, len(tasks)))
+    try:
+        return pool.map(lambda task: task(), tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+# Downloaded dependencies, stored by their sha256 so builds in every working directory can share them
+store_dir = os.environ.get('RASPSEED_STORE', os.path.expanduser('~/.cache/raspseed/store'))
+store_maxsize = 8192 # MB
+
+class Fetcher(object):
+    """
+    Downloads files into a content-addressed store: each file is kept as objects/<sha256>, and an index
+    remembers which URL had which hash, so a URL is only downloaded once no matter how many working directories
+    ask for it. Downloads go to a .part file first and pick up where they left off if they were interrupted, as
+    long as the server can say the file hasn't changed since (If-Range), or the download has a pinned sha256.
+    A download is checked against its pinned sha256, if there is one, before it goes into the store. Once the
+    store is bigger than maxsize megabytes, the least recently used objects are evicted.
+    file:// URLs work too, which is handy for mirrors on local disk.
+    """
+
+    def __init__(self, path=None, maxsize=None, jobs=4):
+        self.path = path if path else store_dir
+        self.maxsize = maxsize if maxsize is not None else store_maxsize
+        self.jobs = jobs
+        self.objects = self.path+'/objects'
+        self.partial = self.path+'/partial'
+        self.indexpath = self.path+'/index.json'
+
+    def __str__(self):
+        return "Fetcher({}, max {}MB)".format(self.path, self.maxsize)
+
+    def _update_index(self, url=None, digest=None):
+        """Record that url has digest and that digest was just used, and evict old objects"""
+        with FileLock(self.path+'/.lock'):
+            index = read_json(self.indexpath, {'urls': {}, 'lastused': {}})
+            if url:
+                index['urls'][url] = digest
+            index['lastused'][digest] = time.time()
+            for evicted in evict_lru(self.objects, index['lastused'], self.maxsize*1024*1024, keep=[digest]):
+                index['lastused'].pop(evicted, None)
+            write_json(index, self.indexpath)
+
+    def lookup(self, url, sha256=None):
+        """Return the stored object for url if the store has it, or None"""
+        if not sha256:
+            sha256 = read_json(self.indexpath, {'urls': {}})['urls'].get(url)
+        if sha256 and os.path.exists('{}/{}'.format(self.objects, sha256)):
+            return '{}/{}'.format(self.objects, sha256)
+        return None
+
+    def fetch(self, url, sha256=None):
+        """
+        Return the path to the stored copy of url, downloading it first if necessary
+        If sha256 is given, the download must match it
+        """
+        stored = self.lookup(url, sha256)
+        if stored:
+            logging.info("Already have '{}' at '{}'".format(url, stored))
+            self._update_index(digest=os.path.basename(stored))
+            return stored
+
+        makedirs(self.objects, exist_ok=True)
+        makedirs(self.partial, exist_ok=True)
+        part = '{}/{}.part'.format(self.partial, hashlib.sha256(url.encode('utf-8')).hexdigest())
+        # Another process could be downloading the same URL right now
+        with FileLock(part+'.lock'):
+            stored = self.lookup(url, sha256)
+            if stored:
+                return stored
+            self.download(url, part, pinned=bool(sha256))
+            digest = checksum_file(part, ['sha256'])['sha256']
+            if sha256 and digest != sha256:
+                os.remove(part)
+                if os.path.exists(part+'.validator'):
+                    os.remove(part+'.validator')
+                raise Exception("Download of '{}' has sha256 {}, but it should be {}".format(url, digest, sha256))
+            if not sha256:
+                logging.warning("No pinned hash for '{}'; it downloaded with sha256 {}".format(url, digest))
+            stored = '{}/{}'.format(self.objects, digest)
+            os.rename(part, stored)
+            if os.path.exists(part+'.validator'):
+                os.remove(part+'.validator')
+        self._update_index(url, digest)
+        return stored
+
+    def download(self, url, part, pinned=False, chunksize=1024*1024):
+        """
+        Download url to part, resuming from however much of it is already there
+        Most URLs follow a branch, so the rest of the file could be from a newer version than the start. The
+        server's ETag or Last-Modified is kept next to part, and sent as If-Range, which makes the server send
+        the whole file again if it changed. Without one, part is only resumed if pinned, i.e. the download is
+        going to be checked against a sha256 anyway
+        """
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        validator = read_json(part+'.validator', {}).get('validator')
+        if offset and not validator and not pinned:
+            logging.info("Can't tell if '{}' changed since it was partly downloaded; starting over".format(url))
+            offset = 0
+        request = Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+            if validator:
+                request.add_header('If-Range', validator)
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            # 416 means there's nothing past offset, i.e. the last download actually finished
+            if e.code == 416:
+                return
+            raise
+        # Servers (and file:// URLs) that ignore Range send the whole file again
+        if offset and response.getcode() != 206:
+            offset = 0
+        if not offset:
+            # Weak ETags can't be used with If-Range
+            etag = response.info().get('ETag')
+            validator = etag if etag and not etag.startswith('W/') else response.info().get('Last-Modified')
+            write_json({'validator': validator}, part+'.validator')
+        logging.info("Downloading '{}'{}".format(url, " from byte {}".format(offset) if offset else ''))
+        with open(part, 'ab' if offset else 'wb') as f:
+            while True:
+                data = response.read(chunksize)
+                if not data:
+                    break
+                f.write(data)
+        response.close()
+
+    def place(self, stored, dest):
+        """Put a stored object at dest, as a hardlink if possible"""
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(stored, dest)
+        except OSError:
+            shutil.copyfile(stored, dest)
+        return dest
+
+def git_clone(url, dest):
+    """Shallow-clone url to dest, unless it's already there; a clone that gets interrupted doesn't count"""
+    if os.path.exists(dest):
+        return dest
+    if os.path.exists(dest+'.tmp'):
+        shutil.rmtree(dest+'.tmp')
+    sh('git clone --depth 1 "{}" "{}"'.format(url, dest+'.tmp'))
+    os.rename(dest+'.tmp', dest)
+    return dest
+
+# Tarballs of freshly debootstrapped root filesystems; see RootfsCache
+rootfs_cache_dir = depsdir+'/rootfs-cache'
+rootfs_cache_maxage = 7 # days
+
+class RootfsCache(object):
+    """
+    Tarballs of freshly debootstrapped root filesystems, so debootstrap only has to run once per combination of
+    architecture, suite, mirror and extra packages. Changing any of those changes the key, so a new tarball gets
+    built; tarballs older than maxage days are thrown away so the base system doesn't get too stale.
+    """
+
+    def __init__(self, path=None, maxage=None):
+        self.path = path if path else rootfs_cache_dir
+        self.maxage = maxage if maxage is not None else rootfs_cache_maxage
+
+    def __str__(self):
+        return "RootfsCache({}, max age {} days)".format(self.path, self.maxage)
+
+    def key(self, arch, suite, mirror, include=None):
+        keydata = json.dumps([arch, suite, mirror, sorted(include if include else [])])
+        return '{}-{}-{}'.format(suite, arch, hashlib.sha256(keydata.encode('utf-8')).hexdigest()[:16])
+
+    def tarball(self, key):
+        return '{}/{}.tar'.format(self.path, key)
+
+    def metapath(self, key):
+        return '{}/{}.json'.format(self.path, key)
+
+    def lock(self, key):
+        return FileLock('{}/{}.lock'.format(self.path, key))
 
-def enable_chroot_daemons(chroot):
+    def prune(self):
+        """Delete tarballs that are older than maxage"""
+        if not os.path.isdir(self.path):
+            return
+        cutoff = time.time() - self.maxage * 24 * 60 * 60
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith('.tar') and os.path.getmtime(path) < cutoff:
+                logging.info("Removing expired base rootfs tarball '{}'".format(path))
+                os.remove(path)
+                if os.path.exists(path[:-len('.tar')]+'.json'):
+                    os.remove(path[:-len('.tar')]+'.json')
+
+    def lookup(self, key):
+        """Return the tarball for key if there's a fresh one, or None"""
+        self.prune()
+        tarball = self.tarball(key)
+        return tarball if os.path.exists(tarball) else None
+
+    def extract(self, key, dest):
+        """Unpack the tarball for key into dest, and log how much time that saved over running debootstrap"""
+        start = time.time()
+        sh('tar --numeric-owner -xpf "{}" -C "{}"'.format(self.tarball(key), dest))
+        elapsed = time.time() - start
+        meta = read_json(self.metapath(key), {'buildtime': 0, 'hits': 0, 'saved': 0})
+        saved = max(meta['buildtime'] - elapsed, 0)
+        meta['hits'] += 1
+        meta['saved'] += saved
+        write_json(meta, self.metapath(key))
+        logging.info(
+            "Unpacked cached base rootfs '{}' in {:.1f}s instead of debootstrapping it in {:.1f}s: saved {:.1f}s "
+            "this time, {:.1f}s over {} builds".format(
+                key, elapsed, meta['buildtime'], saved, meta['saved'], meta['hits']))
+
+    def store(self, key, src, buildtime):
+        """Pack the root filesystem at src into the cache, recording how long it took to build"""
+        makedirs(self.path, exist_ok=True)
+        tarball = self.tarball(key)
+        # --one-file-system keeps /boot/firmware, /proc and /dev mounts out of it
+        sh('tar --numeric-owner --one-file-system -cpf "{}.tmp" -C "{}" .'.format(tarball, src))
+        os.rename(tarball+'.tmp', tarball)
+        write_json({'buildtime': buildtime, 'hits': 0, 'saved': 0, 'created': time.time()}, self.metapath(key))
+        logging.info("Stored base rootfs '{}' in '{}'".format(key, tarball))
+
+# Functions that add what a sprout needs installed to a PackagePlan, called like hook(image, plan); sprouts
+# append theirs before building, so their packages go in with everything else
+package_hooks = []
+# apt can't use https sources until these are installed, so they can't go in the same transaction
+https_packages = ['apt-transport-https', 'ca-certificates']
+
+class PackagePlan(object):
     """
-    Re-enable daemons to start in the chroot
-    Run this before finishing an image
+    Everything that gets installed into an image with apt, collected from everything that wants something, so
+    it can all be done with one apt-get update and one apt-get install instead of a few of each for everyone
+
+    Each apt-get run has a fixed cost of reading the package lists and dpkg's status, which under qemu is a lot.
+    add() takes how many updates and installs each requester would have needed on its own, and run() estimates
+    the time saved from that: each update it didn't do would have taken as long as the one it did, and each
+    install would have cost at least as much as resolving the merged transaction does (run() does that with
+    apt-get -s first, which also fails early if the packages from everyone can't all be installed together)
+
+    Packages that apt needs before it can even update from the plan's sources, like the https transport,
+    are collected in prerequisites; they have to be installed beforehand, e.g. by debootstrap
     """
-    # In a pristine system, policy-rc.d doesn't exist; if it doesn't now, then daemons are already enabled
-    if not os.path.exists(chroot+'/usr/sbin/policy-rc.d'):
-        logging.debug("Daemons already enabled in chroot {}".format(chroot))
-        return
-    logging.debug("Enabling daemons in chroot {}".format(chroot))
-    os.remove(chroot+'/usr/sbin/policy-rc.d')
-    os.remove(chroot+'/usr/sbin/invoke-rc.d')
-    sh(
-        'dpkg-divert --remove --rename /usr/sbin/invoke-rc.d',
-        env={ 'LANG':'C' }, chroot=chroot)
+    env = {'LANG': 'C', 'DEBIAN_FRONTEND': 'noninteractive'}
 
-def makedirs(path, mode=0o755, exist_ok=False):
-    """Replacement for os.makedirs() w/ the Py3 feature of exists_ok"""
-    if os.path.exists(path) and exist_ok:
-        return
-    os.makedirs(path, mode)
+    def __init__(self):
+        # name -> sources.list lines, written to /etc/apt/sources.list.d/NAME.list
+        self.sources = collections.OrderedDict()
+        # Commands to run before updating, like importing a repository's key
+        self.keys = []
+        self.packages = []
+        # Packages that have to be installed before run(); see https_packages
+        self.prerequisites = []
+        self.requesters = []
+        self.updates = 0
+        self.installs = 0
 
-def mount(device, mountpoint, fstype=None, fsoptions=None):
+    def add(self, requester, packages=(), sources=None, keys=(), release=None, trusted=False, updates=1, installs=1):
+        """
+        Add packages, and the sources.list lines and key commands they need. release installs the packages
+        from that release, like apt-get -t does. trusted marks just these sources as trusted without being
+        authenticated, for repositories whose packages can't be, so nothing else in the transaction has to be forced
+        """
+        if sources and trusted:
+            sources = [re.sub('^(deb(-src)?) ', '\\1 [trusted=yes] ', line) for line in sources]
+        if sources and any(' https://' in line for line in sources):
+            self.prerequisites += [p for p in https_packages if p not in self.prerequisites]
+        if sources:
+            self.sources.setdefault(requester, [])
+            self.sources[requester] += [line for line in sources if line not in self.sources[requester]]
+        self.keys += [cmd for cmd in keys if cmd not in self.keys]
+        for package in packages:
+            package = '{}/{}'.format(package, release) if release else package
+            if package not in self.packages:
+                self.packages.append(package)
+        if requester not in self.requesters:
+            self.requesters.append(requester)
+        self.updates += updates
+        self.installs += installs
+
+    def describe(self):
+        """Everything the plan does, as something JSON-able"""
+        return {'sources': self.sources, 'keys': self.keys, 'packages': self.packages}
+
+    def run(self, chroot):
+        """Do the whole plan in chroot, and return the estimated seconds saved"""
+        for name, lines in self.sources.items():
+            write_file(lines, '{}/etc/apt/sources.list.d/{}.list'.format(chroot, name), append=False, mode=0o644)
+        if self.keys:
+            sh(self.keys, env=self.env, chroot=chroot, chroot_disable_daemons=True)
+        update = sh('apt-get update', env=self.env, chroot=chroot, chroot_disable_daemons=True)
+        if not self.packages:
+            return 0
+        packages = ' '.join(self.packages)
+        resolve = sh('apt-get -s -y install {}'.format(packages), env=self.env, chroot=chroot, printoutput=False)
+        install = sh('apt-get -y install {}'.format(packages), env=self.env, chroot=chroot, chroot_disable_daemons=True)
+        saved = (self.updates - 1) * update.wall + (self.installs - 1) * resolve.wall
+        logging.info(' '.join([
+            "Installed {} packages for {} with 1 apt-get update ({:.1f}s) instead of {},".format(
+                len(self.packages), ', '.join(self.requesters), update.wall, self.updates),
+            "and 1 apt-get install ({:.1f}s) instead of {}, saving about {:.0f}s".format(
+                install.wall, self.installs, saved)]))
+        return saved
+
+class PackageCache(object):
     """
-    Use /bin/mount to mount a device on a mountpoint
-    Create the mountpoint if necessary
-    If the device is already mounted there, do nothing
-    If something else is already mounted there, raise an exception
+    A directory on the host that gets bind-mounted over /var/cache/apt/archives and /var/lib/apt/lists in image
+    chroots, so the .debs and package lists downloaded by one build are already there for the next
+
+    The lists are shared by builds with different suites and sources, so while the cache is attached, apt in the
+    chroot is configured not to delete the list files that its own sources don't use
+
+    The manifest records when each .deb was last installed, so the least recently used ones can be evicted once
+    the cache is bigger than maxsize megabytes. Hits and misses are counted from dpkg's log in the chroot:
+    a package whose .deb was already cached when the chroot was attached is a hit; anything else is a miss.
     """
-    mountpoint = os.path.abspath(mountpoint)
-    makedirs(mountpoint, mode=0o755, exist_ok=True)
 
-    fs_type = "-t {}".format(fstype) if fstype else ""
-    fs_options = "-o {}".format(fsoptions) if fsoptions else ""
-
-    ismounted = False
-    for mount in sh('mount', printoutput=False).split('\n'):
-        exdevice, exmountpoint = re.search('(.+) on (.+) type ', mount).group(1, 2)
-        if exmountpoint == mountpoint:
-            logging.info("Attempted to mount '{}' on '{}' but it is already mounted there".format(
-                device, mountpoint))
-            ismounted = True
-    if not ismounted:
-        sh('mount {} {} "{}" "{}"'.format(fs_type, fs_options, device, mountpoint))
-
-# TODO: can't handle options or mountpoints with spaces! 
-#       python's built-in 'shlex' module may be of use here?
-def parse_mtab():
-    mtab = []
-    with open('/etc/mtab') as f:
-        for line in f.readlines():
-            fields = line.split(' ')
-            mtab.append({
-                    'fs_spec':    fields[0],
-                    'fs_file':    fields[1],
-                    'fs_vfstype': fields[2],
-                    'fs_mntops':  fields[3],
-                    'fs_freq':    fields[4],
-                    'fs_passno':  fields[5]})
-    return mtab
+    def __init__(self, path=None, maxsize=None):
+        self.path = path if path else package_cache_dir
+        self.maxsize = maxsize if maxsize is not None else package_cache_maxsize
+        self.archives = self.path+'/archives'
+        self.lists = self.path+'/lists'
+        self.manifestpath = self.path+'/manifest.json'
+        # chroot -> (.debs cached when attached, size of the chroot's dpkg.log when attached, shared lock)
+        self.attached = {}
 
-def is_mounted(mountpoint):
-    for fs in parse_mtab():
-        if fs['fs_file'] == mountpoint:
-            return True
-    else:
-        return False
+    def __str__(self):
+        return "PackageCache({}, max {}MB)".format(self.path, self.maxsize)
 
-# TODO: if lsof is available, show all processes using the mountpoint
-def umount(mountpoint, lsof_on_failure=True):
-    """Use /bin/umount to unmount a device"""
-    if is_mounted(mountpoint):
-        try:
-            sh('umount "{}"'.format(mountpoint))
-        except:
-            print('The following process are still using your mountpoint:')
-            print(sh('lsof | grep {}'.format(mountpoint)))
-            raise
+    def mounts(self, chroot):
+        return [
+            { 'device': self.archives, 'mountpoint': chroot+'/var/cache/apt/archives', 'fstype': None, 'fsoptions': 'bind' },
+            { 'device': self.lists,    'mountpoint': chroot+'/var/lib/apt/lists',      'fstype': None, 'fsoptions': 'bind' }]
+
+    def debs(self):
+        return set(n for n in os.listdir(self.archives) if n.endswith('.deb'))
+
+    def aptconf(self, chroot):
+        return chroot+'/etc/apt/apt.conf.d/99raspseed-package-cache'
 
-def check_loopdev(image):
-    """Use /sbin/losetup to check if an image has been attached as a loopback device"""
-    retval = []
-    if os.path.exists(image):
-        pristine_output = sh('losetup --associated "{}"'.format(image))
-        if pristine_output:
-            for line in pristine_output.split('\n'):
-                loopdev = re.search('(.+?):.*', line).group(1)
-                retval += [loopdev]
-                logging.info("Found existing loopback device for image '{}' at '{}'".format(image, loopdev))
+    def attach(self, chroot):
+        """Bind-mount the cache into a chroot; does nothing if it's already there"""
+        makedirs(self.archives+'/partial', exist_ok=True)
+        makedirs(self.lists+'/partial', exist_ok=True)
+        if chroot not in self.attached:
+            # Other builds can use the cache at the same time, but eviction has to wait until nobody is
+            lock = FileLock(self.path+'/.lock', shared=True)
+            lock.acquire()
+            dpkglog = chroot+'/var/log/dpkg.log'
+            logsize = os.path.getsize(dpkglog) if os.path.exists(dpkglog) else 0
+            self.attached[chroot] = (self.debs(), logsize, lock)
+        for m in self.mounts(chroot):
+            mount(device=m['device'], mountpoint=m['mountpoint'], fstype=m['fstype'], fsoptions=m['fsoptions'])
+        # Otherwise apt-get update deletes the lists of every other suite and source, maybe between another
+        # build's update and its install
+        makedirs(os.path.dirname(self.aptconf(chroot)), exist_ok=True)
+        write_file('APT::Get::List-Cleanup "false";', self.aptconf(chroot), append=False, mode=0o644)
+
+    def detach(self, chroot):
+        """Unmount the cache from a chroot, then update the statistics and evict old packages"""
+        if os.path.exists(self.aptconf(chroot)):
+            os.remove(self.aptconf(chroot))
+        umount_all([m['mountpoint'] for m in self.mounts(chroot)])
+        if chroot not in self.attached:
+            return
+        cached, logsize, lock = self.attached.pop(chroot)
+        lock.release()
+        with FileLock(self.path+'/manifest.lock'):
+            self._account(chroot, cached, logsize)
+
+    def _account(self, chroot, cached, logsize):
+        manifest = read_json(self.manifestpath, {'lastused': {}, 'hits': 0, 'misses': 0})
+        hits, misses = 0, 0
+        now = time.time()
+        available = self.debs()
+        for deb in self.installed_debs(chroot, logsize):
+            if deb not in available:
+                continue
+            if deb in cached:
+                hits += 1
+            else:
+                misses += 1
+            manifest['lastused'][deb] = now
+        manifest['hits'] += hits
+        manifest['misses'] += misses
+        # Packages can't be evicted out from under another build that has the cache mounted
+        evictlock = FileLock(self.path+'/.lock')
+        if evictlock.acquire(blocking=False):
+            try:
+                evicted = evict_lru(self.archives, manifest['lastused'], self.maxsize*1024*1024, suffix='.deb')
+            finally:
+                evictlock.release()
+            for deb in evicted:
+                manifest['lastused'].pop(deb, None)
         else:
-            logging.info("No existing loopback device found for image '{}'".format(image))
-    else:
-        logging.info("No image at path '{}'".format(image))
-    return retval    
+            logging.info("Package cache '{}' is in use by another build; not evicting anything".format(self.path))
+        write_json(manifest, self.manifestpath)
+        logging.info("Package cache '{}': {} hits, {} misses this build; {} hits, {} misses in total".format(
+            self.path, hits, misses, manifest['hits'], manifest['misses']))
 
-# Can't be a member property of RaspSeedImage because it's used in some global functions
-depsdir = os.getcwd()+'/dependencies'
+    def installed_debs(self, chroot, offset=0):
+        """
+        The .deb file names for packages that dpkg installed or upgraded in a chroot, according to its log
+        Only log lines after offset bytes are read
+        """
+        dpkglog = chroot+'/var/log/dpkg.log'
+        if not os.path.exists(dpkglog):
+            return []
+        debs = []
+        with open(dpkglog) as f:
+            f.seek(offset)
+            for line in f:
+                # Looks like:
+                # 2015-03-01 12:00:00 install tor:armhf <none> 0.2.5.10-1
+                # 2015-03-01 12:00:00 upgrade tor:armhf 0.2.5.9-1 0.2.5.10-1
+                fields = line.split()
+                if len(fields) != 6 or fields[2] not in ('install', 'upgrade'):
+                    continue
+                name, _, arch = fields[3].partition(':')
+                # apt escapes the epoch separator in .deb names
+                version = fields[5].replace(':', '%3a')
+                debs.append('{}_{}_{}.deb'.format(name, version, arch))
+        return debs
 
 # This isn't ideal. You'd like to store the finalstatus as part of the RaspSeedImage instance itself, but I can't figure out how to do that, because I need to reference it from within the statusmethod decorator
 '''When an RaspSeedImage reachest this status, it is finished'''
 finalstatus = 0
 statusmethods = []
-def statusmethod(func):
+
+# How much free space, in MB, shrink_image() leaves in the root filesystem, for the first boot to use before
+# it grows the filesystem to fill the SD card
+shrink_headroom = 256
+
+# Run once, at the first boot of a shrunk image, to grow the root partition and filesystem to fill the SD card
+growroot_script = """#!/bin/sh
+set -e
+rootpart=$(findmnt -n -o SOURCE /)
+partname=$(basename "$rootpart")
+disk=/dev/$(lsblk -n -o PKNAME "$rootpart")
+partnum=$(cat /sys/class/block/$partname/partition)
+start=$(cat /sys/class/block/$partname/start)
+# Keep the start where it is and let the partition run to the end of the card
+echo "$start,,83" | sfdisk --no-reread --force -N "$partnum" "$disk"
+partx -u "$disk" || partprobe "$disk" || true
+resize2fs "$rootpart"
+systemctl disable raspseed-growroot.service
+rm -f /usr/local/sbin/raspseed-growroot
+"""
+# It runs before local-fs.target, which the default dependencies would order it after, so it has none
+growroot_unit = """[Unit]
+Description=Grow the root filesystem to fill the SD card
+DefaultDependencies=no
+After=systemd-remount-fs.service
+Before=local-fs.target shutdown.target
+Conflicts=shutdown.target
+
+[Service]
+Type=oneshot
+ExecStart=/usr/local/sbin/raspseed-growroot
+RemainAfterExit=yes
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+# How RaspSeedImage builds the root filesystem: 'loop' works on the image itself, through loop devices, and
+# 'directory' builds a plain directory tree and only makes the image from it at the end; see pack_image()
+build_modes = ['loop', 'directory']
+
+# How RaspSeedImage.checkpoint() snapshots the image after each stage; see there
+checkpoint_modes = ['auto', 'always', 'never']
+# How many checkpoints to keep for each image, besides the ones from right before stages that record inputs,
+# which are kept so that a stage whose inputs change can be redone without starting over
+checkpoint_keep = 3
+# Stages that only read the finished image, or do something to it that's fine to do again, so that when their
+# inputs change they can just run again on the image as it is
+refinish_stages = ['trim_image', 'generate_checksum']
+
+def statusmethod(func=None, inputs=None, outputs=(), resources=('image',)):
     '''
     Decorator for RaspSeedImage methods that set the image's status.
     Methods must be defined *in status order*, because the first function 
     decorated with @statusmethod will be assigned the property '.status = 1'
     and the second will be assigned '.status = 2' etc. 
+    Stages can also say which named things they need (inputs) and make
+    (outputs), and which resources they need to themselves while they run.
+    The stages form a graph from that, and run_stages() runs stages that
+    don't depend on each other at the same time. Stages that attach or mount
+    the image need the 'image' resource, which is the default.
+    A stage that doesn't list its inputs depends on the stage before it.
+    When a stage finishes, a hash of what went into it is recorded (see
+    RaspSeedImage.stage_inputs()), so that later builds can tell if it has
+    to run again.
     '''
+    if func is None:
+        return lambda f: statusmethod(f, inputs=inputs, outputs=outputs, resources=resources)
     global finalstatus, statusmethods
     func.status = finalstatus
     def wrapper(class_instance, *args, **kwargs):
         logging.info("Running status function #{}: {}".format(
                 func.status, func.__name__))
-        func(class_instance, *args, **kwargs)
-        class_instance.status = func.status
+        with trace_span(func.__name__, 'stage', status=func.status):
+            func(class_instance, *args, **kwargs)
+        class_instance.record_inputs(wrapper)
     wrapper.wrapped = func
+    wrapper.status = func.status
+    wrapper.resources = set(resources)
+    wrapper.outputs = set(outputs) | set([func.__name__])
+    wrapper.deps = set()
+    if inputs is None:
+        inputs = [statusmethods[-1].wrapped.__name__] if statusmethods else []
+    for name in inputs:
+        # Stages have to come after what they need, so that status N still means stages 0..N-1 are done
+        producers = [s for s in statusmethods if name in s.outputs]
+        if not producers:
+            raise Exception("Stage '{}' needs '{}', but no earlier stage makes it".format(func.__name__, name))
+        wrapper.deps.add(producers[-1].status)
     statusmethods += [wrapper]
     finalstatus += 1
     return wrapper
 
+def run_stages(image, stages, whatif=False, start=None):
+    """
+    Run stages (statusmethods, in status order) on image, each one as soon as the stages it needs are done
+    and its resources are free, so stages that don't depend on each other run at the same time in threads.
+    The image's status only moves past a stage once every stage before it is done too, and the image is
+    checkpointed then, while no stage is using it. If a stage fails, no more are started, the ones that are
+    running get to finish, and the first failure is raised again.
+    With whatif, just log which stages would run, in batches that could run together; start is the status
+    the build would really start from, if that's not the image's status.
+    """
+    done = set(range(image.status if start is None else start))
+    pending = list(stages)
+
+    if whatif:
+        batch = 0
+        while pending:
+            ready = [s for s in pending if s.deps <= done]
+            for s in ready:
+                logging.info("Running function #{} - '{}' - {} (batch {}, resources: {})".format(
+                        s.status, s.wrapped.__name__, s.wrapped.__doc__, batch,
+                        ', '.join(sorted(s.resources)) or 'none'))
+                pending.remove(s)
+            done.update(s.status for s in ready)
+            batch += 1
+        return
+
+    running = {}
+    busy = set()
+    errors = []
+    failed = []
+    cond = threading.Condition()
+
+    def run(stage):
+        error = None
+        try:
+            stage(image)
+        except Exception as e:
+            logging.exception("Stage '{}' failed".format(stage.wrapped.__name__))
+            error = e
+        with cond:
+            del running[threading.current_thread()]
+            busy.difference_update(stage.resources)
+            if error:
+                errors.append(error)
+                failed.append(stage.wrapped.__name__)
+            else:
+                done.add(stage.status)
+            cond.notify()
+
+    def advance():
+        # Move the status past every stage that's done, and checkpoint, as long as nothing is using the image
+        if 'image' in busy:
+            return
+        status = image.status
+        while status in done and status < finalstatus:
+            status += 1
+        if status != image.status:
+            image.status = status
+            with trace_span('checkpoint at status {}'.format(status), 'checkpoint'):
+                image.checkpoint(status, statusmethods[status-1].wrapped.__name__)
+
+    with cond:
+        while True:
+            advance()
+            if not errors:
+                for stage in list(pending):
+                    if stage.deps <= done and not (stage.resources & busy):
+                        pending.remove(stage)
+                        busy.update(stage.resources)
+                        thread = threading.Thread(target=run, args=(stage,), name=stage.wrapped.__name__)
+                        thread.daemon = True
+                        running[thread] = stage
+                        thread.start()
+            if running:
+                write_file(sorted(s.wrapped.__name__ for s in running.values()), image.inprogressfile, append=False)
+            elif failed:
+                # Left behind so the next build knows to roll back; see RaspSeedImage._buildup()
+                write_file(failed, image.inprogressfile, append=False)
+            elif os.path.exists(image.inprogressfile):
+                os.remove(image.inprogressfile)
+            if not running:
+                break
+            # A timeout, so that ^C still gets through on Python 2
+            cond.wait(1)
+    if errors:
+        raise errors[0]
+    if pending:
+        raise Exception("Stages {} could not run; what they need was not built".format(
+            ', '.join(s.wrapped.__name__ for s in pending)))
+
 class RaspSeedImage(object):
 
     # Kali uses 3000MB. My initial experiment, a minimal debootstrap w/ sjoerd's
@@ -258,19 +2549,33 @@ class RaspSeedImage(object):
         'rpi': {
             'url': 'https://github.com/raspberrypi/linux/archive/rpi-3.18.y.zip',
             'foldername': 'linux-rpi-3.18.y',
-            'extractcmd': 'unzip'},
+            'extractcmd': 'unzip',
+            # A branch archive, so it changes and can't be pinned
+            'sha256': None},
         #'mainline40': {
         'mainline': {
             'url': 'https://www.kernel.org/pub/linux/kernel/v4.x/linux-4.0.tar.xz',
             'foldername': 'linux-4.0',
-            'extractcmd': 'tar xf'}
+            'extractcmd': 'tar xf',
+            # A release, which never changes
+            'sha256': '0f2f7d44979bc8f71c4fc5d3308c03499c26a824dd311fdf6eef4dee0d7d5991'}
         }
 
+    # Downloads are checked against these hashes when they aren't None
+    # The config and dts come from the rpi-3.18.y branch, which moves, so they can't be pinned
     kernel_config_url = 'https://raw.githubusercontent.com/raspberrypi/linux/rpi-3.18.y/arch/arm/configs/bcm2709_defconfig'
+    kernel_config_sha256 = None
+    kernel_dts_url = 'https://raw.githubusercontent.com/raspberrypi/linux/rpi-3.18.y/arch/arm/boot/dts/bcm2709-rpi-2-b.dts'
+    kernel_dts_sha256 = None
+    firmware_git_url = 'https://github.com/raspberrypi/firmware.git'
 
     def __init__(self, imagepath=os.getcwd()+default_imagename,
                  imagesize=None, debianversion="sid",
-                 kernel="sjoerd", overlaydir=None):
+                 kernel="sjoerd", overlaydir=None, allocation='sparse',
+                 devicetimeout=None, packagecache=None, rootfscache=None,
+                 checkpoints='auto', kernelcache=None, buildmode='loop', rootfsdir=None,
+                 eraseblock=None, shrink=True, headroom=None, exportformat=None, exportlevel=None,
+                 fsprofile=None):
         '''
         __init__() should *not* make any modifications to actual files on disk! We rely on this in various places, so if it changes, stuff might break and **data could be deleted**.
         '''
@@ -279,7 +2584,14 @@ class RaspSeedImage(object):
         self.imagedir, self.imagename = re.search('(.*)\/(.*)$', imagepath).group(1, 2)
 
         self.statfile   = self.imagepath+'.status.txt'
-        self.mountpoint = self.imagepath+'.mnt'
+        self.inprogressfile = self.imagepath+'.inprogress'
+        self.inputsfile = self.imagepath+'.inputs.json'
+        # Stages running at the same time record their inputs at the same time
+        self.inputs_lock = threading.Lock()
+        self.build_mode = buildmode
+        # In directory mode the tree is built here, which can be on a tmpfs, instead of in the mounted image
+        self.rootfsdir  = rootfsdir if rootfsdir else self.imagepath+'.rootfs'
+        self.mountpoint = self.rootfsdir if buildmode == 'directory' else self.imagepath+'.mnt'
         self.debianvers = debianversion
         self.hostname   = RaspSeedImage.default_hostname
         self.arch       = RaspSeedImage.default_arch
@@ -288,13 +2600,36 @@ class RaspSeedImage(object):
         self.rootdev    = None 
         self.bootdev    = None
         self.overlaydir = overlaydir
+        self.allocation = allocation
+        # One of export_formats to compress the finished image with, or None; see generate_checksum()
+        self.export_format = exportformat
+        self.export_level = exportlevel
+        # Whether to shrink the finished image, leaving headroom MB free; see shrink_image()
+        self.shrink = shrink
+        self.headroom = headroom if headroom is not None else shrink_headroom
+        # Partitions are aligned to this many bytes; see partition_layout()
+        self.erase_block = eraseblock if eraseblock else erase_block_size
+        # One of filesystem_profiles; see mkfs_options()
+        self.fs_profile = fsprofile if fsprofile else filesystem_profile
+        self.device_timeout = devicetimeout if devicetimeout is not None else device_timeout
+        # A PackageCache to share downloaded packages with other builds, or None
+        self.package_cache = packagecache
+        # A RootfsCache to reuse debootstrapped base systems from, or None
+        self.rootfs_cache = rootfscache
+        # A KernelCache for compiled kernels, or None
+        self.kernel_cache = kernelcache
+        # One of checkpoint_modes; see checkpoint()
+        self.checkpoint_mode = checkpoints
+        # Extra packages for debootstrap to install into the base system
+        self.debootstrap_include = []
 
         if os.path.isfile(self.imagepath):
-            self.imagesize = os.stat(self.imagepath).st_size / 1024 / 1024
+            self.imagesize = os.stat(self.imagepath).st_size // 1024 // 1024
         else:
             self.imagesize = imagesize if imagesize else RaspSeedImage.min_size
         logging.info("Using a size of {}MB".format(self.imagesize))
-        if self.imagesize < RaspSeedImage.min_size:
+        # Finished images have been shrunk, so only new ones have to be big enough to build in
+        if self.imagesize < RaspSeedImage.min_size and not os.path.isfile(self.imagepath):
             raise Exception("imagesize {}MB smaller than minimum size of {}MB".format(self.imagesize, RaspSeedImage.min_size))
 
         logging.info(self)
@@ -302,9 +2637,11 @@ class RaspSeedImage(object):
     @property
     def mounts(self):
         # NOTE: These are mounted in order, then unmounted in reverse order. 
-        return [
-            { 'device': self.rootdev, 'mountpoint': self.mountpoint,                  'fstype': None,   'fsoptions': None },
-            { 'device': self.bootdev, 'mountpoint': self.mountpoint+"/boot/firmware", 'fstype': None,   'fsoptions': None },
+        # In directory mode there are no filesystems to mount, just what the chroot needs
+        filesystems = [] if self.build_mode == 'directory' else [
+            { 'device': self.rootdev, 'mountpoint': self.mountpoint,                  'fstype': 'ext4', 'fsoptions': None },
+            { 'device': self.bootdev, 'mountpoint': self.mountpoint+"/boot/firmware", 'fstype': 'vfat', 'fsoptions': None }]
+        return filesystems + [
             { 'device': 'proc',       'mountpoint': self.mountpoint+'/proc',          'fstype': 'proc', 'fsoptions': None },
             { 'device': '/dev/',      'mountpoint': self.mountpoint+'/dev',           'fstype': None,   'fsoptions': 'bind' },
             { 'device': '/dev/pts',   'mountpoint': self.mountpoint+'/dev/pts',       'fstype': None,   'fsoptions': 'bind' }]
@@ -312,7 +2649,10 @@ class RaspSeedImage(object):
     @property
     def status(self):
         """The current status of the image, as read from the status file"""
-        if not os.path.exists(self.imagepath):
+        if not os.path.exists(self.imagepath) and not (
+                self.build_mode == 'directory' and os.path.isdir(self.rootfsdir)):
+            return 0
+        if not os.path.exists(self.statfile):
             return 0
         with open(self.statfile) as f:
             line1 = f.readline()
@@ -337,114 +2677,170 @@ class RaspSeedImage(object):
             "  debian mirror: "+self.debmirr +")"])
         return selfstring
 
-    def check_partitions(self):
-        dump = sh('sfdisk -d {}'.format(self.imagepath)).split('\n')
-        # Check that the first partition is type FAT32 and second is type Linux
-        p1good = False
-        p2good = False
-        for line in dump:
-            if re.match('^{}1.*Id= c$'.format(imagepath), line):
-                p1good = True
-            if re.match('^{}2.*Id=83$'.format(imagepath), line):
-                p2good = True
-        return p1good and p2good
+    def check_partitions(self, path=None):
+        """
+        Check that the image has a FAT partition of the type the filesystem profile makes and then a Linux one,
+        both aligned to the erase block size, and that they fit in the image. Logs what's wrong, if anything, and
+        returns True or False
+        """
+        path = path if path else self.imagepath
+        try:
+            partitions = read_partition_table(path)
+        except Exception as e:
+            logging.error(str(e))
+            return False
+        problems = []
+        expected = [boot_partition_type(self.fs_profile), mbr_types['linux']]
+        if [p['type'] for p in partitions] != expected:
+            problems.append("expected partitions of types {}, found {}".format(
+                [hex(t) for t in expected], [hex(p['type']) for p in partitions]))
+        for i, p in enumerate(partitions):
+            if p['start'] % self.erase_block:
+                problems.append("partition {} at byte {} is not aligned to {} bytes".format(i+1, p['start'], self.erase_block))
+            if p['start'] + p['size'] > os.path.getsize(path):
+                problems.append("partition {} runs past the end of the image".format(i+1))
+        for problem in problems:
+            logging.error("Bad partition table in '{}': {}".format(path, problem))
+        return not problems
 
     @statusmethod
     def create_image(self):
         makedirs(self.imagedir, mode=0o755, exist_ok=True)
-        sh('dd if=/dev/zero of="{}" bs=1M count="{}"'.format(
-            self.imagepath, self.imagesize))
+        if self.build_mode == 'directory':
+            makedirs(self.rootfsdir, mode=0o755, exist_ok=True)
+            return
+        allocate_image(self.imagepath, self.imagesize, mode=self.allocation)
 
     @statusmethod
     def partition_image(self):
         # Partition it to have a FAT partition and an ext4 one
-        # This could be automated with sfdisk at some point
-        # NOTE: Results in an error: "Warning: The resulting partition is not 
-        # properly aligned for best performance"
-        # No idea if this matters on an SD card? I think it's fixable with 
-        # sfdisk, but that's harder to understand. It's also fixable if you just
-        # use fdisk manually. 
-        sh('parted "{}" --script -- mklabel msdos'.format(self.imagepath))
-        sh('parted "{}" --script -- mkpart primary fat32 0 64'.format(
-            self.imagepath))
-        sh('parted "{}" --script -- mkpart primary ext4 64 -1'.format(
-            self.imagepath))
+        if self.build_mode == 'directory':
+            return
+        self.write_partition_table(self.imagepath)
+
+    def write_partition_table(self, path):
+        """Partition the image at path, with both partitions aligned to the SD card's erase blocks"""
+        layout = partition_layout(
+            os.path.getsize(path), self.erase_block, boottype=boot_partition_type(self.fs_profile))
+        write_mbr(path, layout)
+        if not self.check_partitions(path):
+            raise Exception("Partitioning '{}' failed".format(path))
+        for i, p in enumerate(layout):
+            logging.info("Partition {} of '{}': {}MB at {}MB".format(
+                i+1, path, p['size'] // 1024 // 1024, p['start'] // 1024 // 1024))
 
     # TODO: Make sure the status of this gets checked and run automatically
     # This is HOST status, not IMAGE status, so I can't track it with self.status
     def setup_loopback_partitions(self):
-        # Retrieve mapper name, e.g. loop0
-        # This is usually found as /dev/loop0
-        # After the kpartx command has run, the partitions will be attached as
-        # e.g. /dev/mapper/loop0p1 and /dev/mapper/loop0p2
-
+        # The kernel scans the partition table when the image is attached, so the partitions show up
+        # as e.g. /dev/loop0p1 and /dev/loop0p2
         self.setup_loopback()
-
-        # If the partitions are already attached, kpartx will return them; 
-        # otherwise, it will attach and return them
-        # Its output looks like: 
-        # add map loop2p1 (254:2): 0 125000 linear /dev/loop2 1
-        # add map loop2p2 (254:3): 0 8263607 linear /dev/loop2 125001
-        kpartx_output = sh("kpartx -lva \"{}\"".format(self.loopdev_path))
-
-        re_result = re.search('^add map (\w+)p. ', kpartx_output)
-        loopmap = re_result.group(1)
-
-        self.bootdev = "/dev/mapper/{}p1".format(loopmap)
-        self.rootdev = "/dev/mapper/{}p2".format(loopmap)
+        self.bootdev = loopdevices.partition(self.loopdev_path, 1)
+        self.rootdev = loopdevices.partition(self.loopdev_path, 2)
         logging.info("Boot device: '{}'; Root device: '{}'".format(self.bootdev, self.rootdev))
 
+        # udev may not have created the partition nodes yet
+        wait_for_devices([self.bootdev, self.rootdev], timeout=self.device_timeout)
+
     def setup_loopback(self):
-        # First try to find an already-attached loopback device for the image
-        loopdevs = check_loopdev(self.imagepath)
-        if len(loopdevs) > 0:
-            if len(loopdevs) > 1:
-                logging.warn("Multiple loop devices found: {}".format(self.imagepath, loopdevs))
-            self.loopdev_path = loopdevs[0]
-            logging.info("Using existing loopback device at '{}'".format(self.loopdev_path))
-        else:
-            # If that didn't work, find a new loopback device to use, and attach the image
-            self.loopdev_path = sh('losetup --find "{}" --show'.format(self.imagepath))
-            #time.sleep(6) # Sometimes kpartx won't see these partitions right away
-            logging.info("Connected image to new loopback device at '{}'".format(self.loopdev_path))
+        self.loopdev_path = loopdevices.attach(self.imagepath)
 
     @statusmethod
     def create_image_filesystems(self):
+        # In directory mode, pack_image() makes the filesystems, with the files already in them
+        if self.build_mode == 'directory':
+            return
         self.setup_loopback_partitions()
-        time.sleep(6) # Sometimes kpartx won't see these partitions right away
-        sh('mkfs.vfat {}'.format(self.bootdev))
-        sh('mkfs.ext4 {}'.format(self.rootdev))
+        ext4opts, tune, vfatopts = mkfs_options(self.fs_profile, self.erase_block)
+        def make_root():
+            sh('mkfs.ext4 -F {} "{}"'.format(ext4opts, self.rootdev))
+            if tune:
+                sh('tune2fs -o {} "{}"'.format(tune, self.rootdev))
+        # They're on different partitions, and mkfs.ext4 initializing everything takes a while
+        run_parallel([lambda: sh('mkfs.vfat {} "{}"'.format(vfatopts, self.bootdev)), make_root], jobs=2)
 
     def mount_chroot(self):
-        self.setup_loopback_partitions()
+        if self.build_mode == 'directory':
+            makedirs(self.mountpoint+'/boot/firmware', exist_ok=True)
+        else:
+            self.setup_loopback_partitions()
         for m in self.mounts:
-            # the loopback command in setup_loopback_partitions returns immediately, even if
-            # the fucking /dev/mapper devices haven't been created yet
-            if m['device'].startswith('/dev/mapper') and not is_mounted(m):
-                time.sleep(3)
             mount(
                 device=m['device'], mountpoint=m['mountpoint'], 
                 fstype=m['fstype'], fsoptions=m['fsoptions'])
+        # Before debootstrap has run there's no apt in the chroot to share a cache with
+        if self.package_cache and os.path.isdir(self.mountpoint+'/var/cache/apt'):
+            self.package_cache.attach(self.mountpoint)
 
     @statusmethod
     def debootstrap_stage1(self):
         self.mount_chroot()
-        sh('qemu-debootstrap --verbose --arch={} "{}" "{}" "{}"'.format(
-            self.arch, self.debianvers, self.mountpoint, self.debmirr))
+        if not self.rootfs_cache:
+            self.debootstrap()
+            return
+        key = self.rootfs_cache.key(self.arch, self.debianvers, self.debmirr, self.debootstrap_packages())
+        # If another build is making the same base system right now, wait for it and use its tarball
+        with self.rootfs_cache.lock(key):
+            if self.rootfs_cache.lookup(key):
+                self.rootfs_cache.extract(key, self.mountpoint)
+                return
+            start = time.time()
+            self.debootstrap()
+            self.rootfs_cache.store(key, self.mountpoint, time.time() - start)
+
+    def debootstrap_packages(self):
+        """
+        The extra packages debootstrap installs: debootstrap_include, plus the prerequisites of the package
+        plan, which apt-get update in debootstrap_stage3 already needs
+        """
+        return sorted(set(self.debootstrap_include + self.package_plan().prerequisites))
+
+    def debootstrap(self):
+        packages = self.debootstrap_packages()
+        include = '--include={}'.format(','.join(packages)) if packages else ''
+        sh('qemu-debootstrap --verbose --arch={} {} "{}" "{}" "{}"'.format(
+            self.arch, include, self.debianvers, self.mountpoint, self.debmirr))
 
     @statusmethod
     def debootstrap_stage3(self):
         self.mount_chroot()
+        plan = self.stage3_plan()
+
+        for f in plan['files']:
+            write_file(f['contents'], self.mountpoint+f['path'], append=f['append'], mode=f['mode'])
+
+        sh(plan['commands'], env=plan['env'], chroot=self.mountpoint, chroot_disable_daemons=True)
+        plan['packages'].run(self.mountpoint)
+
+        stage3cmd = list(plan['postcommands'])
+        # With a shared package cache, the archives dir is the cache itself, and it gets unmounted before the
+        # image is finished anyway
+        if not self.package_cache:
+            stage3cmd += ['apt-get clean']
+        sh(stage3cmd, env=plan['env'], chroot=self.mountpoint, chroot_disable_daemons=True)
+
+        for f in plan['finalfiles']:
+            write_file(f['contents'], self.mountpoint+f['path'], append=f['append'], mode=f['mode'])
+
+    def stage3_plan(self):
+        """
+        Everything debootstrap_stage3 does to the image: the files it writes before and after running its
+        commands (paths are inside the image), and the commands, with their environment.
+        Kept apart from the stage itself so that it can be hashed to tell whether the stage needs to run again
+        """
+        def imagefile(path, contents, append=True, mode=False):
+            return {'path': path, 'contents': contents, 'append': append, 'mode': mode}
 
-        write_file(disable_daemons_script, self.mountpoint+'/root/disable_daemons.sh', append=False, mode=0o700)
-        write_file(enable_daemons_script, self.mountpoint+'/root/enable_daemons.sh', append=False, mode=0o700)
+        files = [
+            imagefile('/root/disable_daemons.sh', disable_daemons_script, append=False, mode=0o700),
+            imagefile('/root/enable_daemons.sh', enable_daemons_script, append=False, mode=0o700)]
 
         sl_new = [
             'deb http://ftp.debian.org/debian {} main contrib non-free'.format(self.debianvers),
             'deb-src http://ftp.debian.org/debian {} main contrib non-free'.format(self.debianvers)]
-        write_file(sl_new, self.mountpoint+"/etc/apt/sources.list", mode=0o644)
+        files.append(imagefile("/etc/apt/sources.list", sl_new, mode=0o644))
 
-        write_file([self.hostname], self.mountpoint+"/etc/hostname", append=False, mode=0o644)
+        files.append(imagefile("/etc/hostname", [self.hostname], append=False, mode=0o644))
 
         # Kali does this "so X doesn't complain": 
         hosts_contents = [
@@ -454,17 +2850,17 @@ class RaspSeedImage(object):
             "ff00::0         ip6-mcastprefix",
             "ff02::1         ip6-allnodes",
             "ff02::2         ip6-allrouters"]
-        write_file(hosts_contents, self.mountpoint+"/etc/hosts", append=False, mode=0o644)
+        files.append(imagefile("/etc/hosts", hosts_contents, append=False, mode=0o644))
         
         interfaces_contents = [
             "auto lo",
             "iface lo inet loopback",
             "auto eth0",
             "iface eth0 inet dhcp"]
-        write_file(interfaces_contents, self.mountpoint+"/etc/network/interfaces", append=False, mode=0o644)
+        files.append(imagefile("/etc/network/interfaces", interfaces_contents, append=False, mode=0o644))
 
         # TODO: do something better here, or at least allow a customization that doesn't rely on Google
-        write_file(["nameserver 8.8.8.8"], self.mountpoint+"/etc/resolv.conf", append=False, mode=0o644)
+        files.append(imagefile("/etc/resolv.conf", ["nameserver 8.8.8.8"], append=False, mode=0o644))
 
         # TODO: what do these lines really do though. (from Kali)
         debconfset_contents = [
@@ -473,117 +2869,197 @@ class RaspSeedImage(object):
             'locales locales/default_environment_locale  multiselect en_US.UTF-8 UTF-8',
             'locales locales/default_environment_locale  select      en_US.UTF-8']
         
-        write_file(debconfset_contents, self.mountpoint+"/debconf.set")
+        files.append(imagefile("/debconf.set", debconfset_contents))
 
         thirdstage_env = {
             'LANG':'C', 
             'DEBIAN_FRONTEND':'noninteractive'
         }
 
-        # stuff you probably want
-        additional_packages = 'apt-transport-https aptitude file openssh-client openssh-server iw usbutils ntp'
-        # TODO: micah's stuff you probably want to remove
-        additional_packages+= 'python python-pip emacs24-nox screen git'
-
+        # debconf-set-selections comes with debconf, so this can be answered before anything is installed
         stage3cmd = [
-            'apt-get update',
-            'apt-get install locales locales-all debconf-utils',
             'debconf-set-selections /debconf.set',
-            'rm -f /debconf.set',
-            'apt-get update',
-            # uboot is broken in jessie rn?? sjoerd doesn't require it. the webpage says:
-            # "ideally, having the firmware load a bootloader (such as u-boot) rather than a kernel directly to allow for a much more flexible boot sequence and support for using an initramfs"
-            # ... for non-sjoerd images, might have to build our own uboot. ugh.
-            # ... oh, looks like this migrated to u-boot-tools: https://packages.debian.org/wheezy/uboot-mkimage
-            # However, still not sure that it supports the Pi2 yet - it does support Pi1, but 2 support is unclear
-            #'apt-get -y install uboot-mkimage',
-            'apt-get -y install git-core binutils ca-certificates initramfs-tools',
-            'apt-get -y install console-common less nano git',
+            'rm -f /debconf.set']
+
+        poststage3cmd = [
             'echo "root:toor" | chpasswd',
             '''sed -i -e 's/KERNEL\!=\"eth\*|/KERNEL\!=\"/' /lib/udev/rules.d/75-persistent-net-generator.rules''',
             'rm -f /etc/udev/rules.d/70-persistent-net.rules',
-            'apt-get --yes --force-yes install $packages',
-            'apt-get install -y {}'.format(additional_packages),
             'locale-gen',
             'dpkg-reconfigure locales',
             'update-rc.d ssh enable',
             # Cleanup: 
             'rm -f /etc/ssh_host_*_key.pub',
             'rm -rf /root/.bash_history',
-            'apt-get clean',
             # 'rm -f /usr/bin/qemu*', # Keep this around if you want to keep chrooting in there
             'rm -f /0',
             'rm -f /hs_err*']
-        sh(stage3cmd, env=thirdstage_env, chroot=self.mountpoint, chroot_disable_daemons=True)
 
-        write_file(["T0:23:respawn:/sbin/agetty -L ttyAMA0 115200 vt100"], self.mountpoint+"/etc/inittab")
+        finalfiles = [
+            imagefile("/etc/inittab", ["T0:23:respawn:/sbin/agetty -L ttyAMA0 115200 vt100"])]
 
         fstab_contents = [
             '/dev/mmcblk0p1  /boot   vfat   ro                0       2',
             '/dev/mmcblk0p2  /       ext4   defaults,noatime  0       1']
-        write_file(fstab_contents, "{}/etc/fstab".format(self.mountpoint), mode=0o644)
+        finalfiles.append(imagefile("/etc/fstab", fstab_contents, mode=0o644))
+
+        return {
+            'files': files, 'env': thirdstage_env, 'commands': stage3cmd, 'packages': self.package_plan(),
+            'postcommands': poststage3cmd, 'finalfiles': finalfiles}
+
+    def package_plan(self):
+        """
+        Everything to install with apt: the base system's packages, the kernel's if it comes from apt, and
+        whatever package_hooks add, all in one PackagePlan
+        """
+        plan = PackagePlan()
+
+        # uboot is broken in jessie rn?? sjoerd doesn't require it. the webpage says:
+        # "ideally, having the firmware load a bootloader (such as u-boot) rather than a kernel directly to allow for a much more flexible boot sequence and support for using an initramfs"
+        # ... for non-sjoerd images, might have to build our own uboot. ugh.
+        # ... oh, looks like this migrated to u-boot-tools: https://packages.debian.org/wheezy/uboot-mkimage
+        # However, still not sure that it supports the Pi2 yet - it does support Pi1, but 2 support is unclear
+        #'uboot-mkimage',
+        base_packages = [
+            'locales', 'locales-all', 'debconf-utils',
+            'git-core', 'binutils', 'ca-certificates', 'initramfs-tools',
+            'console-common', 'less', 'nano', 'git']
+        # stuff you probably want
+        base_packages += ['apt-transport-https', 'aptitude', 'file', 'openssh-client', 'openssh-server', 'iw', 'usbutils', 'ntp']
+        # TODO: micah's stuff you probably want to remove
+        base_packages += ['python', 'python-pip', 'emacs24-nox', 'screen']
+        plan.add('base', base_packages, updates=2, installs=5)
+
+        if self.kernel == 'sjoerd':
+            # NOTE: package can't be authenticated. would be better to import the key out of band first, but until then, the repo is trusted
+            # NOTE: sjoerd's page says the package is raspberrypi-firmware-nokernel. Nope. It's apparently raspberrypi-bootloader-nokernel.
+            # NOTE: for some reason even after installing the keyring it can't auth at least some of these packages, so it stays trusted
+            plan.add('sjoerd', [
+                    'collabora-obs-archive-keyring', 'raspberrypi-bootloader-nokernel',
+                    'linux-image-3.18.0-trunk-rpi2', 'linux-headers-3.18.0-trunk-rpi2'],
+                sources=['deb https://repositories.collabora.co.uk/debian/ jessie rpi2'], trusted=True,
+                updates=2, installs=2)
+            # NOTE: the linux-kbuild-3.18 package isn't included in jessie, but sjoerd's kernel images were build to depend on it
+            plan.add('sjoerd', ['linux-kbuild-3.18'], sources=['deb http://ftp.debian.org/debian experimental main'],
+                release='experimental', updates=0, installs=1)
+
+        for hook in package_hooks:
+            hook(self, plan)
+        return plan
 
     def obtain_kernel_source(self, kernel):
         k = self.compilable_kernels[kernel]
         global depsdir
         makedirs(depsdir, exist_ok=True)
         archivename = re.match('.*/(.*)', k['url']).group(1)
+        archivepath = '{}/{}'.format(depsdir, archivename)
         kdir = "{}/{}".format(depsdir, k['foldername'])
-        # Download & extract the kernel source:
-        if not os.path.exists(kdir):
-            if not os.path.exists('{}/{}'.format(depsdir, archivename)):
-                sh('wget "{}"'.format(k['url']), cwd=depsdir)
-            sh('{} "{}"'.format(k['extractcmd'], archivename), cwd=depsdir)
         configname = re.match('.*/(.*)', self.kernel_config_url).group(1)
         configpath = "{}/arch/arm/configs/{}".format(
             kdir, configname)
-        # Download the config
-        if not os.path.exists(configpath):
-            sh('wget "{}"'.format(self.kernel_config_url), 
-               cwd=kdir+"/arch/arm/configs")
-        # Download the firmware
         fwdir = "{}/raspberrypi-firmware".format(depsdir)
-        if not os.path.exists(fwdir):
-            sh('git clone --depth 1 https://github.com/raspberrypi/firmware.git "{}"'.format(fwdir))
-        # Download the device tree source file
         dts_path = kdir+'/arch/arm/boot/dts/bcm2709-rpi-2-b.dts'
-        dts_url = 'https://raw.githubusercontent.com/raspberrypi/linux/rpi-3.18.y/arch/arm/boot/dts/bcm2709-rpi-2-b.dts'
+
+        # Download whatever is missing of the kernel source, the config, the device tree source file, and the
+        # firmware, all at once
+        fetcher = Fetcher()
+        tasks = []
+        if not os.path.exists(archivepath):
+            tasks.append(lambda: fetcher.place(fetcher.fetch(k['url'], k['sha256']), archivepath))
+        if not os.path.exists(configpath):
+            tasks.append(lambda: fetcher.fetch(self.kernel_config_url, self.kernel_config_sha256))
         if not os.path.exists(dts_path):
-            sh('wget "{}"'.format(dts_url), cwd=kdir+'/arch/arm/boot/dts')
-    
+            tasks.append(lambda: fetcher.fetch(self.kernel_dts_url, self.kernel_dts_sha256))
+        tasks.append(lambda: git_clone(self.firmware_git_url, fwdir))
+        run_parallel(tasks, fetcher.jobs)
 
-    def compile_linux_kernel(self, kernel):
+        # Extract the kernel source:
+        if not os.path.exists(kdir):
+            sh('{} "{}"'.format(k['extractcmd'], archivename), cwd=depsdir)
+        # The config and dts go into the extracted tree, so they can only be put in place now
+        if not os.path.exists(configpath):
+            shutil.copyfile(fetcher.lookup(self.kernel_config_url, self.kernel_config_sha256), configpath)
+        if not os.path.exists(dts_path):
+            shutil.copyfile(fetcher.lookup(self.kernel_dts_url, self.kernel_dts_sha256), dts_path)
+
+    def kernel_build_paths(self, kernel):
+        """The paths and make environment for building kernel in depsdir"""
         global depsdir
         k = self.compilable_kernels[kernel]
         kdir = "{}/{}".format(depsdir, k['foldername'])
+        logging.debug("kdir is {}".format(kdir))
+        return {
+            'kdir': kdir,
+            'archive': "{}/{}".format(depsdir, re.match('.*/(.*)', k['url']).group(1)),
+            'configpath': "{}/arch/arm/configs/{}".format(
+                kdir, re.match('.*/(.*)', self.kernel_config_url).group(1)),
+            'zImage': kdir+'/arch/arm/boot/zImage',
+            'dtb': kdir+'/arch/arm/boot/dts/bcm2709-rpi-2-b.dtb',
+            'makeenv': {'ARCH': 'arm', 'CROSS_COMPILE': 'arm-linux-gnueabihf-'}}
 
-        # make sure the kdir has the device tree source code in it
+    def cached_kernel(self, kernel, count=True):
+        """
+        Return the kernel cache's key and entry (or None) for kernel, or (None, None) without a kernel cache
+        count is passed on to KernelCache.lookup(); the lookup that decides whether to build is the one that counts
+        """
+        if not self.kernel_cache:
+            return None, None
+        paths = self.kernel_build_paths(kernel)
+        key = self.kernel_cache.key(
+            paths['archive'], paths['configpath'], toolchain_version(paths['makeenv']['CROSS_COMPILE']))
+        return key, self.kernel_cache.lookup(key, count=count)
 
-        zImage = kdir+'/arch/arm/boot/zImage'
-        dtb    = kdir+'/arch/arm/boot/dts/bcm2709-rpi-2-b.dtb'
-        logging.debug("kdir is {}".format(kdir))
-        makeenv = {'ARCH': 'arm', 'CROSS_COMPILE': 'arm-linux-gnueabihf-'}
-        if not os.path.exists(zImage) or not os.path.exists(dtb):
+    def compile_linux_kernel(self, kernel):
+        """Build kernel on the host, unless the kernel cache already has it; this doesn't touch the image"""
+        paths = self.kernel_build_paths(kernel)
+        kdir, zImage, dtb, makeenv = paths['kdir'], paths['zImage'], paths['dtb'], paths['makeenv']
+
+        key, cached = self.cached_kernel(kernel)
+        if self.kernel_cache:
+            needbuild = not cached
+        else:
+            needbuild = not os.path.exists(zImage) or not os.path.exists(dtb)
+
+        if needbuild:
             jobs = 0
             with open('/proc/cpuinfo') as f:
                 for line in f.readlines():
                     if re.match('processor', line):
                         jobs +=1
             jobs = int(jobs * 1.5)
+            # Rebuilds that miss the kernel cache can still reuse most object files through ccache
+            makecc = ''
+            if which('ccache'):
+                makeenv['CCACHE_DIR'] = ccache_dir
+                makecc = 'CC="ccache {}gcc"'.format(makeenv['CROSS_COMPILE'])
+                sh('ccache --zero-stats', env=makeenv, printoutput=False)
             # TODO: why will my make commands fail if I don't dot-source /etc/profile first? 
             sh('; '.join(['. /etc/profile', 
                           'echo "ARCH is $ARCH"', 
                           'echo "CROSS_COMPILE is $CROSS_COMPILE"',
-                          'make bcm2709_defconfig',
-                          'make -j{}'.format(jobs)]),
+                          'make {} bcm2709_defconfig'.format(makecc),
+                          'make {} -j{}'.format(makecc, jobs)]),
                env=makeenv, cwd=kdir)
+            if makecc:
+                logging.info("ccache statistics for this kernel build:\n{}".format(
+                    sh('ccache --show-stats', env=makeenv, printoutput=False)))
+            if self.kernel_cache:
+                self.kernel_cache.store(key, zImage, dtb, kdir, makeenv)
 
-        # Install the kernel, device tree, modules, and firmware
+    def install_compiled_kernel(self, kernel):
+        """Install the kernel that compile_linux_kernel() built, with its device tree, modules, and firmware"""
+        paths = self.kernel_build_paths(kernel)
+        kdir, zImage, dtb, makeenv = paths['kdir'], paths['zImage'], paths['dtb'], paths['makeenv']
+        # compile_linux_kernel() already counted this build's hit or miss
+        key, cached = self.cached_kernel(kernel, count=False)
         self.mount_chroot()
-        sh('make modules_install INSTALL_MOD_PATH="{}"'.format(self.mountpoint),
-           env=makeenv, cwd=kdir)
-        shutil.copyfile(zImage, self.mountpoint+'/boot/firmware/kernel7.img')
-        shutil.copyfile(dtb,    self.mountpoint+'/boot/firmware/bcm2709-rpi-2-b.dtb')
+        if cached:
+            self.kernel_cache.install(cached, self.mountpoint, os.path.basename(dtb))
+        else:
+            sh('make modules_install INSTALL_MOD_PATH="{}"'.format(self.mountpoint),
+               env=makeenv, cwd=kdir)
+            shutil.copyfile(zImage, self.mountpoint+'/boot/firmware/kernel7.img')
+            shutil.copyfile(dtb,    self.mountpoint+'/boot/firmware/bcm2709-rpi-2-b.dtb')
         fwdir = "{}/raspberrypi-firmware".format(depsdir)
         sh('cp -rf "{}"/boot/* "{}"'.format(
                 fwdir, self.mountpoint+"/boot/firmware"))
@@ -601,110 +3077,549 @@ class RaspSeedImage(object):
             'gpu_mem=16',
             "{}/boot/firmware/config.txt".format(self.mountpoint))
 
-    @statusmethod
+    # This only runs on the host, so it can go while the image is partitioned and debootstrapped
+    @statusmethod(inputs=[], resources=['depsdir'])
+    def build_kernel(self):
+        if self.kernel == 'sjoerd':
+            return
+        # The kernel source tree in depsdir is shared with other builds
+        global depsdir
+        makedirs(depsdir, exist_ok=True)
+        with FileLock(depsdir+'/.lock'):
+            self.obtain_kernel_source(self.kernel)
+            self.compile_linux_kernel(self.kernel)
+
+    @statusmethod(inputs=['debootstrap_stage3', 'build_kernel'], resources=['image', 'depsdir'])
     def install_kernel(self):
         if self.kernel == 'sjoerd':
             self.add_sjoerd_kernel()
         else:
-            self.obtain_kernel_source(self.kernel)
-            self.compile_linux_kernel(self.kernel)
+            global depsdir
+            with FileLock(depsdir+'/.lock'):
+                self.install_compiled_kernel(self.kernel)
 
     @statusmethod
     def copy_overlay(self):
         if self.overlaydir:
-            shutil.copytree(self.overlaydir, self.mountpoint, symlinks=True)
+            self.mount_chroot()
+            # The manifest lives in the image, so it rolls back along with it
+            start = time.time()
+            stats = sync_tree(
+                self.overlaydir, self.mountpoint,
+                manifest=self.mountpoint+'/var/lib/raspseed/overlay-manifest.json',
+                jobs=multiprocessing.cpu_count())
+            logging.info("Synced overlay '{}' in {:.1f}s: {} files ({}MB) copied {}, {} unchanged, {} symlinks".format(
+                self.overlaydir, time.time() - start, stats['copied'], stats['bytes'] // 1024 // 1024,
+                stats['methods'], stats['skipped'], stats['links']))
 
     # TODO: this doesn't require u-boot, meaning that the kernel step and the stage3 step are more segregated than my infrastructure currently allows. 
     # WHICH IS GOOD because apparently uboot is broken in jessie rn? Although the Pi 2 is supported in mainline UBoot so I could just build it myself
     # see stage3 comments
     def add_sjoerd_kernel(self):
-        sl_new = [
-            'deb https://repositories.collabora.co.uk/debian/ jessie rpi2',
-            'deb http://ftp.debian.org/debian experimental main']
-        write_file(sl_new, self.mountpoint+"/etc/apt/sources.list", mode=0o644)
-
+        # The packages were installed along with everything else in debootstrap_stage3; see package_plan()
+        self.mount_chroot()
         sjoerd_env = {
             'LANG':'C', 
             'DEBIAN_FRONTEND':'noninteractive'
         }
-        sjcommand = [
-            # Do the work you need to do: 
-            'apt-get update',
-            # NOTE: package can't be authenticated. would be better to import the key out of band first, but until then, --force-yes:
-            'apt-get install -y --force-yes collabora-obs-archive-keyring',
-            'apt-get update',
-            # NOTE: the linux-kbuild-3.18 package isn't included in jessie, but sjoerd's kernel images were build to depend on it:
-            'apt-get -t experimental install linux-kbuild-3.18',
-            # NOTE: sjoerd's page says the package is raspberrypi-firmware-nokernel. Nope. It's apparently raspberrypi-bootloader-nokernel.
-            # NOTE: for some reason even after installing the keyring it can't auth at least some of these packages. I have to use --force-yes again. 
-            'apt-get install -y --force-yes raspberrypi-bootloader-nokernel linux-image-3.18.0-trunk-rpi2 linux-headers-3.18.0-trunk-rpi2']
-        sh(sjcommand, env=sjoerd_env, chroot=self.mountpoint, chroot_disable_daemons=True)
 
         # Copy the kernel & supporting files to the place that the Pi expects
-        kpath = sh('chroot {} dpkg-query -L linux-image-3.18.0-trunk-rpi2 | grep vmlinuz'.format(self.mountpoint), env=sjoerd_env)
+        kpath = sh('dpkg-query -L linux-image-3.18.0-trunk-rpi2 | grep vmlinuz', env=sjoerd_env, chroot=self.mountpoint)
         shutil.copyfile(self.mountpoint+kpath, self.mountpoint+'/boot/firmware/kernel7.img')
 
         # create a cmdline.txt file. Uses the Raspbian one as a starting point
         cmdline_contents = "dwc_otg.lpm_enable=0 console=ttyAMA0,115200 root=/dev/mmcblk0p2 rootfstype=ext4 elevator=deadline rootwait"
         write_file(cmdline_contents, "{}/boot/firmware/cmdline.txt".format(self.mountpoint))
 
+    @property
+    def chroot_session(self):
+        """The resident shell for running commands in the image's chroot"""
+        return get_chroot_session(self.mountpoint)
+
     def detach_image(self):
-        for m in reversed(self.mounts):
-            umount(m['mountpoint'])
+        # The session's shell lives inside the chroot, so it has to go before anything can be unmounted
+        close_chroot_session(self.mountpoint)
+        if self.package_cache:
+            self.package_cache.detach(self.mountpoint)
+        umount_all([m['mountpoint'] for m in self.mounts])
 
         # Note: will detach ALL loopback devices for the image
-        loopdev = check_loopdev(self.imagepath)
-        for ld in loopdev:
-            logging.info("Removing loopback device '{}'".format(ld))
-            sh('kpartx -dv {}'.format(ld))
-            sh("losetup --detach '{}'".format(ld))
+        loopdevices.detach_image(self.imagepath)
 
     def purge_files(self):
-        os.remove(self.imagepath)
-        os.remove(self.statfile)
+        for path in [self.imagepath, self.statfile, self.inprogressfile, self.inputsfile]:
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(self.checkpointdir):
+            shutil.rmtree(self.checkpointdir)
+        if self.build_mode == 'directory' and os.path.isdir(self.rootfsdir):
+            # rmtree would follow a bind mount of /dev right into the host's
+            if mounttable.beneath(os.path.realpath(self.rootfsdir)):
+                raise Exception("Not removing '{}' while things are mounted in it".format(self.rootfsdir))
+            shutil.rmtree(self.rootfsdir)
         # TODO: should also remove working dirs and shit
 
+    def stage_inputs(self, stage):
+        """
+        What went into a stage, as something JSON-able: if it changes, the stage has to run again
+        Stages that aren't listed in input_functions() only depend on what the stages before them did
+        """
+        inputs = self.input_functions()
+        name = stage.wrapped.__name__
+        return inputs[name]() if name in inputs else {}
+
+    def input_functions(self):
+        """A dict of stage name -> function that returns what went into that stage; see stage_inputs()"""
+        return {
+            'create_image': lambda: {'buildmode': self.build_mode},
+            'partition_image': lambda: {
+                'eraseblock': self.erase_block, 'boottype': boot_partition_type(self.fs_profile)},
+            'create_image_filesystems': lambda: {'fsprofile': mkfs_options(self.fs_profile, self.erase_block)},
+            'debootstrap_stage1': lambda: {
+                'arch': self.arch, 'debianversion': self.debianvers, 'mirror': self.debmirr,
+                'include': self.debootstrap_packages()},
+            'debootstrap_stage3': lambda: dict(self.stage3_plan(), packages=self.package_plan().describe()),
+            'build_kernel': lambda: {
+                'kernel': self.kernel, 'source': self.compilable_kernels.get(self.kernel),
+                'config': [self.kernel_config_url, self.kernel_config_sha256],
+                'dts': [self.kernel_dts_url, self.kernel_dts_sha256], 'firmware': self.firmware_git_url},
+            'install_kernel': lambda: {'kernel': self.kernel},
+            'install_growroot': lambda: {'shrink': self.shrink, 'script': growroot_script, 'unit': growroot_unit},
+            'shrink_image': lambda: {'shrink': self.shrink, 'headroom': self.headroom},
+            'copy_overlay': lambda: {'overlay': tree_hash(self.overlaydir) if self.overlaydir else None},
+            'pack_image': lambda: {
+                'fsprofile': mkfs_options(self.fs_profile, self.erase_block), 'shrink': self.shrink,
+                'headroom': self.headroom if self.build_mode == 'directory' else None},
+            'generate_checksum': lambda: {
+                'algorithms': checksum_algorithms, 'export': [self.export_format, self.export_level]}}
+
+    def record_inputs(self, stage):
+        """Remember the hash of a stage's inputs, once it's done"""
+        with self.inputs_lock:
+            recorded = read_json(self.inputsfile, {})
+            recorded[stage.wrapped.__name__] = inputs_hash(self.stage_inputs(stage))
+            write_json(recorded, self.inputsfile)
+
+    def invalidated_stage(self):
+        """Return the first finished stage whose inputs have changed since it ran, or None"""
+        recorded = read_json(self.inputsfile, {})
+        for stage in statusmethods[:self.status]:
+            name = stage.wrapped.__name__
+            # Stages from before inputs were recorded have nothing to compare to, so they're left alone
+            if name in recorded and recorded[name] != inputs_hash(self.stage_inputs(stage)):
+                return stage
+        return None
+
+    @property
+    def checkpointdir(self):
+        return self.imagepath+'.checkpoints'
+
+    def checkpoints(self):
+        """Return a dict of status -> path for the image's checkpoints"""
+        if not os.path.isdir(self.checkpointdir):
+            return {}
+        return dict(
+            (int(name.split('-')[0]), os.path.join(self.checkpointdir, name))
+            for name in os.listdir(self.checkpointdir) if name.endswith('.img'))
+
+    def checkpoint(self, status, stagename):
+        """
+        Snapshot the image after a stage, so a later build can roll back to it instead of starting over
+        With checkpoint_mode 'auto' this only happens if the image's filesystem can make reflinks;
+        'always' falls back to a sparse copy, and 'never' turns checkpoints off
+        """
+        if self.checkpoint_mode == 'never' or not os.path.exists(self.imagepath):
+            return
+        makedirs(self.checkpointdir, exist_ok=True)
+        path = '{}/{:02d}-{}.img'.format(self.checkpointdir, status, stagename)
+        start = time.time()
+        mountpoints = [m['mountpoint'] for m in self.mounts if m['fstype'] in ('ext4', 'vfat')]
+        with frozen_filesystems(mountpoints):
+            with open(self.imagepath, 'rb') as img:
+                os.fsync(img.fileno())
+            try:
+                isreflink = clone_file(self.imagepath, path, allow_copy=(self.checkpoint_mode == 'always'))
+            except (IOError, OSError) as e:
+                logging.info("Cannot reflink '{}' ({}); not keeping checkpoints for it".format(self.imagepath, e))
+                self.checkpoint_mode = 'never'
+                return
+        logging.info("Checkpointed status {} to '{}' ({}) in {:.1f}s".format(
+            status, path, 'reflink' if isreflink else 'copy', time.time() - start))
+        inputs = self.input_functions()
+        keep = set(s.status for s in statusmethods if s.wrapped.__name__ in inputs)
+        old = [s for s in sorted(self.checkpoints()) if s not in keep]
+        for s in old[:-checkpoint_keep]:
+            os.remove(self.checkpoints()[s])
+
+    def rollback(self, status):
+        """
+        Put the image back the way it was when it reached status, from a checkpoint
+        Checkpoints for later statuses are deleted, since they no longer follow from the image
+        """
+        logging.info("Rolling back image '{}' to status {}".format(self.imagepath, status))
+        self.detach_image()
+        checkpoints = self.checkpoints()
+        if status == 0:
+            self.purge_files()
+        elif status in checkpoints:
+            clone_file(checkpoints[status], self.imagepath+'.rollback')
+            os.rename(self.imagepath+'.rollback', self.imagepath)
+            self.status = status
+        else:
+            raise Exception("No checkpoint for status {} of image '{}'; use --force to start over".format(
+                status, self.imagepath))
+        for later in checkpoints:
+            if later > status and os.path.exists(checkpoints[later]):
+                os.remove(checkpoints[later])
+        if os.path.exists(self.inprogressfile):
+            os.remove(self.inprogressfile)
+
+
+    @statusmethod
+    def install_growroot(self):
+        """Set the image up to grow its root partition and filesystem to fill the SD card when it first boots"""
+        if not self.shrink:
+            return
+        self.mount_chroot()
+        write_file(growroot_script, self.mountpoint+'/usr/local/sbin/raspseed-growroot', append=False, mode=0o755)
+        write_file(growroot_unit, self.mountpoint+'/etc/systemd/system/raspseed-growroot.service', append=False, mode=0o644)
+        wants = self.mountpoint+'/etc/systemd/system/multi-user.target.wants'
+        makedirs(wants, exist_ok=True)
+        link = wants+'/raspseed-growroot.service'
+        if not os.path.lexists(link):
+            os.symlink('/etc/systemd/system/raspseed-growroot.service', link)
+
+    @statusmethod
+    def pack_image(self):
+        """
+        In directory mode, make the image out of the finished tree, without attaching it: the boot files go into
+        a FAT filesystem made with mtools, everything else into an ext4 filesystem that mkfs.ext4 -d makes, and
+        both are copied into the image. The ext4 one is shrunk here too, before it's copied, instead of in
+        shrink_image(), since resize2fs can't shrink a filesystem partway into a file without cutting off its end.
+        In loop mode the image is already done.
+        """
+        if self.build_mode != 'directory':
+            return
+        self.detach_image()
+        packing = self.imagepath+'.packing'
+        bootimg = self.imagepath+'.boot.packing'
+        rootimg = self.imagepath+'.root.packing'
+        allocate_image(packing, self.imagesize, mode=self.allocation)
+        self.write_partition_table(packing)
+        partitions = read_partition_table(packing)
+        (bootstart, bootsize), (rootstart, rootsize) = partition_extents(packing)
+
+        # The boot files go in the FAT partition, so they're moved out of the way while the ext4 one is made
+        firmware = self.rootfsdir+'/boot/firmware'
+        aside = self.rootfsdir+'.firmware'
+        ext4opts, tune, vfatopts = mkfs_options(self.fs_profile, self.erase_block)
+        def make_root():
+            if os.path.exists(rootimg):
+                os.remove(rootimg)
+            sh('mkfs.ext4 -F -d "{}" {} "{}" {}k'.format(self.rootfsdir, ext4opts, rootimg, rootsize // 1024))
+            if tune:
+                sh('tune2fs -o {} "{}"'.format(tune, rootimg))
+            if self.shrink:
+                self.shrink_filesystem(rootimg, rootsize)
+        def make_boot():
+            if os.path.exists(bootimg):
+                os.remove(bootimg)
+            sh('mkfs.vfat -C {} "{}" {}'.format(vfatopts, bootimg, bootsize // 1024))
+            bootfiles = sorted(os.listdir(aside))
+            if bootfiles:
+                sh('mcopy -s -p -m -i "{}" {} ::/'.format(
+                    bootimg, ' '.join(shellquote(os.path.join(aside, f)) for f in bootfiles)))
+        os.rename(firmware, aside)
+        try:
+            os.mkdir(firmware)
+            # Each filesystem is made in a file of its own, and they're copied in after both are done
+            run_parallel([make_root, make_boot], jobs=2)
+            sparse_copy_into(bootimg, packing, bootstart)
+            os.remove(bootimg)
+            # resize2fs cuts the file off where the shrunk filesystem ends
+            partitions[1]['size'] = os.path.getsize(rootimg)
+            write_mbr(packing, partitions)
+            with open(packing, 'r+b') as f:
+                f.truncate(rootstart + partitions[1]['size'])
+            sparse_copy_into(rootimg, packing, rootstart)
+            os.remove(rootimg)
+        finally:
+            os.rmdir(firmware)
+            os.rename(aside, firmware)
+        os.rename(packing, self.imagepath)
+        self.imagesize = os.path.getsize(self.imagepath) // 1024 // 1024
+        logging.info("Packed '{}' into '{}' ({}MB)".format(self.rootfsdir, self.imagepath, self.imagesize))
+
+    def shrink_filesystem(self, rootdev, size):
+        """
+        Shrink the ext4 filesystem on rootdev, which is size bytes, to its smallest size plus headroom, rounded up
+        to an erase block. Returns the new size, or None if that wouldn't be any smaller
+        """
+        sh('e2fsck -fy "{}"'.format(rootdev))
+        blocksize = int(re.search(
+            '^Block size:\s+(\d+)', sh('dumpe2fs -h "{}"'.format(rootdev), printoutput=False),
+            re.MULTILINE).group(1))
+        minblocks = int(re.search(
+            'minimum size of the filesystem: (\d+)', sh('resize2fs -P "{}"'.format(rootdev))).group(1))
+        target = minblocks * blocksize + self.headroom * 1024 * 1024
+        target = (target + self.erase_block - 1) // self.erase_block * self.erase_block
+        if target >= size:
+            logging.info("The root filesystem on '{}' is already as small as it can be".format(rootdev))
+            return None
+        sh('resize2fs "{}" {}K'.format(rootdev, target // 1024))
+        return target
+
+    @statusmethod
+    def shrink_image(self):
+        """
+        Shrink the root filesystem to its smallest size plus headroom, end the root partition there (rounded up to
+        an erase block), and cut the image off after it, so it's stored, hashed and copied at its real size
+        """
+        # In directory mode, pack_image() already made the root filesystem at its shrunk size
+        if not self.shrink or self.build_mode == 'directory':
+            return
+        self.detach_image()
+        self.setup_loopback_partitions()
+        try:
+            partitions = read_partition_table(self.imagepath)
+            root = partitions[1]
+            target = self.shrink_filesystem(self.rootdev, root['size'])
+            if not target:
+                return
+        finally:
+            self.detach_image()
+        root['size'] = target
+        write_mbr(self.imagepath, partitions)
+        oldsize = os.path.getsize(self.imagepath)
+        with open(self.imagepath, 'r+b') as f:
+            f.truncate(root['start'] + root['size'])
+        if not self.check_partitions():
+            raise Exception("Shrinking '{}' left a bad partition table".format(self.imagepath))
+        self.imagesize = os.path.getsize(self.imagepath) // 1024 // 1024
+        logging.info("Shrank '{}' from {}MB to {}MB".format(self.imagepath, oldsize // 1024 // 1024, self.imagesize))
+
+    @statusmethod
+    def trim_image(self):
+        """
+        Get rid of the old data in the free space of both filesystems, which would otherwise be compressed,
+        checksummed and flashed along with everything else, and make it holes in the image file
+        """
+        before = allocated_size(self.imagepath)
+        self.detach_image()
+        # In directory mode the filesystems were made fresh, in sparse files, so their free space is holes already
+        if self.build_mode != 'directory':
+            self.discard_free_space()
+        # Zeroed free space, and anything else that's zeroes, only stops taking up space once it's a hole
+        punched = punch_zeroes(self.imagepath)
+        after = allocated_size(self.imagepath)
+        logging.info("Trimming '{}' reclaimed {}MB ({}MB from punching zeroes); it now takes up {}MB of {}MB".format(
+            self.imagepath, (before - after) // 1024 // 1024, punched // 1024 // 1024,
+            after // 1024 // 1024, os.path.getsize(self.imagepath) // 1024 // 1024))
+
+    def discard_free_space(self):
+        """Discard the free space of both filesystems in the image, or zero it where that can't be done"""
+        self.setup_loopback_partitions()
+        trimdir = self.imagepath+'.trim'
+        filesystems = [(self.rootdev, trimdir+'/root', 'ext4'), (self.bootdev, trimdir+'/boot', 'vfat')]
+        try:
+            for device, mountpoint, fstype in filesystems:
+                mount(device, mountpoint, fstype=fstype)
+                # The loop device passes discards on as holes punched in the image file
+                try:
+                    trimmed = fitrim(mountpoint)
+                    logging.info("Discarded {}MB of free space on '{}'".format(trimmed // 1024 // 1024, device))
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                        raise
+                    zeroed = zero_free_space(mountpoint)
+                    logging.info("'{}' can't discard ({}), so zeroed {}MB of free space instead".format(
+                        device, e, zeroed // 1024 // 1024))
+        finally:
+            umount_all([m for _, m, _ in filesystems])
+            self.detach_image()
+            if os.path.isdir(trimdir):
+                shutil.rmtree(trimdir)
+
     @statusmethod
     def generate_checksum(self):
         self.detach_image()
-        with open(self.imagepath, 'rb') as img:
-            self.sha1sum = hashlib.sha1(img.read()).hexdigest() 
-        logging.info("SHA1 for image at '{}' is '{}'".format(self.imagepath, self.sha1sum))
-        write_file(self.sha1sum, "{}.sha1".format(self.imagepath), append=False)
+        progress = log_progress(
+            "Checksumming '{}'".format(self.imagepath), os.path.getsize(self.imagepath))
+        if self.export_format:
+            # Exporting reads the image anyway, so the checksums come from the same pass
+            _, self.checksums, _ = export_image(
+                self.imagepath, self.export_format, self.export_level, progress=progress)
+        else:
+            self.checksums = checksum_file(self.imagepath, progress=progress)
+        self.sha1sum = self.checksums['sha1']
+        for algo in sorted(self.checksums):
+            logging.info("{} for image at '{}' is '{}'".format(
+                algo.upper(), self.imagepath, self.checksums[algo]))
+        write_checksum_sidecars(self.imagepath, self.checksums)
 
-    def buildup(self, statuslevel=None, overwrite=False, whatif=False):
+    def buildup(self, statuslevel=None, overwrite=False, whatif=False, rollback=None):
+        if whatif:
+            self._buildup(statuslevel, overwrite, whatif, rollback)
+            return
+        # Two processes building the same image at once would trample each other
+        with FileLock(self.imagepath+'.lock', blocking=False):
+            with tee_build_log(self.imagepath+'.build.log'):
+                with trace_span(self.imagename, 'build', imagepath=self.imagepath):
+                    self._buildup(statuslevel, overwrite, whatif, rollback)
+
+    def _buildup(self, statuslevel, overwrite, whatif, rollback):
         global finalstatus, statusmethods
 
         print("Image {} starting at status {}".format(self.imagename, self.status))
+        # Where the build starts once the image is rolled back or purged; whatif only works it out
+        start = self.status
 
         if overwrite:
             logging.info("Removing existing image/stat file...")
+            start = 0
             if not whatif:
                 self.detach_image()
-                if os.path.exists(self.imagepath): os.remove(self.imagepath)
-                if os.path.exists(self.statfile): os.remove(self.statfile)
+                self.purge_files()
+        elif rollback is not None:
+            start = rollback
+            if not whatif:
+                self.rollback(rollback)
+        elif os.path.exists(self.inprogressfile):
+            with open(self.inprogressfile) as f:
+                stage = f.readline().strip()
+            if self.status == 0 or self.status in self.checkpoints():
+                logging.warning("The last build stopped partway through '{}'; rolling back to status {}".format(
+                    stage, self.status))
+                if not whatif:
+                    self.rollback(self.status)
+            else:
+                # No checkpoints when the host can't reflink, or before pack_image in directory mode
+                logging.warning(' '.join([
+                    "The last build stopped partway through '{}', and there's no checkpoint for status {};".format(
+                        stage, self.status),
+                    "running it again on the image as it is"]))
+                if not whatif:
+                    os.remove(self.inprogressfile)
+
+        # Redo the first stage whose inputs changed and everything after it, from the closest checkpoint
+        if not overwrite and rollback is None:
+            stage = self.invalidated_stage()
+            if stage:
+                name = stage.wrapped.__name__
+                usable = [s for s in self.checkpoints() if 0 < s <= stage.status]
+                if all(s.wrapped.__name__ in refinish_stages for s in statusmethods[stage.status:self.status]):
+                    logging.warning("The inputs of '{}' changed since it ran; running it again from there".format(name))
+                    start = stage.status
+                    if not whatif:
+                        self.status = stage.status
+                elif usable:
+                    logging.warning("The inputs of '{}' changed since it ran; rebuilding from status {}".format(
+                        name, max(usable)))
+                    start = max(usable)
+                    if not whatif:
+                        self.rollback(max(usable))
+                elif whatif:
+                    logging.warning(' '.join([
+                        "The inputs of '{}' changed since it ran, and there's no checkpoint of image '{}'".format(
+                            name, self.imagepath),
+                        "to redo it from; building would stop and ask for --force, which starts from scratch"]))
+                    start = 0
+                else:
+                    raise Exception(' '.join([
+                        "The inputs of '{}' changed since it ran, and there's no checkpoint of image '{}'".format(
+                            name, self.imagepath),
+                        "to redo it from; use --force to build it again from scratch"]))
 
         finish = (statuslevel if statuslevel else finalstatus)
-        for stat in range(self.status, finish):
-            func = statusmethods[stat]
-            logging.info("Running function #{} - '{}' - {}".format(
-                    stat, func.wrapped.__name__, func.wrapped.__doc__))
-            if not whatif:
-                # Basically when you call instance.method(), python calls Class.method(instance). These do the same thing:
-                #   imgobj = RaspSeedImage(); imgobj.memberfunc(arg1, argN);
-                #   imgobj = RaspSeedImage(); f=RaspSeedImage.memberfunc; f(imgobj, arg1, argN);
-                # (This is why all class methods must have at least one argument, usually called 'self')
-                func(self)
+        run_stages(self, statusmethods[start:finish], whatif=whatif, start=start)
 
         print("Image complete: {}".format(self))
 
+def build_one(spec):
+    """
+    Build one image in a worker process of build_images()
+    spec is a dict of RaspSeedImage arguments, plus optional 'statuslevel', 'overwrite' and 'rollback' for buildup()
+    Everything the build prints goes to the image's .build.log, so builds running at once don't get mixed up
+    Returns (imagepath, error message or None, seconds taken)
+    """
+    spec = dict(spec)
+    buildargs = dict((k, spec.pop(k)) for k in ('statuslevel', 'overwrite', 'rollback') if k in spec)
+    # Caches are on by default, like on the command line; a spec can turn them off with null
+    packagecache = spec.pop('packagecache', package_cache_dir)
+    rootfscache = spec.pop('rootfscache', rootfs_cache_dir)
+    kernelcache = spec.pop('kernelcache', kernel_cache_dir)
+    imagepath = os.path.abspath(spec.pop('imagepath'))
+    start = time.time()
+
+    makedirs(os.path.dirname(imagepath), exist_ok=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(imagepath+'.build.log', 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        image = RaspSeedImage(
+            imagepath=imagepath,
+            packagecache=PackageCache(packagecache) if packagecache else None,
+            rootfscache=RootfsCache(rootfscache) if rootfscache else None,
+            kernelcache=KernelCache(kernelcache) if kernelcache else None,
+            **spec)
+        image.buildup(**buildargs)
+        return (imagepath, None, time.time() - start)
+    except Exception as e:
+        logging.exception("Building '{}' failed".format(imagepath))
+        return (imagepath, str(e), time.time() - start)
+
+def build_state(imagepath):
+    """A short description of how far along a build is, from the files it leaves next to the image"""
+    statfile = imagepath+'.status.txt'
+    status = 0
+    if os.path.exists(statfile):
+        with open(statfile) as f:
+            status = int(f.readline() or 0)
+    stage = 'waiting'
+    if os.path.exists(imagepath+'.inprogress'):
+        with open(imagepath+'.inprogress') as f:
+            stage = ', '.join(line.strip() for line in f if line.strip())
+    return "{} {}/{} ({})".format(os.path.basename(imagepath), status, finalstatus, stage)
+
+def build_images(specs, jobs=2, interval=30):
+    """
+    Build several images at once, with at most jobs builds running at a time
+    Each build runs in its own process (see build_one); this one prints a line whenever a build finishes,
+    and the state of every unfinished build every interval seconds
+    """
+    logging.info("Building {} images, {} at a time".format(len(specs), jobs))
+    sys.stdout.flush()
+    # maxtasksperchild=1 gives each build a fresh process, without another build's chroot sessions etc
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    results = pool.imap_unordered(build_one, specs)
+    pending = set(os.path.abspath(s['imagepath']) for s in specs)
+    failures = []
+    while pending:
+        try:
+            imagepath, error, elapsed = results.next(interval)
+        except multiprocessing.TimeoutError:
+            print("==== Progress: {}".format('; '.join(build_state(p) for p in sorted(pending))))
+            continue
+        pending.discard(imagepath)
+        print("==== [{}/{}] {} {} after {:.0f}s (log: {}.build.log)".format(
+            len(specs) - len(pending), len(specs), imagepath,
+            "FAILED: {}".format(error) if error else "finished", elapsed, imagepath))
+        if error:
+            failures.append(imagepath)
+    pool.close()
+    pool.join()
+    if failures:
+        raise Exception("{} of {} builds failed: {}".format(len(failures), len(specs), failures))
+
 def install_prereqs():
     # Note: We assume a completely bare debian install, so that this is enough to get a bare netinstall system up and running
     raise Exception("You need to add the emdebian mirror for what you wanna use ugh. don't forget to get the apt keys. then install sudo apt-get install emdebian-archive-keyring")
 
     # emdebian info, including repo URLs: http://www.emdebian.org/crosstools.html
     emdebian_host_packages = ""
-    host_packages = "dosfstools parted kpartx debootstrap qemu-user-static binfmt-support python ntp gcc-arm-linux-gnueabi bc unzip libncurses5-dev"
+    host_packages = "dosfstools mtools debootstrap qemu-user-static binfmt-support python ntp gcc-arm-linux-gnueabi bc unzip libncurses5-dev"
     logging.info("Installing host packages: {}".format(host_packages))
     sh("apt-get install -y {}".format(host_packages))
 
@@ -720,6 +3635,288 @@ def download_collabora_repo():
         cwd=colldir)
         
 
+# The block map of an image is made of ranges of whole blocks of this size
+bmap_block_size = 4096
+# Mapped ranges are split at this size, so each one gets its own hash and a bad write is narrowed down
+bmap_range_max = 64*1024*1024
+# flash_image() reads and writes this much at a time, with direct I/O
+flash_chunksize = 4*1024*1024
+
+def ext_free_ranges(device):
+    """
+    Return (start, length) in bytes, relative to the start of the filesystem, for the free blocks of the ext2/3/4
+    filesystem on device, which can be an image with ?offset=N like the e2fsprogs take
+    """
+    dump = sh('dumpe2fs "{}"'.format(device), printoutput=False)
+    blocksize = int(re.search(r'^Block size:\s+(\d+)', dump, re.MULTILINE).group(1))
+    free = []
+    # Each group has a line like '  Free blocks: 1234-5678, 9000'; the one in the header isn't indented
+    for line in re.findall(r'^\s+Free blocks: (.*)$', dump, re.MULTILINE):
+        for item in line.split(','):
+            if not item.strip():
+                continue
+            first, _, last = item.strip().partition('-')
+            first, last = int(first), int(last if last else first)
+            free.append((first * blocksize, (last - first + 1) * blocksize))
+    return free
+
+def used_ranges(path):
+    """
+    Return (start, length) in bytes for what the filesystems in a disk image use, or None if it isn't
+    partitioned. That's every block an ext partition hasn't marked free, including the inode tables and journal
+    that the sdcard profiles have mke2fs zero and record as zeroed, and all of any other partition, since FAT
+    keeps its allocation in tables that are mostly zeroes too. Those zeroes are holes once punch_zeroes() or
+    sparse_copy_into() have been at the image, but a card they're flashed to has to get them all the same.
+    """
+    try:
+        partitions = read_partition_table(path)
+    except Exception:
+        return None
+    used = []
+    for p in partitions:
+        free = None
+        if p['type'] == mbr_types['linux']:
+            try:
+                free = ext_free_ranges('{}?offset={}'.format(path, p['start']))
+            except Exception as e:
+                logging.warning("Can't read which blocks of partition at {} of '{}' are free ({}); using all of them".format(
+                    p['start'], path, e))
+        offset = 0
+        for start, length in sorted(free if free else []):
+            if start > offset:
+                used.append((p['start'] + offset, min(start, p['size']) - offset))
+            offset = max(offset, start + length)
+        if offset < p['size']:
+            used.append((p['start'] + offset, p['size'] - offset))
+    return used
+
+def block_map(path, blocksize=None):
+    """
+    Map the blocks of an image that flash_image() has to write, and hash each mapped range
+    In a partitioned image, that's what its filesystems use (see used_ranges()), plus whatever has data in it
+    outside the partitions, like the MBR; anything else, just what has data in it, skipping the holes.
+    Sparse images (the default allocation, checkpoints, and trimmed images) are mostly holes or free space, so
+    this is usually a small part of the image. Returns a dict like
+    {'size': 1610612736, 'blocksize': 4096, 'mapped': 412090368, 'ranges': [{'start': 0, 'length': 4096, 'sha256': '...'}]}
+    """
+    blocksize = blocksize if blocksize else bmap_block_size
+    size = os.path.getsize(path)
+    wanted = list(iter_data_ranges(path))
+    used = used_ranges(path)
+    if used is not None:
+        # Within the partitions, the filesystems decide
+        outside = []
+        for offset, length in wanted:
+            end = offset + length
+            for start, partsize in partition_extents(path):
+                if start < end and offset < start + partsize:
+                    if offset < start:
+                        outside.append((offset, start - offset))
+                    offset = max(offset, start + partsize)
+            if offset < end:
+                outside.append((offset, end - offset))
+        wanted = sorted(outside + used)
+    # Holes don't have to start and end on block boundaries, so round out to whole blocks and merge what touches
+    merged = []
+    for offset, length in wanted:
+        if length <= 0:
+            continue
+        start = offset // blocksize * blocksize
+        end = min(size, (offset + length + blocksize - 1) // blocksize * blocksize)
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    ranges = []
+    with io.open(path, 'rb') as f:
+        for start, end in merged:
+            for piece in range(start, end, bmap_range_max):
+                length = min(bmap_range_max, end - piece)
+                digest = hashlib.sha256()
+                f.seek(piece)
+                remaining = length
+                while remaining:
+                    data = f.read(min(flash_chunksize, remaining))
+                    digest.update(data)
+                    remaining -= len(data)
+                ranges.append({'start': piece, 'length': length, 'sha256': digest.hexdigest()})
+    return {'size': size, 'blocksize': blocksize, 'mapped': sum(r['length'] for r in ranges), 'ranges': ranges}
+
+def image_block_map(imagepath):
+    """Return the block map of an image, from its .bmap.json file if that's newer than the image, or made and saved"""
+    bmappath = imagepath+'.bmap.json'
+    if os.path.exists(bmappath) and os.path.getmtime(bmappath) >= os.path.getmtime(imagepath):
+        bmap = read_json(bmappath)
+        if bmap['size'] == os.path.getsize(imagepath):
+            return bmap
+    logging.info("Mapping the used blocks of '{}'".format(imagepath))
+    bmap = block_map(imagepath)
+    write_json(bmap, bmappath)
+    return bmap
+
+def aligned_buffer(size):
+    """
+    Return (a memoryview of size bytes, whether it is page-aligned), which direct I/O needs
+    An anonymous mmap is aligned, but Python 2 can't make a memoryview of one, so it gets a bytearray
+    """
+    try:
+        return memoryview(mmap.mmap(-1, size)), True
+    except TypeError:
+        return memoryview(bytearray(size)), False
+
+def open_direct(path, flags, mode, direct=True):
+    """
+    Open path with O_DIRECT if direct is True and it can do that, which some filesystems can't,
+    as an unbuffered io.FileIO. Returns (file, is direct)
+    """
+    fd = None
+    if direct:
+        try:
+            fd = os.open(path, flags | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    if fd is None:
+        fd, direct = os.open(path, flags), False
+    return io.FileIO(fd, mode), direct
+
+def flash_image(imagepath, target, verify=True):
+    """
+    Write an image to target, a block device like an SD card, or a regular file, only writing the image's mapped
+    blocks (see block_map()) with large direct I/O writes, then read those blocks back and check their hashes
+    Blocks that aren't mapped are left alone on target, so they hold whatever was there before; that's fine,
+    since they're free space as far as the image's filesystems are concerned, or outside of any filesystem
+    """
+    bmap = image_block_map(imagepath)
+    if is_block_device(target):
+        mounttable.refresh()
+        busy = [m['fs_file'] for m in mounttable.entries if m['fs_spec'].startswith(target)]
+        if busy:
+            raise Exception("'{}' has filesystems mounted at {}; unmount them first".format(target, busy))
+    elif not os.path.exists(target) or os.path.getsize(target) < bmap['size']:
+        # A regular file stands in for a card; it gets the image's size, with holes where the image has them
+        with open(target, 'ab') as f:
+            f.truncate(bmap['size'])
+
+    view, aligned = aligned_buffer(flash_chunksize)
+    out, direct = open_direct(target, os.O_WRONLY, 'wb', direct=aligned)
+    try:
+        targetsize = out.seek(0, os.SEEK_END)
+        if targetsize < bmap['size']:
+            raise Exception("'{}' is {}MB, too small for the {}MB image".format(
+                target, targetsize // 1024 // 1024, bmap['size'] // 1024 // 1024))
+        logging.info("Writing {}MB of the {}MB image '{}' to '{}'{}".format(
+            bmap['mapped'] // 1024 // 1024, bmap['size'] // 1024 // 1024, imagepath, target,
+            " with direct I/O" if direct else ""))
+        progress = log_progress("Flashing '{}'".format(target), bmap['mapped'])
+        written = 0
+        start = time.time()
+        with io.open(imagepath, 'rb', buffering=0) as image:
+            for r in bmap['ranges']:
+                image.seek(r['start'])
+                out.seek(r['start'])
+                remaining = r['length']
+                while remaining:
+                    count = image.readinto(view[:min(flash_chunksize, remaining)])
+                    # The last block of an image whose size isn't a whole number of blocks can't be written directly
+                    if direct and count % bmap['blocksize']:
+                        out.close()
+                        out, direct = io.FileIO(target, 'r+b'), False
+                        out.seek(r['start'] + r['length'] - remaining)
+                    done = 0
+                    while done < count:
+                        done += out.write(view[done:count])
+                    remaining -= count
+                    written += count
+                    progress(written)
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+    elapsed = time.time() - start
+    logging.info("Wrote {}MB in {:.1f}s ({:.1f}MB/s)".format(
+        written // 1024 // 1024, elapsed, written / 1024.0 / 1024 / max(elapsed, 0.001)))
+    if verify:
+        verify_flash(target, bmap)
+
+def verify_flash(target, bmap):
+    """Read the mapped ranges back from target, bypassing the page cache if possible, and check their hashes"""
+    view, aligned = aligned_buffer(flash_chunksize)
+    f, direct = open_direct(target, os.O_RDONLY, 'rb', direct=aligned)
+    try:
+        if not direct and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        # Direct reads have to be whole blocks; ranges are whole blocks, except maybe the last one
+        progress = log_progress("Verifying '{}'".format(target), bmap['mapped'])
+        checked = 0
+        bad = []
+        for r in bmap['ranges']:
+            f.seek(r['start'])
+            digest = hashlib.sha256()
+            remaining = r['length']
+            while remaining:
+                want = min(flash_chunksize, remaining)
+                count = f.readinto(view[:(want + bmap['blocksize'] - 1) // bmap['blocksize'] * bmap['blocksize']])
+                if not count:
+                    break
+                digest.update(view[:min(count, want)])
+                remaining -= min(count, want)
+            checked += r['length']
+            progress(checked)
+            if digest.hexdigest() != r['sha256']:
+                bad.append(r['start'])
+    finally:
+        f.close()
+    if bad:
+        raise Exception("Verifying '{}' failed: {} ranges differ from the image, starting at bytes {}".format(
+            target, len(bad), bad[:10]))
+    logging.info("Verified {} ranges ({}MB) on '{}'".format(len(bmap['ranges']), bmap['mapped'] // 1024 // 1024, target))
+
+# Sets of RaspSeedImage arguments that the benchmark subcommand can compare
+benchmark_comparisons = {
+    'buildmode': [('loop', {'buildmode': 'loop'}), ('directory', {'buildmode': 'directory'})],
+    'fsprofile': [(name, {'fsprofile': name}) for name in sorted(filesystem_profiles)]}
+
+def benchmark(imagepath, variants, rounds=1, **imageargs):
+    """
+    Build the same image once for each variant, rounds times over, and print how long each stage took
+    variants is a list of (name, dict of RaspSeedImage arguments); each one is built next to imagepath, as
+    IMAGE-NAME.img, with the usual caches, so the first build also warms them up for the others.
+    Returns a dict of variant name -> dict of stage name -> fastest time in seconds, plus 'size' and
+    'allocated', the size of the finished image and how much of it isn't holes, in bytes
+    """
+    base = re.sub('\.img$', '', imagepath)
+    results = dict((name, {}) for name, _ in variants)
+    for _ in range(rounds):
+        for name, args in variants:
+            path = '{}-{}.img'.format(base, name)
+            variantargs = dict(imageargs)
+            variantargs.update(args)
+            image = RaspSeedImage(
+                imagepath=path, packagecache=PackageCache(package_cache_dir),
+                rootfscache=RootfsCache(rootfs_cache_dir), kernelcache=KernelCache(kernel_cache_dir),
+                **variantargs)
+            with tracing(path+'.trace.json') as tracer:
+                image.buildup(overwrite=True)
+            for event in tracer.events:
+                if event['cat'] in ('stage', 'build'):
+                    stage = 'total' if event['cat'] == 'build' else event['name']
+                    seconds = event['dur'] / 1000000.0
+                    results[name][stage] = min(seconds, results[name].get(stage, seconds))
+            results[name]['size'] = os.path.getsize(path)
+            results[name]['allocated'] = allocated_size(path)
+
+    names = [name for name, _ in variants]
+    stages = [s.wrapped.__name__ for s in statusmethods] + ['total']
+    lines = ['{:<28}'.format('stage') + ''.join('{:>12}'.format(n) for n in names)]
+    for stage in stages:
+        lines.append('{:<28}'.format(stage) + ''.join(
+            '{:>11.1f}s'.format(results[n][stage]) if stage in results[n] else '{:>12}'.format('-') for n in names))
+    for key in ['size', 'allocated']:
+        lines.append('{:<28}'.format('image '+key) + ''.join(
+            '{:>10}MB'.format(results[n][key] // 1024 // 1024) for n in names))
+    print('\n'.join(lines))
+    return results
+
 def get_argparser():
     """
     Build the argparse object, but do not parse the arguments
@@ -740,6 +3937,10 @@ def get_argparser():
         '--image-path', '-i', action='store', dest='imagepath',
         default=os.getcwd()+RaspSeedImage.default_imagename,
         help='The path to the image file')
+    imagep.add_argument(
+        '--device-timeout', action='store', dest='devicetimeout',
+        default=device_timeout, type=float,
+        help='Seconds to wait for partition devices to appear after attaching the image')
 
     # SUBPARSERS
     setups = subparsers.add_parser('setup')
@@ -757,6 +3958,33 @@ def get_argparser():
 
     detachs = subparsers.add_parser('detach', parents=[imagep])
 
+    parallels = subparsers.add_parser('parallel')
+    parallels.add_argument(
+        'specfile', action='store',
+        help=' '.join(
+            ['A JSON file with a list of images to build. Each one is an object of',
+             'image arguments, like {"imagepath": "/srv/jessie.img", "debianversion":',
+             '"jessie", "kernel": "sjoerd"}, plus optional "statuslevel" and "overwrite"']))
+    parallels.add_argument(
+        '--jobs', '-j', action='store', default=2, type=int,
+        help='How many images to build at the same time')
+
+    exports = subparsers.add_parser('export', parents=[imagep])
+    exports.add_argument(
+        '--format', action='store', dest='exportformat', choices=sorted(export_formats), default='zst',
+        help='Compress the image to IMAGE.zst (the default) or IMAGE.xz')
+    exports.add_argument(
+        '--level', action='store', dest='exportlevel', default=None, type=int,
+        help='The compression level')
+
+    flashs = subparsers.add_parser('flash', parents=[imagep])
+    flashs.add_argument(
+        'device', action='store',
+        help='The SD card to write the image to, e.g. /dev/mmcblk0; a regular file works too')
+    flashs.add_argument(
+        '--no-verify', action='store_true', dest='noverify',
+        help='Do not read the written blocks back to check them')
+
     attachs = subparsers.add_parser('attach', parents=[imagep])
     attachs.add_argument(
         '--chroot', '-c', action='store_true', 
@@ -770,6 +3998,15 @@ def get_argparser():
     images.add_argument(
         '--statuslevel', '-l', action='store', default=None, type=int, 
         help='Do not take the image passt the specified statuslevel')
+    images.add_argument(
+        '--rollback', '-r', action='store', default=None, type=int,
+        help='Roll the image back to the checkpoint for this statuslevel, then continue from there')
+    images.add_argument(
+        '--checkpoints', action='store', choices=checkpoint_modes, default='auto',
+        help=' '.join(
+            ['Snapshot the image after each stage, so failed builds can roll back',
+             'and resume. auto (the default) only does it if the image can be',
+             'reflinked, always falls back to copying, never turns it off.']))
     images.add_argument(
         '--debianversion', '-d', action='store', default='sid',
         help='The version of debian to use')
@@ -789,7 +4026,98 @@ def get_argparser():
              'Foundation (unimplemented).']))
     images.add_argument(
         '--overlay-directory', '-o', action='store', default=None, 
-        destination='overlaydir', help='Copy an overlay onto the chroot')
+        dest='overlaydir', help='Copy an overlay onto the chroot')
+    images.add_argument(
+        '--allocation', '-a', action='store', choices=allocation_modes,
+        default='sparse',
+        help=' '.join(
+            ['How to allocate space for a new image file. sparse (the default)',
+             'only allocates blocks as they are written, fallocate reserves',
+             'them all up front, and zero writes zeroes over the whole image.']))
+    images.add_argument(
+        '--package-cache', action='store', dest='packagecache',
+        default=package_cache_dir,
+        help='A host directory to share downloaded packages between builds')
+    images.add_argument(
+        '--package-cache-size', action='store', dest='packagecachesize',
+        default=package_cache_maxsize, type=int,
+        help='Evict the least recently used packages once the cache is bigger than this many megabytes')
+    images.add_argument(
+        '--no-package-cache', action='store_true', dest='nopackagecache',
+        help='Do not share downloaded packages between builds')
+    images.add_argument(
+        '--rootfs-cache', action='store', dest='rootfscache',
+        default=rootfs_cache_dir,
+        help='A host directory to keep debootstrapped base systems in')
+    images.add_argument(
+        '--rootfs-cache-age', action='store', dest='rootfscacheage',
+        default=rootfs_cache_maxage, type=float,
+        help='Rebuild cached base systems once they are older than this many days')
+    images.add_argument(
+        '--no-rootfs-cache', action='store_true', dest='norootfscache',
+        help='Always run debootstrap, instead of reusing a cached base system')
+    images.add_argument(
+        '--kernel-cache', action='store', dest='kernelcache',
+        default=kernel_cache_dir,
+        help='A host directory to keep compiled kernels in, for the mainline and rpi kernels')
+    images.add_argument(
+        '--no-kernel-cache', action='store_true', dest='nokernelcache',
+        help='Do not reuse compiled kernels from earlier builds')
+    images.add_argument(
+        '--erase-block', action='store', dest='eraseblock', default=erase_block_size // 1024, type=int,
+        help='Align partitions to this many KB, the erase block size of the SD card')
+    images.add_argument(
+        '--fs-profile', action='store', dest='fsprofile', choices=sorted(filesystem_profiles),
+        default=filesystem_profile,
+        help=' '.join(
+            ['How to make the filesystems: default uses what mkfs does for hard',
+             'disks; sdcard (the default) tunes them for SD cards; sdcard-writeback',
+             'also only journals metadata']))
+    images.add_argument(
+        '--shrink-headroom', action='store', dest='headroom', default=shrink_headroom, type=int,
+        help='Shrink the finished image so its root filesystem has this many MB free')
+    images.add_argument(
+        '--no-shrink', action='store_true', dest='noshrink',
+        help=' '.join(
+            ['Leave the image at its full size, instead of shrinking it and having',
+             'it grow to fill the SD card when it first boots']))
+    images.add_argument(
+        '--export', action='store', dest='exportformat', choices=sorted(export_formats), default=None,
+        help='Also compress the finished image to IMAGE.zst or IMAGE.xz, in the same pass as checksumming it')
+    images.add_argument(
+        '--export-level', action='store', dest='exportlevel', default=None, type=int,
+        help='The compression level for --export')
+    images.add_argument(
+        '--build-mode', action='store', dest='buildmode', choices=build_modes, default='loop',
+        help=' '.join(
+            ['loop (the default) builds inside the image, attached through loop',
+             'devices. directory builds the tree in a plain directory and packs',
+             'it into the image at the end, without attaching it.']))
+    images.add_argument(
+        '--rootfs-dir', action='store', dest='rootfsdir', default=None,
+        help='Where to build the tree in directory mode, e.g. somewhere on a tmpfs. Defaults to IMAGE.rootfs')
+    images.add_argument(
+        '--trace', action='store', default=None, metavar='FILE',
+        help=' '.join(
+            ['Time every stage and command, and write the timings to FILE as a',
+             'Chrome trace (open it in chrome://tracing or ui.perfetto.dev),',
+             'and a summary of the slowest ones to FILE.txt']))
+
+    benchmarks = subparsers.add_parser('benchmark', parents=[imagep])
+    benchmarks.add_argument(
+        '--compare', action='store', choices=sorted(benchmark_comparisons), default='buildmode',
+        help=' '.join(
+            ['What to compare: buildmode builds the image in loop mode and in',
+             'directory mode, fsprofile builds it with each --fs-profile']))
+    benchmarks.add_argument(
+        '--rounds', action='store', default=1, type=int,
+        help='Build each variant this many times, and report the fastest time for each stage')
+    benchmarks.add_argument(
+        '--debianversion', '-d', action='store', default='sid',
+        help='The version of debian to use')
+    benchmarks.add_argument(
+        '--kernel', '-k', action='store', choices=['sjoerd','mainline','rpi'], default='sjoerd',
+        help='How to get the kernel')
 
     return argparser
 
@@ -821,11 +4149,29 @@ def execute(parsedargs, post_setup=None, post_image=None):
             imagesize = parsedargs.imagesize, 
             debianversion = parsedargs.debianversion, 
             kernel = parsedargs.kernel, 
-            overlaydir = parsedargs.overlaydir)
-        image.buildup(
-            overwrite=parsedargs.force, 
-            statuslevel=parsedargs.statuslevel,
-            whatif=parsedargs.whatif)
+            overlaydir = parsedargs.overlaydir,
+            allocation = parsedargs.allocation,
+            devicetimeout = parsedargs.devicetimeout,
+            packagecache = None if parsedargs.nopackagecache else PackageCache(
+                parsedargs.packagecache, parsedargs.packagecachesize),
+            rootfscache = None if parsedargs.norootfscache else RootfsCache(
+                parsedargs.rootfscache, parsedargs.rootfscacheage),
+            checkpoints = parsedargs.checkpoints,
+            kernelcache = None if parsedargs.nokernelcache else KernelCache(parsedargs.kernelcache),
+            buildmode = parsedargs.buildmode,
+            eraseblock = parsedargs.eraseblock * 1024,
+            fsprofile = parsedargs.fsprofile,
+            shrink = not parsedargs.noshrink,
+            exportformat = parsedargs.exportformat,
+            exportlevel = parsedargs.exportlevel,
+            headroom = parsedargs.headroom,
+            rootfsdir = parsedargs.rootfsdir)
+        with tracing(parsedargs.trace):
+            image.buildup(
+                overwrite=parsedargs.force, 
+                rollback=parsedargs.rollback,
+                statuslevel=parsedargs.statuslevel,
+                whatif=parsedargs.whatif)
 
     elif parsedargs.subparser == 'info':
         if parsedargs.imagepath:
@@ -837,12 +4183,34 @@ def execute(parsedargs, post_setup=None, post_image=None):
                 imagepath = parsedargs.imagepath)
             image.buildup(whatif=True)
 
+    elif parsedargs.subparser == 'parallel':
+        with open(parsedargs.specfile) as f:
+            specs = json.load(f)
+        build_images(specs, jobs=parsedargs.jobs)
+
+    elif parsedargs.subparser == 'benchmark':
+        benchmark(
+            parsedargs.imagepath, benchmark_comparisons[parsedargs.compare], rounds=parsedargs.rounds,
+            debianversion=parsedargs.debianversion, kernel=parsedargs.kernel,
+            devicetimeout=parsedargs.devicetimeout)
+
+    elif parsedargs.subparser == 'export':
+        progress = log_progress("Exporting '{}'".format(parsedargs.imagepath), os.path.getsize(parsedargs.imagepath))
+        _, digests, _ = export_image(
+            parsedargs.imagepath, parsedargs.exportformat, parsedargs.exportlevel, progress=progress)
+        write_checksum_sidecars(parsedargs.imagepath, digests)
+
+    elif parsedargs.subparser == 'flash':
+        flash_image(parsedargs.imagepath, parsedargs.device, verify=not parsedargs.noverify)
+
     elif parsedargs.subparser == 'detach':
         image = RaspSeedImage(imagepath=parsedargs.imagepath)
         image.detach_image()
 
     elif parsedargs.subparser == 'attach':
-        image = RaspSeedImage(imagepath=parsedargs.imagepath)
+        image = RaspSeedImage(
+            imagepath = parsedargs.imagepath,
+            devicetimeout = parsedargs.devicetimeout)
         image.mount_chroot()
         #if parsedargs.chroot:
             # TODO! Open a shell here
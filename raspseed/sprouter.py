@@ -15,25 +15,31 @@ tor_wap_cidr = '24'
 tor_trans_port = 9040
 tor_dns_port = 53
 
-def install_tor(image):
-    image.mount_chroot()
-
+def tor_packages(image, plan):
+    """Add tor, and the torproject.org repository it comes from, to a raspseed.PackagePlan"""
     sources_list = [
         'deb http://deb.torproject.org/torproject.org jessie main',
         'deb-src http://deb.torproject.org/torproject.org jessie main']
-    raspseed.write_file(
-        sources_list, image.mountpoint+'/etc/apt/sources.list',
-        append=True, uniqueonly=True)
-
-    chroot_env = {
-        'LANG':'C', 
-        'DEBIAN_FRONTEND':'noninteractive'}
-    chroot_cmds = [
+    key_cmds = [
         'gpg --keyserver keys.gnupg.net --recv 886DDD89',
-        'gpg --export A3C4F0F979CAA22CDBA8F512EE8CBC9E886DDD89 | apt-key add -',
-        'apt-get update',
-        'apt-get -y install tor deb.torproject.org-keyring tor-geoipdb']
-    raspseed.sh(chroot_cmds, env=chroot_env, chroot=image.mountpoint, chroot_disable_daemons=True)
+        'gpg --export A3C4F0F979CAA22CDBA8F512EE8CBC9E886DDD89 | apt-key add -']
+    plan.add('tor', ['tor', 'deb.torproject.org-keyring', 'tor-geoipdb'], sources=sources_list, keys=key_cmds)
+
+def install_packages(image, hook):
+    """
+    Install what a package hook like tor_packages adds, in its own PackagePlan
+    Unless the hook is in raspseed.package_hooks: then the build already installed it along with everything
+    else, in debootstrap_stage3, so there's nothing left to do. This is for images that were built without it
+    """
+    if hook in raspseed.package_hooks:
+        return
+    image.mount_chroot()
+    plan = raspseed.PackagePlan()
+    hook(image, plan)
+    plan.run(image.mountpoint)
+
+def install_tor(image):
+    install_packages(image, tor_packages)
 
 def route_thru_tor(image, wan_if, tor_ap):
     image.mount_chroot()
@@ -67,15 +73,12 @@ def enable_wifi_ap(image, wan_if, wap_if):
     # Can Linux correspond physical USB ports to logical devices? If so, I should specify an order and tell people that like slot 1 is wan_if and slot 2 is wap_if. Or whatever
 
     image.mount_chroot()
+    install_packages(image, wifi_ap_packages)
 
-    chroot_env = {
-        'LANG':'C', 
-        'DEBIAN_FRONTEND':'noninteractive'}
-    chroot_cmds = [
-        'apt-get update',
-        'apt-get -y install hostapd',
-        'apt-get -y install python python-pip'] # required for some of my boot scripts
-    raspseed.sh(chroot_cmds, env=chroot_env, chroot=image.mountpoint, chroot_disable_daemons=True)
+def wifi_ap_packages(image, plan):
+    """Add what enable_wifi_ap() needs to a raspseed.PackagePlan; see install_packages()"""
+    # python is required for some of my boot scripts
+    plan.add('wifi_ap', ['hostapd', 'python', 'python-pip'], installs=2)
 
 
 def add_tor_router(image, wan_if, tor_ap):
@@ -102,6 +105,12 @@ def sprout_main(*args):
         '--ingress-interface', '-e', action='store',
         help='The wifi interface to use for a Tor-only access point')
 
+    # So the build installs what the sprout needs along with everything else, instead of the sprout doing it
+    # with another apt-get update and install afterwards
+    for hook in [tor_packages, wifi_ap_packages]:
+        if hook not in raspseed.package_hooks:
+            raspseed.package_hooks.append(hook)
+
     parsed = parser.parse_args()
     raspseed.execute(parsed)
 
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import raspseed
+
+MB = 1024*1024
+
+class ExportImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = self.tmp+'/raspseed.img'
+        # Holes at the start, in the middle, and at the end, which export_image() makes up as zeroes
+        with open(self.image, 'wb') as f:
+            f.seek(MB)
+            f.write(os.urandom(100000))
+            f.seek(6*MB + 1)
+            f.write(b'raspseed' * 1000)
+            f.truncate(10*MB + 7)
+        with open(self.image, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def decompress(self, command, path):
+        return subprocess.check_output('{} -d -c {}'.format(command, path), shell=True)
+
+    def check_export(self, fmt, command):
+        outpath, imagedigests, outdigests = raspseed.export_image(self.image, fmt=fmt, level=1)
+        self.assertEqual(outpath, self.image+'.'+fmt)
+        self.assertEqual(self.decompress(command, outpath), self.data)
+        self.assertEqual(imagedigests['sha256'], hashlib.sha256(self.data).hexdigest())
+        with open(outpath, 'rb') as f:
+            self.assertEqual(outdigests['sha256'], hashlib.sha256(f.read()).hexdigest())
+        with open(outpath+'.sha256') as f:
+            self.assertEqual(f.read().split(), [outdigests['sha256'], os.path.basename(outpath)])
+        self.assertFalse(os.path.exists(outpath+'.tmp'))
+
+    @unittest.skipUnless(raspseed.which('zstd'), "needs zstd")
+    def test_zst(self):
+        self.check_export('zst', 'zstd -q')
+
+    @unittest.skipUnless(raspseed.which('xz'), "needs xz")
+    def test_xz(self):
+        self.check_export('xz', 'xz')
+
+    def test_unknown_format(self):
+        self.assertRaises(Exception, raspseed.export_image, self.image, fmt='rar')
+
+    def test_compressor_fails(self):
+        raspseed.export_formats['broken'] = {'command': 'cat >/dev/null; exit 3', 'level': 0}
+        try:
+            self.assertRaises(Exception, raspseed.export_image, self.image, fmt='broken')
+        finally:
+            del raspseed.export_formats['broken']
+        self.assertEqual(os.listdir(self.tmp), ['raspseed.img'])
+
+if __name__ == '__main__':
+    unittest.main()
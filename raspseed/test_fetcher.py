@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import raspseed
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def leftovers(fetcher):
+    """What's in the fetcher's partial directory besides the lock files, which are meant to stay"""
+    return [n for n in os.listdir(fetcher.partial) if not n.endswith('.lock')]
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves self.server.files, path -> (body, etag), and honors Range unless If-Range says the file changed"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(dict((k, self.headers.get(k)) for k in ('Range', 'If-Range')))
+        body, etag = self.server.files[self.path]
+        wanted = self.headers.get('Range')
+        validator = self.headers.get('If-Range')
+        if wanted and (validator is None or validator == etag):
+            body = body[int(wanted.split('=')[1].rstrip('-')):]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fetcher = raspseed.Fetcher(path=self.tmp+'/store')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def publish(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return 'file://'+path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_file_url(self):
+        data = b'linux' * 1000
+        url = self.publish('linux.tar.xz', data)
+        stored = self.fetcher.fetch(url, sha256(data))
+        self.assertEqual(self.read(stored), data)
+        self.assertEqual(os.path.basename(stored), sha256(data))
+        self.assertEqual(leftovers(self.fetcher), [])
+        # Comes from the store the second time, so the source can go away
+        os.remove(url[len('file://'):])
+        self.assertEqual(self.fetcher.fetch(url, sha256(data)), stored)
+        self.assertEqual(self.fetcher.fetch(url), stored)
+
+    def test_hash_mismatch(self):
+        url = self.publish('config', b'CONFIG_FOO=y\n')
+        self.assertRaises(Exception, self.fetcher.fetch, url, sha256(b'CONFIG_FOO=n\n'))
+        self.assertEqual(os.listdir(self.fetcher.objects), [])
+        self.assertEqual(leftovers(self.fetcher), [])
+
+    def test_eviction(self):
+        self.fetcher.maxsize = 0
+        first = self.fetcher.fetch(self.publish('a', b'a'))
+        second = self.fetcher.fetch(self.publish('b', b'b'))
+        # The object that was just fetched is never evicted, however small the store
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_place(self):
+        data = b'dtb'
+        stored = self.fetcher.fetch(self.publish('bcm2709-rpi-2-b.dtb', data))
+        dest = self.fetcher.place(stored, self.tmp+'/placed.dtb')
+        self.assertEqual(self.read(dest), data)
+
+class FetcherResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fetcher = raspseed.Fetcher(path=self.tmp+'/store')
+        self.server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.files = {}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        os.makedirs(self.fetcher.partial)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def interrupted(self, name, body, etag, data, validator=None):
+        """Serve body as name, and leave behind a partial download of it that got as far as data"""
+        self.server.files['/'+name] = (body, etag)
+        url = 'http://127.0.0.1:{}/{}'.format(self.server.server_port, name)
+        part = '{}/{}.part'.format(self.fetcher.partial, sha256(url.encode('utf-8')))
+        with open(part, 'wb') as f:
+            f.write(data)
+        if validator:
+            raspseed.write_json({'validator': validator}, part+'.validator')
+        return url
+
+    def fetched(self, url, pinned=None):
+        with open(self.fetcher.fetch(url, pinned), 'rb') as f:
+            return f.read()
+
+    def test_resume_unchanged(self):
+        url = self.interrupted('linux.tar.xz', b'A'*1000, '"v1"', b'A'*400, validator='"v1"')
+        self.assertEqual(self.fetched(url), b'A'*1000)
+        self.assertEqual(self.server.requests, [{'Range': 'bytes=400-', 'If-Range': '"v1"'}])
+
+    def test_resume_changed(self):
+        url = self.interrupted('linux.tar.xz', b'B'*1000, '"v2"', b'A'*400, validator='"v1"')
+        self.assertEqual(self.fetched(url), b'B'*1000)
+        self.assertEqual(leftovers(self.fetcher), [])
+
+    def test_no_validator_unpinned(self):
+        url = self.interrupted('linux.tar.xz', b'B'*1000, '"v2"', b'A'*400)
+        self.assertEqual(self.fetched(url), b'B'*1000)
+        self.assertEqual(self.server.requests, [{'Range': None, 'If-Range': None}])
+
+    def test_no_validator_pinned(self):
+        url = self.interrupted('linux.tar.xz', b'A'*1000, '"v1"', b'A'*400)
+        self.assertEqual(self.fetched(url, sha256(b'A'*1000)), b'A'*1000)
+        self.assertEqual(self.server.requests, [{'Range': 'bytes=400-', 'If-Range': None}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import raspseed
+
+MB = 1024*1024
+
+class FlashTest(unittest.TestCase):
+    """A regular file stands in for the SD card"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = self.tmp+'/raspseed.img'
+        self.card = self.tmp+'/card'
+        # Data at the start and in the middle, with holes around it
+        with open(self.image, 'wb') as f:
+            f.write(b'M' * 8192)
+            f.seek(5*MB + 100)
+            f.write(b'R' * 10000)
+            f.truncate(12*MB)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_block_map(self):
+        # Not partitioned, so it's only the holes that are skipped
+        self.assertIsNone(raspseed.used_ranges(self.image))
+        bmap = raspseed.block_map(self.image)
+        self.assertEqual(bmap['size'], 12*MB)
+        self.assertEqual(bmap['blocksize'], 4096)
+        # Rounded out to whole blocks
+        self.assertEqual([(r['start'], r['length']) for r in bmap['ranges']], [(0, 8192), (5*MB, 3*4096)])
+        self.assertEqual(bmap['mapped'], 8192 + 3*4096)
+
+    def test_block_map_splits_ranges(self):
+        with open(self.image, 'r+b') as f:
+            f.write(b'M' * 3*MB)
+        default = raspseed.bmap_range_max
+        raspseed.bmap_range_max = MB
+        try:
+            bmap = raspseed.block_map(self.image)
+        finally:
+            raspseed.bmap_range_max = default
+        self.assertEqual([(r['start'], r['length']) for r in bmap['ranges'][:3]], [(0, MB), (MB, MB), (2*MB, MB)])
+        self.assertEqual(len(set(r['sha256'] for r in bmap['ranges'][:3])), 1)
+
+    def test_image_block_map_is_saved(self):
+        bmap = raspseed.image_block_map(self.image)
+        self.assertEqual(raspseed.read_json(self.image+'.bmap.json'), bmap)
+        self.assertEqual(raspseed.image_block_map(self.image), bmap)
+
+    def test_flash_new_file(self):
+        raspseed.flash_image(self.image, self.card)
+        self.assertEqual(self.read(self.card), self.read(self.image))
+
+    def test_flash_leaves_holes_alone(self):
+        with open(self.card, 'wb') as f:
+            f.write(b'\xff' * 16*MB)
+        raspseed.flash_image(self.image, self.card)
+        card = self.read(self.card)
+        self.assertEqual(len(card), 16*MB)
+        self.assertEqual(card[:8192], b'M' * 8192)
+        self.assertEqual(card[8192:5*MB], b'\xff' * (5*MB - 8192))
+        self.assertEqual(card[5*MB:5*MB + 100], b'\0' * 100)
+        self.assertEqual(card[5*MB + 100:5*MB + 10100], b'R' * 10000)
+
+    def test_flash_partial_last_block(self):
+        with open(self.image, 'r+b') as f:
+            f.seek(12*MB)
+            f.write(b'T' * 1000)
+        raspseed.flash_image(self.image, self.card)
+        self.assertEqual(self.read(self.card), self.read(self.image))
+
+    def test_flash_grows_smaller_file(self):
+        with open(self.card, 'wb') as f:
+            f.write(b'\xff' * 4096)
+        raspseed.flash_image(self.image, self.card)
+        self.assertEqual(self.read(self.card), self.read(self.image))
+
+    def test_verify_finds_bad_writes(self):
+        raspseed.flash_image(self.image, self.card)
+        with open(self.card, 'r+b') as f:
+            f.seek(5*MB + 200)
+            f.write(b'X')
+        self.assertRaises(Exception, raspseed.verify_flash, self.card, raspseed.image_block_map(self.image))
+
+@unittest.skipUnless(raspseed.which('mkfs.ext4') and raspseed.which('dumpe2fs'), "needs e2fsprogs")
+class FlashFilesystemTest(unittest.TestCase):
+    """An image with a real ext4 partition, made the way the sdcard profile makes it, on a card with junk on it"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = self.tmp+'/raspseed.img'
+        self.card = self.tmp+'/card'
+        with open(self.image, 'wb') as f:
+            f.truncate(64*MB)
+        self.layout = raspseed.partition_layout(64*MB, eraseblock=MB, bootsize=8)
+        raspseed.write_mbr(self.image, self.layout)
+        root = self.layout[1]
+        ext4opts = raspseed.mkfs_options('sdcard', MB, extended=['offset={}'.format(root['start'])])[0]
+        raspseed.sh('mkfs.ext4 -F -q {} "{}" {}k'.format(ext4opts, self.image, root['size'] // 1024), printoutput=False)
+        # The zeroed inode tables and journal become holes
+        raspseed.punch_zeroes(self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_used_ranges(self):
+        used = raspseed.used_ranges(self.image)
+        boot, root = self.layout
+        self.assertEqual(used[0], (boot['start'], boot['size']))
+        self.assertTrue(all(root['start'] <= start and start + length <= root['start'] + root['size']
+                            for start, length in used[1:]))
+        # Free blocks aren't in it, but the metadata is, holes or not
+        self.assertLess(sum(length for _, length in used[1:]), root['size'])
+        self.assertGreater(sum(length for _, length in used[1:]), raspseed.allocated_size(self.image))
+
+    def test_flash_over_junk(self):
+        with open(self.card, 'wb') as f:
+            f.write(b'\xa5' * 64*MB)
+        raspseed.flash_image(self.image, self.card)
+        # Every block the filesystems use has to be what's in the image, zeroes included, not the card's junk
+        with open(self.image, 'rb') as image:
+            with open(self.card, 'rb') as card:
+                for start, length in raspseed.used_ranges(self.image):
+                    image.seek(start)
+                    card.seek(start)
+                    self.assertEqual(card.read(length), image.read(length))
+        raspseed.sh('e2fsck -fn "{}?offset={}"'.format(self.card, self.layout[1]['start']), printoutput=False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import raspseed
+
+# From a build with the image's root mounted, and an overlay directory with a space in its name
+mountinfo = """\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro
+23 22 0:5 / /dev rw,nosuid shared:2 - devtmpfs udev rw,size=4010000k,mode=755
+36 22 7:1 / /tmp/build/mnt rw,relatime shared:20 - ext4 /dev/loop0p2 rw
+37 36 7:0 / /tmp/build/mnt/boot rw,relatime shared:21 - vfat /dev/loop0p1 rw,fmask=0022
+38 36 0:5 / /tmp/build/mnt/dev rw,nosuid shared:2 master:3 - devtmpfs udev rw
+39 38 0:12 / /tmp/build/mnt/dev/pts rw,nosuid - devpts devpts rw,gid=5,mode=620
+40 22 8:1 /home/me/my\\040overlay /tmp/build/over\\040lay rw,relatime shared:1 - ext4 /dev/sda1 rw
+41 36 7:2 / /tmp/build/mnt rw,relatime - ext4 /dev/loop2 rw
+42 22 0:40 / /tmp/build/mntx rw - tmpfs tmpfs rw
+"""
+
+class MountTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.table = raspseed.MountTable()
+        self.table.path = self.tmp+'/mountinfo'
+        with open(self.table.path, 'w') as f:
+            f.write(mountinfo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_parse(self):
+        self.table.refresh(force=True)
+        self.assertEqual(len(self.table.entries), 9)
+        boot = self.table.entries[3]
+        self.assertEqual(boot, {
+            'mount_id': 37, 'parent_id': 36, 'devnum': '7:0', 'root': '/', 'fs_file': '/tmp/build/mnt/boot',
+            'fs_mntops': 'rw,relatime', 'fs_vfstype': 'vfat', 'fs_spec': '/dev/loop0p1',
+            'fs_superops': 'rw,fmask=0022'})
+        # Any number of optional fields, including none
+        self.assertEqual(self.table.entries[4]['fs_vfstype'], 'devtmpfs')
+        self.assertEqual(self.table.entries[5]['fs_spec'], 'devpts')
+
+    def test_unescape(self):
+        overlay = self.table.find('/tmp/build/over lay')
+        self.assertEqual(overlay['root'], '/home/me/my overlay')
+        self.assertEqual(raspseed.unescape_mountinfo('a\\011b\\134c'), 'a\tb\\c')
+
+    def test_find_topmost(self):
+        self.assertEqual(self.table.find('/tmp/build/mnt')['fs_spec'], '/dev/loop2')
+        self.assertTrue(self.table.is_mounted('/tmp/build/mnt/dev/pts'))
+        self.assertFalse(self.table.is_mounted('/tmp/build'))
+
+    def test_beneath(self):
+        # Submounts come before what they're mounted on, and /tmp/build/mntx isn't under /tmp/build/mnt
+        self.assertEqual([e['mount_id'] for e in self.table.beneath('/tmp/build/mnt')], [41, 39, 38, 37, 36])
+        self.assertEqual([e['mount_id'] for e in self.table.beneath('/tmp/build/mnt/dev')], [39, 38])
+
+    def test_refresh_rereads(self):
+        self.table.refresh(force=True)
+        with open(self.table.path, 'a') as f:
+            f.write('43 22 0:41 / /tmp/build/cache rw - tmpfs tmpfs rw\n')
+        # A regular file can't be polled for changes, so this only shows up when forced
+        self.table.refresh(force=True)
+        self.assertTrue(self.table.is_mounted('/tmp/build/cache'))
+
+if __name__ == '__main__':
+    unittest.main()
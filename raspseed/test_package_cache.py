@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import raspseed
+
+class PackageCacheTest(unittest.TestCase):
+    """
+    A local directory stands in for the mirror: installing a package copies its .deb from there into the
+    chroot's apt archives, like apt-get does, and logs it the way dpkg does
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.mirror = self.tmp+'/mirror'
+        self.chroot = self.tmp+'/chroot'
+        os.makedirs(self.mirror)
+        os.makedirs(self.chroot+'/var/log')
+        os.makedirs(self.chroot+'/etc/apt')
+        self.cache = raspseed.PackageCache(path=self.tmp+'/cache', maxsize=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def publish(self, deb, size=400*1024):
+        with open(os.path.join(self.mirror, deb), 'wb') as f:
+            f.write(b'\0' * size)
+
+    def install(self, name, version, arch='armhf'):
+        deb = '{}_{}_{}.deb'.format(name, version.replace(':', '%3a'), arch)
+        archives = self.chroot+'/var/cache/apt/archives'
+        if not os.path.exists(os.path.join(archives, deb)):
+            shutil.copy(os.path.join(self.mirror, deb), archives)
+        with open(self.chroot+'/var/log/dpkg.log', 'a') as f:
+            f.write('2015-03-01 12:00:00 install {}:{} <none> {}\n'.format(name, arch, version))
+
+    def test_installed_debs(self):
+        with open(self.chroot+'/var/log/dpkg.log', 'w') as f:
+            f.write('2015-03-01 12:00:00 startup archives unpack\n')
+            f.write('2015-03-01 12:00:00 install tor:armhf <none> 0.2.5.10-1\n')
+        offset = os.path.getsize(self.chroot+'/var/log/dpkg.log')
+        with open(self.chroot+'/var/log/dpkg.log', 'a') as f:
+            f.write('2015-03-01 12:00:01 status unpacked tor:armhf 0.2.5.10-1\n')
+            f.write('2015-03-01 12:00:02 upgrade libc6:armhf 2.19-17 1:2.19-18\n')
+            f.write('2015-03-01 12:00:03 remove hostapd:armhf 2.3-1 <none>\n')
+        self.assertEqual(self.cache.installed_debs(self.chroot), [
+            'tor_0.2.5.10-1_armhf.deb', 'libc6_1%3a2.19-18_armhf.deb'])
+        self.assertEqual(self.cache.installed_debs(self.chroot, offset), ['libc6_1%3a2.19-18_armhf.deb'])
+
+    def test_installed_debs_without_log(self):
+        self.assertEqual(self.cache.installed_debs(self.chroot), [])
+
+    @unittest.skipUnless(os.geteuid() == 0, "bind mounts need root")
+    def test_attach_detach(self):
+        self.publish('tor_0.2.5.10-1_armhf.deb')
+        self.publish('hostapd_2.3-1_armhf.deb')
+        self.addCleanup(raspseed.umount_all, [self.chroot])
+
+        self.cache.attach(self.chroot)
+        self.assertTrue(raspseed.is_mounted(self.chroot+'/var/cache/apt/archives'))
+        self.assertTrue(raspseed.is_mounted(self.chroot+'/var/lib/apt/lists'))
+        with open(self.cache.aptconf(self.chroot)) as f:
+            self.assertIn('List-Cleanup "false"', f.read())
+        self.install('tor', '0.2.5.10-1')
+        self.cache.detach(self.chroot)
+        self.assertFalse(raspseed.is_mounted(self.chroot+'/var/cache/apt/archives'))
+        self.assertFalse(os.path.exists(self.cache.aptconf(self.chroot)))
+        self.assertEqual(self.cache.debs(), set(['tor_0.2.5.10-1_armhf.deb']))
+        manifest = raspseed.read_json(self.cache.manifestpath)
+        self.assertEqual((manifest['hits'], manifest['misses']), (0, 1))
+
+        # The next build finds tor already there, and hostapd pushes the cache over its 1MB limit
+        self.publish('libnl_3.2.24-2_armhf.deb')
+        self.cache.attach(self.chroot)
+        self.install('tor', '0.2.5.10-1')
+        self.install('hostapd', '2.3-1')
+        self.install('libnl', '3.2.24-2')
+        self.cache.detach(self.chroot)
+        manifest = raspseed.read_json(self.cache.manifestpath)
+        self.assertEqual((manifest['hits'], manifest['misses']), (1, 3))
+        self.assertEqual(len(self.cache.debs()), 2)
+        self.assertEqual(set(manifest['lastused']), self.cache.debs())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import raspseed
+
+MB = 1024*1024
+
+class PartitionTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = self.tmp+'/raspseed.img'
+        with open(self.image, 'wb') as f:
+            f.truncate(2048*MB + 12345)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_layout(self):
+        boot, root = raspseed.partition_layout(2048*MB + 12345, eraseblock=4*MB, bootsize=64)
+        self.assertEqual((boot['start'], boot['size'], boot['type'], boot['bootable']), (4*MB, 64*MB, 0x0c, True))
+        self.assertEqual((root['start'], root['size'], root['type'], root['bootable']), (68*MB, 1980*MB, 0x83, False))
+        # The boot partition is rounded up to whole erase blocks
+        boot, root = raspseed.partition_layout(2048*MB, eraseblock=3*MB, bootsize=64, boottype=0x0e)
+        self.assertEqual((boot['start'], boot['size'], boot['type']), (3*MB, 66*MB, 0x0e))
+        self.assertEqual(root['start'] % (3*MB), 0)
+
+    def test_layout_errors(self):
+        self.assertRaises(Exception, raspseed.partition_layout, 2048*MB, eraseblock=1000)
+        self.assertRaises(Exception, raspseed.partition_layout, 64*MB, bootsize=64)
+
+    def test_round_trip(self):
+        layout = raspseed.partition_layout(os.path.getsize(self.image), eraseblock=4*MB, boottype=0x0e)
+        raspseed.write_mbr(self.image, layout, diskid=0x12345678)
+        self.assertEqual(raspseed.read_partition_table(self.image), layout)
+        self.assertEqual(raspseed.partition_extents(self.image), [(p['start'], p['size']) for p in layout])
+        with open(self.image, 'rb') as f:
+            mbr = f.read(512)
+        self.assertEqual(struct.unpack('<I', mbr[440:444])[0], 0x12345678)
+        self.assertEqual(mbr[510:], b'\x55\xaa')
+
+    def test_keeps_disk_signature(self):
+        layout = raspseed.partition_layout(os.path.getsize(self.image))
+        raspseed.write_mbr(self.image, layout, diskid=0xcafe)
+        layout[1]['size'] -= 4*MB
+        raspseed.write_mbr(self.image, layout)
+        with open(self.image, 'rb') as f:
+            f.seek(440)
+            self.assertEqual(struct.unpack('<I', f.read(4))[0], 0xcafe)
+        self.assertEqual(raspseed.read_partition_table(self.image), layout)
+
+    def test_write_errors(self):
+        layout = raspseed.partition_layout(os.path.getsize(self.image))
+        self.assertRaises(Exception, raspseed.write_mbr, self.image, layout * 3)
+        layout[0]['size'] += 1
+        self.assertRaises(Exception, raspseed.write_mbr, self.image, layout)
+
+    def test_no_partition_table(self):
+        self.assertRaises(Exception, raspseed.read_partition_table, self.image)
+
+if __name__ == '__main__':
+    unittest.main()
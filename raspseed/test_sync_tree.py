@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import raspseed
+
+class SyncTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = self.tmp+'/overlay'
+        self.dst = self.tmp+'/root'
+        self.host = self.tmp+'/host'
+        self.manifest = self.tmp+'/state/overlay.json'
+        for d in (self.src, self.dst, self.host):
+            os.makedirs(d)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, data, mode=0o644):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+        os.chmod(path, mode)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def sync(self):
+        return raspseed.sync_tree(self.src, self.dst, manifest=self.manifest)
+
+    def test_copy(self):
+        self.write(self.src+'/etc/hostname', 'raspseed\n')
+        self.write(self.src+'/usr/local/bin/sprout', '#!/bin/sh\n', mode=0o755)
+        os.symlink('/usr/local/bin/sprout', self.src+'/usr/local/bin/grow')
+        os.chmod(self.src+'/usr/local/bin', 0o700)
+        stats = self.sync()
+        self.assertEqual((stats['copied'], stats['links'], stats['skipped']), (2, 1, 0))
+        self.assertEqual(self.read(self.dst+'/etc/hostname'), 'raspseed\n')
+        self.assertEqual(os.stat(self.dst+'/usr/local/bin/sprout').st_mode & 0o777, 0o755)
+        self.assertEqual(os.stat(self.dst+'/usr/local/bin').st_mode & 0o777, 0o700)
+        self.assertEqual(os.readlink(self.dst+'/usr/local/bin/grow'), '/usr/local/bin/sprout')
+        self.assertEqual(raspseed.read_json(self.manifest)['etc/hostname']['size'], len('raspseed\n'))
+
+    def test_resync(self):
+        self.write(self.src+'/etc/hostname', 'raspseed\n')
+        self.write(self.src+'/etc/motd', 'hi\n')
+        self.sync()
+        stats = self.sync()
+        self.assertEqual((stats['copied'], stats['skipped']), (0, 2))
+        # Touched but the same is skipped once it's hashed; changed in src or in dst is copied again
+        os.utime(self.src+'/etc/hostname', (0, 12345))
+        self.write(self.dst+'/etc/motd', 'changed in the image\n')
+        stats = self.sync()
+        self.assertEqual((stats['copied'], stats['skipped']), (1, 1))
+        self.assertEqual(self.read(self.dst+'/etc/motd'), 'hi\n')
+        self.write(self.src+'/etc/hostname', 'sprout\n')
+        stats = self.sync()
+        self.assertEqual((stats['copied'], stats['skipped']), (1, 1))
+        self.assertEqual(self.read(self.dst+'/etc/hostname'), 'sprout\n')
+
+    def test_keeps_existing(self):
+        self.write(self.dst+'/etc/fstab', 'proc /proc proc defaults 0 0\n')
+        os.chmod(self.dst+'/etc', 0o755)
+        self.write(self.src+'/etc/hostname', 'raspseed\n')
+        os.chmod(self.src+'/etc', 0o700)
+        self.sync()
+        self.assertEqual(self.read(self.dst+'/etc/fstab'), 'proc /proc proc defaults 0 0\n')
+        self.assertEqual(os.stat(self.dst+'/etc').st_mode & 0o777, 0o755)
+
+    def test_symlinks_stay_in_root(self):
+        # Like /var/run -> /run in the image, which must not mean the host's /run
+        os.makedirs(self.dst+'/run')
+        os.makedirs(self.dst+'/var')
+        os.symlink('/run', self.dst+'/var/run')
+        os.symlink('../../../../..'+self.host, self.dst+'/var/escape')
+        self.write(self.src+'/var/run/tor/tor.pid', '1\n')
+        self.write(self.src+'/var/escape/passwd', 'x\n')
+        self.sync()
+        self.assertEqual(self.read(self.dst+'/run/tor/tor.pid'), '1\n')
+        self.assertEqual(os.listdir(self.host), [])
+        self.assertEqual(self.read(self.dst+self.host+'/passwd'), 'x\n')
+
+    def test_replaces_symlink_file(self):
+        # A file in src replaces a link in dst; the link's target isn't written through
+        self.write(self.dst+'/etc/resolv.conf.host', 'nameserver 10.0.0.1\n')
+        os.symlink('/etc/resolv.conf.host', self.dst+'/etc/resolv.conf')
+        self.write(self.src+'/etc/resolv.conf', 'nameserver 127.0.0.1\n')
+        self.sync()
+        self.assertFalse(os.path.islink(self.dst+'/etc/resolv.conf'))
+        self.assertEqual(self.read(self.dst+'/etc/resolv.conf'), 'nameserver 127.0.0.1\n')
+        self.assertEqual(self.read(self.dst+'/etc/resolv.conf.host'), 'nameserver 10.0.0.1\n')
+
+    def test_directory_over_file(self):
+        self.write(self.dst+'/etc/tor', 'not a directory\n')
+        self.write(self.src+'/etc/tor/torrc', 'SocksPort 9050\n')
+        self.assertRaises(Exception, self.sync)
+
+class ResolveInRootTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(self.root+'/usr/lib')
+        os.symlink('usr/lib', self.root+'/lib')
+        os.symlink('/usr', self.root+'/opt')
+        os.symlink('loop', self.root+'/loop')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_resolve(self):
+        r = raspseed.resolve_in_root
+        self.assertEqual(r(self.root, 'lib/firmware'), self.root+'/usr/lib/firmware')
+        self.assertEqual(r(self.root, 'opt/lib'), self.root+'/usr/lib')
+        self.assertEqual(r(self.root, 'lib', follow=False), self.root+'/lib')
+        self.assertEqual(r(self.root, '../../etc/./passwd'), self.root+'/etc/passwd')
+        self.assertEqual(r(self.root, '.'), self.root)
+
+    def test_loop(self):
+        self.assertRaises(Exception, raspseed.resolve_in_root, self.root, 'loop/x')
+
+if __name__ == '__main__':
+    unittest.main()